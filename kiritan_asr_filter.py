@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+文字起こしの誤認識（Whisper の幻聴）を LLM に回す前に捨てる
+- 無音や雑音だけの録音でも Whisper は「ご視聴ありがとうございました」等の定番句や、同じ句の繰り返しを返す。
+  そのまま会話に入れると、1 回ごとに LLM の生成と読み上げが 1 ターンぶん走る
+- 判定は速い順に:
+  1. 録音のエネルギー: 声らしい大きさのフレームが合計 MIN_VOICED 秒に満たない（無音から出た文字起こし）
+  以下の文字列の判定は、声が少ない（SUSPECT_VOICED 秒未満）か録音が短い（SHORT_CAPTURE 秒未満）とき、
+  または録音が渡されないときだけ行う（はっきり話した「うんうんうんうん」等を捨てないように）
+  2. 定番句の辞書（トライ木）: 正規化した文字列の大半（COVERAGE 以上）が辞書の句で埋まっている
+  3. 繰り返し: 短い単位が REPEAT_MIN 回以上連続して文字列のほとんどを占める / zlib で縮みすぎる（圧縮率 > MAX_COMPRESSION）
+  4. 文字のエントロピー: 長さの割に使っている文字の種類が極端に少ない（「ああああ…」等）
+- 捨てた件数を理由別に集計し、直近に捨てた文字起こしも残す（閾値の調整用）
+
+使い方:
+  f = open_filter()                       # 無効なら None
+  why = f.check(text, pcm, fs)            # 捨てるなら理由（"energy" / "blocklist" / "repeat" / "entropy"）、通すなら None
+
+設定（環境変数）:
+  KIRITAN_ASR_FILTER=0            … 無効
+  KIRITAN_ASR_BLOCKLIST=path.txt  … 定番句を追加（1 行 1 句、# から後はコメント）
+"""
+
+import os
+import re
+import sys
+import math
+import zlib
+import threading
+import unicodedata
+from collections import Counter, deque
+from typing import Optional, List, Dict, Iterable, Tuple
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+FRAME_SEC = 0.02
+VOICE_DBFS = -45.0            # これより大きいフレームを声らしいとみなす
+MIN_VOICED = 0.25             # 声らしいフレームの合計がこれ未満なら無音扱い（秒）
+SUSPECT_VOICED = 1.0          # 声がこれ未満なら文字列の判定もする（秒）
+SHORT_CAPTURE = 1.5           # 録音がこれより短ければ文字列の判定もする（秒）
+COVERAGE = 0.6                # 定番句が文字列のこれ以上を占めたら捨てる
+REPEAT_MIN = 6                # 同じ単位がこれ以上続いたら繰り返し
+REPEAT_COVERAGE = 0.8          # 繰り返しが文字列のこれ以上を占めたら捨てる
+MAX_COMPRESSION = 2.4         # Whisper 自身の幻聴判定と同じ目安
+MIN_ENTROPY = 2.0             # 文字あたりのビット数
+ENTROPY_MIN_LEN = 12          # これより短い文字起こしはエントロピーを見ない（「はい」等）
+RECENT = 50
+
+# Whisper が無音・雑音から返しがちな定番句（正規化して登録する）
+DEFAULT_BLOCKLIST = [
+    "ご視聴ありがとうございました",
+    "ご視聴いただきありがとうございました",
+    "最後までご視聴いただきありがとうございました",
+    "最後までご視聴頂きありがとうございました",
+    "ご清聴ありがとうございました",
+    "チャンネル登録お願いします",
+    "チャンネル登録よろしくお願いします",
+    "チャンネル登録と高評価をお願いします",
+    "高評価とチャンネル登録をお願いします",
+    "次回もお楽しみに",
+    "また次回お会いしましょう",
+    "字幕視聴ありがとうございました",
+    "thank you for watching",
+    "thanks for watching",
+    "please subscribe",
+    "subtitles by the amara.org community",
+]
+
+
+def normalize(text: str) -> str:
+    """NFKC・小文字化して、空白と記号を落とす（句読点の有無で判定が揺れないように）"""
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"[\s\W_]+", "", t)
+
+
+# ---------------- 定番句のトライ木 ----------------
+class PhraseTrie:
+    _END = "\0"
+
+    def __init__(self, phrases: Iterable[str] = ()):
+        self.root: Dict = {}
+        self.size = 0
+        for p in phrases:
+            self.add(p)
+
+    def add(self, phrase: str):
+        key = normalize(phrase)
+        if not key:
+            return
+        node = self.root
+        for ch in key:
+            node = node.setdefault(ch, {})
+        if self._END not in node:
+            node[self._END] = phrase
+            self.size += 1
+
+    def _longest_at(self, text: str, i: int) -> int:
+        node, best = self.root, 0
+        for j in range(i, len(text)):
+            node = node.get(text[j])
+            if node is None:
+                break
+            if self._END in node:
+                best = j + 1 - i
+        return best
+
+    def coverage(self, norm: str) -> Tuple[float, List[str]]:
+        """正規化済みの文字列のうち、登録句で覆われている割合と、当たった句"""
+        if not norm:
+            return 0.0, []
+        covered, hits, i = 0, [], 0
+        while i < len(norm):
+            n = self._longest_at(norm, i)
+            if n:
+                covered += n
+                hits.append(norm[i:i + n])
+                i += n
+            else:
+                i += 1
+        return covered / len(norm), hits
+
+
+def load_blocklist(path: str) -> List[str]:
+    phrases = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                phrases.append(line)
+    return phrases
+
+
+# ---------------- 個別の判定 ----------------
+def voiced_seconds(pcm, fs: int) -> float:
+    """声らしい大きさ（VOICE_DBFS 超）のフレームの合計秒数"""
+    x = np.asarray(pcm, dtype=np.float32).reshape(-1)
+    n = max(1, int(fs * FRAME_SEC))
+    frames = len(x) // n
+    if frames == 0:
+        return 0.0
+    rms = np.sqrt(np.mean(x[:frames * n].reshape(frames, n) ** 2, axis=1) + 1e-12)
+    return float(np.count_nonzero(20.0 * np.log10(rms) > VOICE_DBFS)) * n / fs
+
+
+def repeated_share(norm: str) -> float:
+    """1〜12 文字の単位が REPEAT_MIN 回以上続いている部分の割合"""
+    if len(norm) < REPEAT_MIN * 2:
+        return 0.0
+    pat = re.compile(r"(.{1,12}?)\1{%d,}" % (REPEAT_MIN - 1))
+    return sum(len(m.group(0)) for m in pat.finditer(norm)) / len(norm)
+
+
+def compression_ratio(text: str) -> float:
+    data = text.encode("utf-8")
+    return len(data) / max(1, len(zlib.compress(data)))
+
+
+def char_entropy(norm: str) -> float:
+    if not norm:
+        return 0.0
+    n = len(norm)
+    return max(0.0, -sum(c / n * math.log2(c / n) for c in Counter(norm).values()))
+
+
+# ---------------- 統計 ----------------
+class FilterStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.dropped = 0
+        self.reasons: Counter = Counter()
+        self.recent: deque = deque(maxlen=RECENT)     # (理由, 文字起こし)
+
+    def summary(self) -> str:
+        with self.lock:
+            rate = self.dropped / self.checked if self.checked else 0.0
+            why = " / ".join(f"{k} {v}" for k, v in self.reasons.most_common()) or "なし"
+            return f"判定 {self.checked} / 捨てた {self.dropped}（{rate:.0%}）: {why}"
+
+
+# ---------------- 本体 ----------------
+class AsrFilter:
+    def __init__(self, blocklist: Iterable[str] = DEFAULT_BLOCKLIST):
+        self.trie = PhraseTrie(blocklist)
+        self.stats = FilterStats()
+
+    def reason(self, text: str, pcm=None, fs: int = 16000) -> Optional[str]:
+        """捨てる理由（通すなら None）。統計は取らない"""
+        norm = normalize(text)
+        if not norm:
+            return None
+        if pcm is not None and np is not None:
+            voiced = voiced_seconds(pcm, fs)
+            if voiced < MIN_VOICED:
+                return "energy"
+            if voiced >= SUSPECT_VOICED and len(pcm) / fs >= SHORT_CAPTURE:
+                # 十分に声がある録音の文字起こしは信じる
+                return None
+        if self.trie.coverage(norm)[0] >= COVERAGE:
+            return "blocklist"
+        if repeated_share(norm) >= REPEAT_COVERAGE:
+            return "repeat"
+        if len(norm) >= ENTROPY_MIN_LEN:
+            if compression_ratio(norm) > MAX_COMPRESSION:
+                return "repeat"
+            if char_entropy(norm) < MIN_ENTROPY:
+                return "entropy"
+        return None
+
+    def check(self, text: str, pcm=None, fs: int = 16000) -> Optional[str]:
+        why = self.reason(text, pcm, fs)
+        with self.stats.lock:
+            self.stats.checked += 1
+            if why:
+                self.stats.dropped += 1
+                self.stats.reasons[why] += 1
+                self.stats.recent.append((why, text))
+        return why
+
+
+def open_filter() -> Optional[AsrFilter]:
+    """KIRITAN_ASR_FILTER=0 なら None。KIRITAN_ASR_BLOCKLIST の句を既定の辞書に足す"""
+    if (os.getenv("KIRITAN_ASR_FILTER") or "").strip().lower() in ("0", "off", "false"):
+        return None
+    phrases = list(DEFAULT_BLOCKLIST)
+    path = (os.getenv("KIRITAN_ASR_BLOCKLIST") or "").strip()
+    if path:
+        try:
+            phrases += load_blocklist(path)
+        except OSError as e:
+            print(f"[asr] KIRITAN_ASR_BLOCKLIST を読めません: {e}", file=sys.stderr)
+    return AsrFilter(phrases)
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(prog="kiritan_asr_filter", description="文字起こしの判定だけを試す")
+    p.add_argument("text", nargs="+")
+    args = p.parse_args()
+    f = open_filter() or AsrFilter()
+    for t in args.text:
+        norm = normalize(t)
+        cov, hits = f.trie.coverage(norm)
+        print(f"{f.reason(t) or 'ok':9s} {t!r}  辞書 {cov:.0%}{' ' + ','.join(hits) if hits else ''}"
+              f" / 繰り返し {repeated_share(norm):.0%} / 圧縮率 {compression_ratio(norm):.2f}"
+              f" / エントロピー {char_entropy(norm):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+話しながら文字起こし（長い発話用のストリーミング ASR）
+- 録音を止めてから全体を 1 回アップロードする代わりに、録音中の音声を VAD の「間」で区切って
+  チャンクごとに並行アップロードする（話し終わった時点で、残りは最後のチャンク 1 本分だけ）
+- 区切りは 無音が PAUSE 秒続いた所（チャンクが MIN_CHUNK 秒以上のとき）。間が無いまま MAX_CHUNK 秒に
+  達したら、直近 1 秒でいちばん静かなフレームで切る
+- 間が無くて切ったときは、隣のチャンクと OVERLAP 秒重ねて送る（切れ目の単語を落とさない）。
+  重なって二重に出た文字はつなぐときに取り除く（末尾と先頭の一致 → だめなら近い位置の最長一致）。
+  取り除くのは実際に重ねて送った切れ目だけ（間で切った所は「ですです」のような本当の繰り返しを残す）
+- 無音が END_SILENCE 秒続いたら発話終了。録音時間の指定は上限としてだけ使う
+- 発話終了から文字起こし完了までの待ち（tail）とチャンク数を集計
+
+使い方:
+  st = StreamingTranscriber(lambda pcm, fs: whisper(pcm, fs))
+  text = listen_streaming(st, max_seconds=30)
+  python kiritan_asr_stream.py rec.wav [--realtime]   … チャンクの切れ目を確認（ASR なし）
+
+設定（環境変数）:
+  KIRITAN_ASR_STREAM=0  … 無効（従来どおり録音 → 全体を 1 回で文字起こし）
+"""
+
+import os
+import sys
+import time
+import queue
+import difflib
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Callable, Tuple
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+try:
+    import sounddevice as sd
+except Exception:
+    sd = None
+
+FS = 16000
+FRAME = 0.02                  # VAD のフレーム長（秒）
+PAUSE = 0.35                  # チャンクを区切る無音
+END_SILENCE = 0.9             # 発話終了とみなす無音
+MIN_CHUNK = 2.0               # これより短いチャンクは間があっても区切らない
+MAX_CHUNK = 8.0               # 間が無くてもここで区切る
+OVERLAP = 0.3                 # 隣のチャンクと重ねる秒数
+LEAD = 0.2                    # 発話開始の前に含める秒数
+NO_SPEECH = 8.0               # これだけ待っても話し始めなければ終了
+SPEECH_RMS = 0.01             # 有声とみなす最低 RMS（雑音レベルの VOICE_RATIO 倍と大きい方）
+VOICE_RATIO = 3.0
+WORKERS = 3                   # 同時アップロード数
+MIN_STITCH = 2                # 重なりとして取り除く最短文字数
+STITCH_WINDOW = 24            # 重なりを探す範囲（文字）
+
+
+def enabled() -> bool:
+    return np is not None and (os.getenv("KIRITAN_ASR_STREAM") or "1").strip().lower() not in ("0", "off", "false")
+
+
+# ---------------- つなぎ合わせ ----------------
+def _norm(text: str) -> Tuple[str, List[int]]:
+    """比較用に正規化した文字列と、各文字の元の位置"""
+    chars, index = [], []
+    for i, ch in enumerate(text):
+        c = unicodedata.normalize("NFKC", ch).lower()
+        if c and (c.isalnum() or unicodedata.category(c[0]).startswith("L")):
+            chars.append(c[0])
+            index.append(i)
+    return "".join(chars), index
+
+
+def stitch(head: str, tail: str, overlap: bool = True) -> str:
+    """
+    head の末尾と tail の先頭の重なり（チャンクの重なりで二重に起こされた部分）を除いてつなぐ。
+    overlap=False（音声を重ねずに切った所）なら重なりは探さずにそのままつなぐ
+    """
+    head, tail = head.rstrip(), tail.strip()
+    if not head or not tail:
+        return head or tail
+    if not overlap:
+        return _concat(head, tail)
+    # 重なった部分は tail 側を残す（切れ目で欠けた単語も、次のチャンクでは頭から入っている）
+    base = max(0, len(head) - STITCH_WINDOW * 2)
+    a, a_index = _norm(head[base:])
+    b, b_index = _norm(tail[:STITCH_WINDOW * 2])
+    keep, start = len(head), 0
+    for k in range(min(len(a), len(b), STITCH_WINDOW), MIN_STITCH - 1, -1):
+        if a.endswith(b[:k]):
+            keep = base + a_index[len(a) - k]
+            break
+    else:
+        # 切れ目の単語が両側で少し違って起こされることがあるので、端の近くの最長一致も見る
+        wa, wb = a[-STITCH_WINDOW:], b[:STITCH_WINDOW]
+        blk = difflib.SequenceMatcher(None, wa, wb, autojunk=False).find_longest_match(0, len(wa), 0, len(wb))
+        if blk.size >= MIN_STITCH + 1 and blk.b <= 3 and len(wa) - (blk.a + blk.size) <= 3:
+            keep = base + a_index[len(a) - len(wa) + blk.a]
+            start = b_index[blk.b]
+    return _concat(head[:keep].rstrip(), tail[start:])
+
+
+def _concat(head: str, tail: str) -> str:
+    if not head or not tail:
+        return head or tail
+    sep = " " if head[-1].isascii() and head[-1].isalnum() and tail[0].isascii() else ""
+    return head + sep + tail
+
+
+# ---------------- 統計 ----------------
+class AsrStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.utterances = 0
+        self.chunks = 0
+        self.skipped = 0          # prefilter（自分の再生音の除去など）で送らなかったチャンク
+        self.failed = 0
+        self.speech_s = 0.0
+        self.tails: deque = deque(maxlen=200)     # 発話終了 → 文字起こし完了
+
+    def summary(self) -> str:
+        with self.lock:
+            tails = sorted(self.tails)
+            p50 = tails[len(tails) // 2] if tails else 0.0
+            p95 = tails[min(len(tails) - 1, int(round(0.95 * (len(tails) - 1))))] if tails else 0.0
+            return (f"発話 {self.utterances}（計 {self.speech_s:.0f}s）: チャンク {self.chunks}"
+                    f" / 送らず {self.skipped} / 失敗 {self.failed} | 話し終わり→完了 p50 {p50:.2f}s p95 {p95:.2f}s")
+
+
+STATS = AsrStats()
+
+
+# ---------------- 本体 ----------------
+class StreamingTranscriber:
+    """
+    feed() に録音ブロック（float32 mono）を渡していき、True が返ったら発話終了 → result()
+    transcribe(pcm, fs) … 1 チャンクの文字起こし（別スレッドから並行に呼ばれる）
+    prefilter(pcm, t0) … 送る前の加工。None を返したらそのチャンクは送らない（t0 はチャンク先頭の時刻）
+    on_partial(text) … 間で区切ったところまでの文字起こしが揃ったときの途中結果（別スレッドから呼ばれる）
+    """
+
+    def __init__(self, transcribe: Callable[["np.ndarray", int], str], fs: int = FS, max_seconds: float = 30.0,
+                 prefilter: Optional[Callable[["np.ndarray", float], Optional["np.ndarray"]]] = None,
+                 workers: int = WORKERS, on_partial: Optional[Callable[[str], None]] = None):
+        self.transcribe = transcribe
+        self.prefilter = prefilter
+        self.on_partial = on_partial
+        self.fs = fs
+        self.frame = int(FRAME * fs)
+        self.audio = np.zeros(int(max_seconds * fs), dtype=np.float32)
+        self.n = 0
+        self.started_at: Optional[float] = None      # 最初のブロックを受けた時刻（= audio[0] の時刻）
+        self.ended_at: Optional[float] = None
+        self.ended = False
+        self.chunks: List[Tuple[int, int]] = []      # 送ったチャンクの [開始, 終了) サンプル
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asr")
+        self._futures = []
+        self._pos = 0                 # VAD 済みの位置
+        self._floor: Optional[float] = None
+        self._voiced_run = 0
+        self._speech_at: Optional[int] = None
+        self._voiced_end = 0          # 最後の有声フレームの終わり
+        self._chunk_at = 0            # 次のチャンクの開始
+        self._rms: List[float] = []
+        self._lock = threading.Lock()
+        self._kinds: List[str] = []   # チャンクごとの切り方（"pause" / "max" / "end"）
+        self._overlaps: List[bool] = []   # 前のチャンクと音声が重なっているか（重なりを取り除いてつなぐか）
+        self._offered = 0
+
+    # ---- 入力 ----
+    def feed(self, block) -> bool:
+        if self.ended:
+            return True
+        if self.started_at is None:
+            self.started_at = time.time() - len(block) / self.fs
+        x = np.asarray(block, dtype=np.float32).reshape(len(block), -1).mean(axis=1)
+        room = len(self.audio) - self.n
+        self.audio[self.n:self.n + min(room, len(x))] = x[:room]
+        self.n += min(room, len(x))
+        while self._pos + self.frame <= self.n and not self.ended:
+            self._step()
+        if self.n >= len(self.audio) and not self.ended:
+            self._finish(self.n)
+        return self.ended
+
+    def _step(self):
+        f = self.audio[self._pos:self._pos + self.frame]
+        rms = float(np.sqrt(np.mean(f * f)))
+        self._rms.append(rms)
+        self._pos += self.frame
+        if self._floor is None:
+            self._floor = rms
+        voiced = rms > max(SPEECH_RMS, self._floor * VOICE_RATIO)
+        if not voiced:
+            # 雑音レベルは無声フレームでゆっくり追う
+            self._floor = 0.95 * self._floor + 0.05 * rms
+        self._voiced_run = self._voiced_run + 1 if voiced else 0
+
+        if self._speech_at is None:
+            if self._voiced_run >= 2:
+                self._speech_at = self._pos - 2 * self.frame
+                self._chunk_at = max(0, self._speech_at - int(LEAD * self.fs))
+                self._voiced_end = self._pos
+            elif self._pos >= NO_SPEECH * self.fs:
+                self._finish(None)
+            return
+        if voiced:
+            self._voiced_end = self._pos
+
+        silence = self._pos - self._voiced_end
+        length = self._pos - self._chunk_at
+        if silence >= END_SILENCE * self.fs:
+            self._finish(self._voiced_end + int(LEAD * self.fs))
+        elif silence >= PAUSE * self.fs and length >= MIN_CHUNK * self.fs:
+            # 無音の真ん中で切る（両側に無音が残るので重ねなくてよい）
+            self._cut(self._voiced_end + silence // 2, 0, "pause")
+        elif length >= MAX_CHUNK * self.fs:
+            # 間が無い → 直近 1 秒でいちばん静かなフレームで切り、単語の途中かもしれないので重ねる
+            back = min(len(self._rms), int(1.0 / FRAME))
+            i = int(np.argmin(self._rms[-back:]))
+            self._cut(self._pos - (back - i) * self.frame + self.frame // 2, int(OVERLAP * self.fs), "max")
+
+    # ---- チャンク ----
+    def _cut(self, end: int, overlap: int, kind: str):
+        self._submit(self._chunk_at, end, kind)
+        self._chunk_at = max(self._chunk_at, end - overlap)
+
+    def _submit(self, start: int, end: int, kind: str):
+        if end - start < self.frame * 5:
+            return
+        # 重ねるのは MAX_CHUNK で切った後だけ。実際に前のチャンクと重なっているときに限って重なりを探す
+        overlaps = bool(self.chunks) and self._kinds[-1] == "max" and start < self.chunks[-1][1]
+        self.chunks.append((start, end))
+        pcm = self.audio[start:end].copy()
+        t0 = self.started_at + start / self.fs
+        fut = self._pool.submit(self._run, pcm, t0)
+        with self._lock:
+            self._futures.append(fut)
+            self._kinds.append(kind)
+            self._overlaps.append(overlaps)
+        fut.add_done_callback(self._partial)
+
+    def _partial(self, _fut):
+        # 間で区切ったチャンクまでが全部返ってきたら、その時点のつなぎ合わせを途中結果として渡す
+        if self.on_partial is None:
+            return
+        with self._lock:
+            futures = list(self._futures)
+            overlaps = list(self._overlaps)
+            if (self._kinds[-1] != "pause" or self._offered >= len(futures)
+                    or not all(f.done() for f in futures)):
+                return
+            self._offered = len(futures)
+        text = self._join([f.result() for f in futures], overlaps)
+        try:
+            self.on_partial(text)
+        except Exception as e:
+            print(f"[asr] on_partial error: {e}", file=sys.stderr)
+
+    def _run(self, pcm, t0: float) -> str:
+        if self.prefilter is not None:
+            pcm = self.prefilter(pcm, t0)
+            if pcm is None:
+                with STATS.lock:
+                    STATS.skipped += 1
+                return ""
+        try:
+            return (self.transcribe(pcm, self.fs) or "").strip()
+        except Exception as e:
+            with STATS.lock:
+                STATS.failed += 1
+            print(f"[asr] チャンクの文字起こし失敗: {e}", file=sys.stderr)
+            return ""
+
+    def _finish(self, end: Optional[int]):
+        self.ended = True
+        self.ended_at = time.time()
+        # 最後に区切った後に声が無ければ（区切り → そのまま終了）追加のチャンクは送らない
+        if end is not None and self._speech_at is not None and (
+                not self.chunks or self._voiced_end > self.chunks[-1][1]):
+            self._submit(self._chunk_at, min(self.n, end), "end")
+
+    # ---- 結果 ----
+    def result(self, timeout: Optional[float] = None) -> str:
+        if not self.ended:
+            self._finish(self.n)
+        text = self._join([fut.result(timeout=timeout) for fut in self._futures], self._overlaps)
+        self._pool.shutdown(wait=False)
+        with STATS.lock:
+            if self._futures:
+                STATS.utterances += 1
+                STATS.chunks += len(self._futures)
+                STATS.speech_s += (self.chunks[-1][1] - self.chunks[0][0]) / self.fs
+                STATS.tails.append(time.time() - self.ended_at)
+        return text
+
+    @staticmethod
+    def _join(texts: List[str], overlaps: List[bool]) -> str:
+        text = ""
+        for t, overlap in zip(texts, overlaps):
+            text = stitch(text, t, overlap)
+        return text
+
+    def speech(self) -> "np.ndarray":
+        """発話区間の音声（エコー判定やトレース用）"""
+        if not self.chunks:
+            return self.audio[:0]
+        return self.audio[self.chunks[0][0]:self.chunks[-1][1]]
+
+
+def listen_streaming(st: StreamingTranscriber, max_seconds: float, block: float = 0.05) -> str:
+    """マイクから録りながら st に流し、発話終了（または max_seconds）で文字起こし結果を返す"""
+    if sd is None:
+        raise RuntimeError("sounddevice が未インストールです。`pip install sounddevice`")
+    q: "queue.Queue" = queue.Queue()
+    deadline = time.time() + max_seconds
+    with sd.InputStream(samplerate=st.fs, channels=1, dtype="float32", blocksize=int(st.fs * block),
+                        callback=lambda data, frames, t, status: q.put(data[:, 0].copy())):
+        while time.time() < deadline:
+            try:
+                if st.feed(q.get(timeout=1.0)):
+                    break
+            except queue.Empty:
+                continue
+    return st.result()
+
+
+def main():
+    import argparse
+    from kiritan_playback import decode_wav, resample
+    p = argparse.ArgumentParser(prog="kiritan_asr_stream")
+    p.add_argument("wav")
+    p.add_argument("--realtime", action="store_true", help="実時間で流す（tail の確認用）")
+    args = p.parse_args()
+
+    pcm, fs = decode_wav(args.wav)
+    pcm = pcm.mean(axis=1) if pcm.ndim > 1 else pcm
+    if fs != FS:
+        pcm = resample(pcm, fs, FS)
+    st = StreamingTranscriber(lambda x, fs: f"[{len(x) / fs:.1f}s]", max_seconds=len(pcm) / FS + 1)
+    step = int(0.05 * FS)
+    for i in range(0, len(pcm), step):
+        if st.feed(pcm[i:i + step]):
+            break
+        if args.realtime:
+            time.sleep(0.05)
+    print(st.result())
+    for a, b in st.chunks:
+        print(f"  {a / FS:6.2f} - {b / FS:6.2f}s  ({(b - a) / FS:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+オートプレイ版（2キャラ自動会話）
+- 2人のペルソナ（system プロンプト / cid を個別指定）が交互に会話を続ける
+- ダブルバッファ: ターン N の再生中に、ターン N+1 の生成と WAV レンダリング（SeikaSay2 -save）を進める
+- 再生は kiritan_playback のギャップレスエンジン（文単位で先読みレンダリング）
+- 話題シード / ターン数・時間の上限 / 人間の割り込みキュー（標準入力に打った行が次の生成に入る）
+- ターン間の無音（dead air = 前ターン再生終了 → 次ターン再生開始）を計測し、終了時に集計表示
+- KIRITAN_ADAPTIVE_SPEED があれば、読み上げ待ちが溜まったときだけ話速を上げる（kiritan_speedctl）
+
+使い方:
+  python kiritan_autoplay.py --topic "冬の過ごし方" --turns 20
+  python kiritan_autoplay.py --personas personas.json --minutes 10
+
+personas.json の例:
+  [{"name": "きりたん", "cid": 1707, "system": "..."},
+   {"name": "ずん子",   "cid": 1708, "system": "..."}]
+
+実行中の入力:
+  テキスト → 割り込み（観客の発言として次のターンに反映）
+  exit / quit → 終了
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Tuple
+
+from kiritan_hedge import get_policy, hedged_stream
+from kiritan_playback import PlaybackEngine, Segment, split_sentences, DEFAULT_LOOKAHEAD
+from kiritan_speech import backend_from_env
+from kiritan_speedctl import open_speedctl, unstarted_seconds
+from kiritan_engine_pool import pool_from_env
+from kiritan_budget import SpeechBudget, token_kwargs, collect, STATS as BUDGET_STATS
+from kiritan_ratelimit import limit_client, get_limiter
+from kiritan_timestretch import STATS as STRETCH_STATS
+
+# LLM
+try:
+    from openai import OpenAI
+except Exception:
+    OpenAI = None
+
+
+# ---------------- 設定 ----------------
+CID_KIRITAN = 1707
+DEFAULT_SPEED = 1.0
+DEFAULT_MODELS = ["gpt-4o-mini", "o4-mini-high", "o3-mini", "gpt-4o"]
+HISTORY_WINDOW = 12           # 直近だけ送ってトークン節約（GUI 版と同じ）
+BUDGET = SpeechBudget.from_env()
+
+PERSONA_RULES = (
+    "これは{other}との掛け合い会話です。話題: {topic}\n"
+    "1〜3文の短い話し言葉で返し、相手が返しやすいように会話をつないでください。"
+    "観客からの発言があれば、自然に拾ってください。"
+)
+
+
+@dataclass
+class Persona:
+    name: str
+    cid: int
+    system: str
+
+
+@dataclass
+class Turn:
+    index: int
+    speaker: Persona
+    text: str
+    segments: List[Segment]   # 再生エンジンに投入した文単位のセグメント
+    generated_at: float
+
+
+DEFAULT_PERSONAS = [
+    Persona("きりたん", CID_KIRITAN,
+            "あなたは『東北きりたん』です。ちょっと生意気で可愛らしい口調で話します。"),
+    Persona("相方", int(os.getenv("KIRITAN_CID_B") or CID_KIRITAN),
+            "あなたはきりたんの相方です。落ち着いた優しい口調で話します。"),
+]
+
+
+# ---------------- ユーティリティ ----------------
+def load_personas(path: Optional[str]) -> List[Persona]:
+    if not path:
+        return DEFAULT_PERSONAS[:]
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    personas = [Persona(p["name"], int(p.get("cid", CID_KIRITAN)), p.get("system", "")) for p in raw]
+    if len(personas) != 2:
+        raise SystemExit("personas には 2 人分の定義が必要です。")
+    return personas
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(q * (len(s) - 1)))))
+    return s[k]
+
+
+# ---------------- 会話生成（OpenAI） ----------------
+def create_client():
+    if OpenAI is None:
+        raise RuntimeError("openai ライブラリが未インストールです。`pip install openai`")
+    key = os.getenv("OPENAI_API_KEY")
+    if not key:
+        raise RuntimeError("環境変数 OPENAI_API_KEY が未設定です。")
+    return limit_client(OpenAI(api_key=key))
+
+
+def _choose_models() -> List[str]:
+    env = (os.environ.get("OPENAI_MODEL") or "").strip()
+    if env:
+        return [env]
+    return DEFAULT_MODELS[:]
+
+
+def build_messages(me: Persona, other: Persona, topic: str,
+                   transcript: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+    """transcript（話者名, 発言）を me 視点の messages に変換する"""
+    system = me.system + "\n" + PERSONA_RULES.format(other=other.name, topic=topic)
+    messages = [{"role": "system", "content": system}]
+    for who, text in transcript[-HISTORY_WINDOW:]:
+        if who == me.name:
+            messages.append({"role": "assistant", "content": text})
+        elif who == other.name:
+            messages.append({"role": "user", "content": text})
+        else:
+            messages.append({"role": "user", "content": f"（{who}）{text}"})
+    if len(messages) == 1:
+        messages.append({"role": "user", "content": f"（司会）「{topic}」について話し始めてください。"})
+    return messages
+
+
+def chat_once(client, messages: List[Dict[str, str]], speed: float = DEFAULT_SPEED) -> str:
+    # 1 ターンの長さは読み上げ予算（KIRITAN_SPEECH_BUDGET の autoplay）で縛る
+    limit = BUDGET.max_tokens("autoplay", speed)
+    policy = get_policy()
+    if policy is not None:
+        return collect(hedged_stream(client, _choose_models(), messages, policy,
+                                     model_kwargs=lambda m: token_kwargs(m, limit), temperature=0.8),
+                       BUDGET.cutter("autoplay", speed))
+    last_err = None
+    for m in _choose_models():
+        try:
+            res = client.chat.completions.create(model=m, messages=messages, temperature=0.8,
+                                                 **token_kwargs(m, limit))
+            return collect([res.choices[0].message.content or ""], BUDGET.cutter("autoplay", speed))
+        except Exception as e:
+            last_err = e
+            print(f"[warn] {m} 失敗: {e}", file=sys.stderr)
+    raise RuntimeError(f"全モデル失敗: {last_err}")
+
+
+# ---------------- オートプレイ本体 ----------------
+class Autoplay:
+    """生成スレッドがターン N+1 を生成・投入し、再生エンジンがターン N を鳴らす（ダブルバッファ）"""
+
+    def __init__(self, client, personas: List[Persona], topic: str,
+                 max_turns: int = 0, max_seconds: float = 0.0, speed: float = DEFAULT_SPEED,
+                 engine: Optional[PlaybackEngine] = None):
+        self.client = client
+        self.personas = personas
+        self.topic = topic
+        self.max_turns = max_turns
+        self.max_seconds = max_seconds
+        self.speed = speed
+        self.speedctl = open_speedctl(speed, tag="autoplay")
+        self.engine = engine or PlaybackEngine(backend_from_env())
+        self.engine.on_start.append(self._on_start)
+        self.engine.on_finish.append(self._on_finish)
+
+        self.transcript: List[Tuple[str, str]] = []
+        self.interjections: "queue.Queue[str]" = queue.Queue()
+        self.stop = threading.Event()
+        self.started_at = 0.0
+
+        self.dead_air: List[float] = []       # 前ターン終了 → 次ターン開始（秒）
+        self.played = 0
+        self._last_turn_end: Optional[float] = None
+        self._last_segments: List[Segment] = []
+
+    def _expired(self, turns_done: int) -> bool:
+        if self.stop.is_set():
+            return True
+        if self.max_turns and turns_done >= self.max_turns:
+            return True
+        if self.max_seconds and time.time() - self.started_at >= self.max_seconds:
+            return True
+        return False
+
+    def _drain_interjections(self):
+        while True:
+            try:
+                text = self.interjections.get_nowait()
+            except queue.Empty:
+                return
+            self.transcript.append(("観客", text))
+            print(f"[interject] 観客 > {text}")
+
+    # ---- 再生イベント（エンジンのイベントスレッドから呼ばれる） ----
+    # seg.group は (ターン, 文の番号, 文の数)。turn.segments は投入が終わるまで空なので、先頭 / 末尾は番号で見る
+    def _on_start(self, seg: Segment):
+        turn, k, _ = seg.group
+        if k != 0 or seg.started_at is None:
+            return
+        if self._last_turn_end is not None:
+            self.dead_air.append(max(0.0, seg.started_at - self._last_turn_end))
+        print(f"{turn.speaker.name} > {turn.text}")
+
+    def _on_finish(self, seg: Segment):
+        _, k, n = seg.group
+        if k == n - 1 and not seg.error:
+            self._last_turn_end = seg.finished_at
+            self.played += 1
+
+    # ---- 生成 ----
+    def _producer(self):
+        i = 0
+        while not self._expired(i):
+            self._drain_interjections()
+            me = self.personas[i % 2]
+            other = self.personas[(i + 1) % 2]
+            try:
+                text = chat_once(self.client, build_messages(me, other, self.topic, self.transcript), self.speed)
+            except Exception as e:
+                print(f"[error] 生成失敗: {e}", file=sys.stderr)
+                time.sleep(1.0)
+                continue
+            if not text:
+                # 空の返答も失敗と同じく間を置く（すぐ投げ直すと API を空回りで叩き続ける）
+                print("[warn] 空の返答。1 秒後に生成し直します", file=sys.stderr)
+                time.sleep(1.0)
+                continue
+            # 次の生成は再生を待たずに進めるため、transcript には生成時点で積む
+            self.transcript.append((me.name, text))
+            turn = Turn(i, me, text, [], time.time())
+            speed = self.speed
+            if self.speedctl is not None:
+                speed = self.speedctl.update(self.engine.backlog_seconds() + unstarted_seconds(self._last_segments))
+            sentences = split_sentences(text)
+            turn.segments = [self.engine.submit(s, me.cid, speed, group=(turn, k, len(sentences)))
+                             for k, s in enumerate(sentences)]
+            self._last_segments = turn.segments
+            if not turn.segments:
+                continue
+            # このターンが鳴り始める（= 前のターンが終わる）まで次の生成は待つ
+            while not self.stop.is_set() and not turn.segments[0].started.wait(0.2):
+                pass
+            i += 1
+
+    def _stdin_reader(self):
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            if line.lower() in ("exit", "quit"):
+                self.stop.set()
+                return
+            self.interjections.put(line)
+
+    def run(self):
+        self.started_at = time.time()
+        threading.Thread(target=self._stdin_reader, daemon=True).start()
+        producer = threading.Thread(target=self._producer, daemon=True)
+        producer.start()
+        try:
+            while producer.is_alive():
+                producer.join(0.2)
+            if self.stop.is_set():
+                self.engine.cancel()
+            else:
+                self.engine.wait()
+        except KeyboardInterrupt:
+            self.stop.set()
+            self.engine.cancel()
+        self.stop.set()
+        self.report()
+
+    def report(self):
+        n = len(self.dead_air)
+        print()
+        print(f"[stats] ターン数: {self.played} / 経過 {time.time() - self.started_at:.1f}s")
+        if n:
+            ms = [x * 1000 for x in self.dead_air]
+            print(f"[stats] dead air: mean {sum(ms) / n:.0f}ms / p50 {_percentile(ms, 0.5):.0f}ms"
+                  f" / p95 {_percentile(ms, 0.95):.0f}ms / max {max(ms):.0f}ms")
+        print(f"[stats] 再生バッファ枯渇（文間・ターン間の隙間）合計: {self.engine.underrun_s * 1000:.0f}ms")
+        if get_policy() is not None:
+            print(f"[stats] hedge: {get_policy().stats.summary()}")
+        if BUDGET_STATS.replies:
+            print(f"[stats] budget: {BUDGET_STATS.summary()}")
+        if get_limiter() is not None:
+            print(f"[stats] ratelimit: {get_limiter().stats.summary()}")
+        if STRETCH_STATS.segments:
+            print(f"[stats] 話速の伸縮: {STRETCH_STATS.summary()}")
+        if getattr(self.engine, "post", None) is not None:
+            print(f"[stats] 後処理: {self.engine.post.stats.summary()}")
+        if self.speedctl is not None:
+            print(f"[stats] 話速: {self.speedctl.stats.summary()}")
+
+
+# ---------------- メイン ----------------
+def main():
+    p = argparse.ArgumentParser(prog="kiritan_autoplay")
+    p.add_argument("--personas", help="2 人分のペルソナ定義 JSON")
+    p.add_argument("--topic", default=os.getenv("AUTOPLAY_TOPIC", "最近ハマっていること"))
+    p.add_argument("--turns", type=int, default=0, help="最大ターン数（0 = 無制限）")
+    p.add_argument("--minutes", type=float, default=0.0, help="最大時間（分, 0 = 無制限）")
+    p.add_argument("--speed", type=float, default=DEFAULT_SPEED)
+    args = p.parse_args()
+
+    personas = load_personas(args.personas)
+    speed = max(0.5, min(4.0, args.speed))
+    print("=== オートプレイ（2キャラ会話） ===")
+    print(f"話題: {args.topic} / {personas[0].name}(cid={personas[0].cid}) × {personas[1].name}(cid={personas[1].cid})")
+    print("入力した行は割り込みとして次のターンに反映。exit で終了。\n")
+
+    # KIRITAN_ENGINES があれば複数エンジンへ振り分け（担当の無い cid は KIRITAN_SPEECH、既定 SeikaSay2 直）
+    pool = pool_from_env()
+    engine = PlaybackEngine(pool.render, lookahead=max(DEFAULT_LOOKAHEAD, pool.size)) if pool else None
+    Autoplay(create_client(), personas, args.topic,
+             max_turns=args.turns, max_seconds=args.minutes * 60.0, speed=speed, engine=engine).run()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n(CTRL+C) 終了します。")
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+読み上げ時間の予算（返答の長さを話す秒数で縛る）
+- モードごとに「最大 N 秒しゃべる」を設定（例: text=20, mic=12, loop=8）
+- 現在の speed とモーラ速度の見積もりから max_tokens を決める
+- ストリーミング中に予算を超えたら、収まる最後の文末で打ち切る（それ以降は受信もやめる）
+- 予算超過（打ち切り）の回数と超過秒数を集計
+
+設定（環境変数）:
+  KIRITAN_SPEECH_BUDGET=12                     … 全モード 12 秒
+  KIRITAN_SPEECH_BUDGET=text=20,mic=12,loop=8  … モード別
+  KIRITAN_SPEECH_BUDGET=0                      … 無効
+  KIRITAN_GUI_SPEED=1.2                        … GUI 版の話速（VOICEROID 側の設定に合わせる）
+"""
+
+import os
+import re
+import sys
+import threading
+from typing import Optional, Dict
+
+MORA_PER_SEC = 7.5            # speed 1.0 のときの話速（モーラ/秒）
+PAUSE_SEC = {"、": 0.15, ",": 0.15, "。": 0.35, "！": 0.35, "？": 0.35, "!": 0.35, "?": 0.35, "\n": 0.35}
+MORA_PER_TOKEN = 1.6          # 日本語の返答で 1 トークンあたりのモーラ数（概算）
+TOKEN_SLACK = 1.3             # 文末で切るための余裕（少し多めに生成させる）
+MIN_MAX_TOKENS = 32
+# GUI 版は話速を操作しないので、VOICEROID 側の設定値を環境変数で教えてもらう
+try:
+    GUI_SPEED = float(os.getenv("KIRITAN_GUI_SPEED") or 1.0)
+except ValueError:
+    GUI_SPEED = 1.0
+
+DEFAULT_BUDGETS: Dict[str, float] = {
+    "dual": 20.0, "text": 20.0, "mic": 12.0, "loop": 8.0, "autoplay": 12.0, "live": 15.0,
+}
+
+_SMALL_KANA = set("ぁぃぅぇぉゃゅょゎァィゥェォャュョヮ")
+_SENTENCE_END = re.compile(r"[。！？!?♪\n][」』）)]*")
+_CLAUSE_END = re.compile(r"[、,]")
+
+
+def estimate_mora(text: str) -> float:
+    """表記からのモーラ数の概算（かな=1, 拗音の小書き=0, 漢字≈1.8, 数字≈1.5, 英字≈0.6）"""
+    n = 0.0
+    for c in text or "":
+        o = ord(c)
+        if c in _SMALL_KANA:
+            continue
+        if 0x3041 <= o <= 0x30FF:           # ひらがな / カタカナ / ー
+            n += 1.0
+        elif 0x4E00 <= o <= 0x9FFF:         # 漢字（音読み 2 モーラが多い）
+            n += 1.8
+        elif c.isdigit():
+            n += 1.5
+        elif c.isalpha():
+            n += 0.6
+    return n
+
+
+def estimate_seconds(text: str, speed: float = 1.0) -> float:
+    speed = max(0.1, float(speed))
+    pauses = sum(PAUSE_SEC.get(c, 0.0) for c in text or "")
+    return (estimate_mora(text) / MORA_PER_SEC + pauses) / speed
+
+
+def max_tokens_for(seconds: float, speed: float = 1.0) -> int:
+    """seconds 秒しゃべれる分のトークン上限"""
+    mora = seconds * MORA_PER_SEC * max(0.1, float(speed))
+    return max(MIN_MAX_TOKENS, int(mora / MORA_PER_TOKEN * TOKEN_SLACK))
+
+
+def token_kwargs(model: str, max_tokens: Optional[int]) -> Dict[str, int]:
+    """o 系 / gpt-5（推論モデル）は max_tokens 非対応かつ推論トークンも数えるので上限を付けない"""
+    if not max_tokens or re.match(r"^(o\d|gpt-5)", model or ""):
+        return {}
+    return {"max_tokens": max_tokens}
+
+
+def trim_to_budget(text: str, seconds: float, speed: float = 1.0) -> str:
+    """予算に収まる最後の文末で切る。1 文目から超える場合は読点、それも無ければ 1 文目をそのまま返す"""
+    if estimate_seconds(text, speed) <= seconds:
+        return text
+    cut = ""
+    for m in _SENTENCE_END.finditer(text):
+        head = text[:m.end()]
+        if estimate_seconds(head, speed) > seconds:
+            break
+        cut = head
+    if cut:
+        return cut.strip()
+    first = _SENTENCE_END.search(text)
+    first = text[:first.end()] if first else text
+    for m in _CLAUSE_END.finditer(first):
+        head = first[:m.start()]
+        if estimate_seconds(head, speed) > seconds:
+            break
+        cut = head + "。"
+    return (cut or first).strip()
+
+
+# ---------------- 統計 ----------------
+class BudgetStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.replies = 0
+        self.cut = 0
+        self.over_s = 0.0
+        self.max_over_s = 0.0
+
+    def record(self, generated_s: float, budget_s: float, cut: bool):
+        with self.lock:
+            self.replies += 1
+            if cut:
+                over = max(0.0, generated_s - budget_s)
+                self.cut += 1
+                self.over_s += over
+                self.max_over_s = max(self.max_over_s, over)
+
+    def summary(self) -> str:
+        with self.lock:
+            n = max(1, self.replies)
+            return (f"replies={self.replies} 打ち切り={self.cut}（{self.cut / n:.0%}）"
+                    f" 超過 合計 {self.over_s:.1f}s / 最大 {self.max_over_s:.1f}s")
+
+
+STATS = BudgetStats()
+
+
+# ---------------- 予算 ----------------
+class SpeechBudget:
+    def __init__(self, budgets: Optional[Dict[str, float]] = None):
+        self.budgets = dict(DEFAULT_BUDGETS if budgets is None else budgets)
+
+    @classmethod
+    def from_env(cls) -> "SpeechBudget":
+        raw = (os.getenv("KIRITAN_SPEECH_BUDGET") or "").strip()
+        if not raw:
+            return cls()
+        budgets: Dict[str, float] = {}
+        try:
+            if "=" not in raw:
+                v = float(raw)
+                return cls({} if v <= 0 else {"*": v})
+            for part in raw.split(","):
+                k, v = part.split("=", 1)
+                budgets[k.strip()] = float(v)
+        except ValueError:
+            print(f"[budget] KIRITAN_SPEECH_BUDGET の値が不正です: {raw}（既定値を使用）", file=sys.stderr)
+            return cls()
+        return cls(budgets)
+
+    def seconds(self, mode: str) -> Optional[float]:
+        v = self.budgets.get(mode, self.budgets.get("*"))
+        return v if v and v > 0 else None
+
+    def max_tokens(self, mode: str, speed: float = 1.0) -> Optional[int]:
+        s = self.seconds(mode)
+        return max_tokens_for(s, speed) if s else None
+
+    def cutter(self, mode: str, speed: float = 1.0) -> Optional["BudgetCutter"]:
+        s = self.seconds(mode)
+        return BudgetCutter(s, speed) if s else None
+
+
+class BudgetCutter:
+    """ストリーミングの delta を受けて、予算超過を検知したら打ち切る"""
+
+    def __init__(self, seconds: float, speed: float = 1.0):
+        self.seconds = seconds
+        self.speed = speed
+        self.max_tokens = max_tokens_for(seconds, speed)
+        self.buf = []
+        self.exceeded = False
+
+    def feed(self, delta: str) -> bool:
+        """delta を追加。予算を超えたら True（= 受信をやめてよい）"""
+        self.buf.append(delta)
+        if not self.exceeded and estimate_seconds("".join(self.buf), self.speed) > self.seconds:
+            self.exceeded = True
+        return self.exceeded
+
+    def text(self) -> str:
+        """最終テキスト（超過していれば文末で切ったもの）。統計もここで記録"""
+        full = "".join(self.buf).strip()
+        out = trim_to_budget(full, self.seconds, self.speed) if self.exceeded else full
+        STATS.record(estimate_seconds(full, self.speed), self.seconds, self.exceeded)
+        if self.exceeded:
+            print(f"\n[budget] 読み上げ予算 {self.seconds:.0f}s を超過 → "
+                  f"{estimate_seconds(out, self.speed):.1f}s 分で打ち切り", file=sys.stderr)
+        return out
+
+
+def collect(deltas, cutter: Optional[BudgetCutter]) -> str:
+    """delta のイテレータを読み切る（予算を超えたらそこで close して打ち切る）"""
+    if cutter is None:
+        return "".join(deltas).strip()
+    for delta in deltas:
+        if cutter.feed(delta):
+            close = getattr(deltas, "close", None)
+            if close:
+                close()
+            break
+    return cutter.text()
@@ -2,9 +2,11 @@
 """
 きりたん会話・自動読み上げ（VOICEROID+ 東北きりたん EX）
  - 会話生成: OpenAI API（モデルは環境に応じて自動選択）
- - 読み上げ: SeikaSay2.exe の CLI (-play)
+ - 読み上げ: SeikaSay2.exe の CLI (-play)（KIRITAN_SPEECH で AssistantSeika HTTP / ヘッドレス等に切替）
  - 起動時と再生後に、VOICEROID のタブを「フレーズ編集」に自動で戻す
  - PowerShell のフォーカスが勝手に失われないよう前面復帰
+ - コンソール / VOICEROID のハンドルは起動時に 1 回だけ解決してキャッシュ（kiritan_winreg）
+ - KIRITAN_TIMELINE=1 / --profile N で各段階の区間を Chrome のトレース形式に書き出す（kiritan_timeline）
 
 必須:
   - OpenAI API キー: 環境変数 OPENAI_API_KEY
@@ -12,12 +14,9 @@
 """
 
 import os
+import re
 import sys
 import time
-import ctypes
-import subprocess
-import win32gui
-import win32process
 from typing import Optional, Tuple
 
 # 音声入出力（必要なら使う）
@@ -37,17 +36,27 @@ except Exception:
 # UI 操作（UIA バックエンド）
 from pywinauto import Application, timings
 
+from kiritan_winreg import WindowRegistry
+from kiritan_budget import SpeechBudget, token_kwargs, collect, STATS as BUDGET_STATS
+from kiritan_echo import open_echo, to_pcm16
+from kiritan_trace import open_trace, trace_turn
+from kiritan_timeline import open_timeline, span
+from kiritan_uia_worker import open_worker
+from kiritan_tabwatch import open_tabwatch
+from kiritan_speech import backend_from_env
+from kiritan_ratelimit import limit_client, get_limiter
+
 
 # ---------------- 設定 ----------------
 CID_KIRITAN = 1707            # 東北きりたんEX CID
 DEFAULT_SPEED = 1.0           # 読み上げ速度（Seika側の話速に対して倍率）
 DEFAULT_LISTEN = 0            # mic/loop 時の秒数（使わない場合は 0 のまま）
 VOICEROID_TITLE = 'VOICEROID＋ 東北きりたん EX'  # 全角プラス（＋）に注意
-
-# SeikaSay2.exe の既定パス（必要なら SEIKA_EXE 環境変数で上書き）
-DEFAULT_SEIKA_EXE = (
-    r"C:\Users\takum\Downloads\assistantseika20250113a\SeikaSay2\SeikaSay2.exe"
-)
+BUDGET = SpeechBudget.from_env()  # モード別の読み上げ秒数（KIRITAN_SPEECH_BUDGET）
+ECHO = open_echo()                # 自分の再生音の回り込み除去（KIRITAN_ECHO=0 で無効）
+TRACE = open_trace()              # 会話トレース（KIRITAN_TRACE、kiritan_replay.py で再生）
+TIMELINE = open_timeline()        # 区間のタイムライン（KIRITAN_TIMELINE / --profile N）
+SPEECH = backend_from_env()       # 読み上げの出口（KIRITAN_SPEECH、既定は SeikaSay2。SEIKA_EXE でパス指定）
 
 SYSTEM_PROMPT = (
     "あなたは『東北きりたんEX』です。可愛らしく親しみやすい口調で、"
@@ -56,39 +65,28 @@ SYSTEM_PROMPT = (
 
 
 # ---------------- ユーティリティ ----------------
-def seika_exe_path() -> str:
-    p = os.getenv("SEIKA_EXE") or DEFAULT_SEIKA_EXE
-    if not os.path.exists(p):
-        raise FileNotFoundError(
-            f"SeikaSay2.exe が見つかりません: {p}\n"
-            "環境変数 SEIKA_EXE で正しいパスを指定してください。"
-        )
-    return p
+# 起動時にコンソールと VOICEROID のハンドルを解決し、以後は生存確認だけで使い回す
+WINDOWS = WindowRegistry(r"^" + re.escape(VOICEROID_TITLE) + r"$")
+# タブ復帰などの UI 操作は別プロセスのワーカーで（COM のハングを期限で打ち切る。KIRITAN_UIA_WORKER=0 で無効）
+# タブが『フレーズ編集』から外れたときだけ裏で戻す（KIRITAN_TABWATCH=0 で無効）
+# どちらも子プロセス / スレッドを起こすので、import では作らず main() で作る
+UIA = None
+TABS = None
 
 
 def bring_powershell_front():
-    """PowerShell を前面に戻す（フォーカス維持）"""
-    def _cb(hwnd, _):
-        title = win32gui.GetWindowText(hwnd)
-        if "PowerShell" in title:
-            try:
-                ctypes.windll.user32.SetForegroundWindow(hwnd)
-            except Exception:
-                pass
+    """PowerShell を前面に戻す（フォーカス維持）。起動時に解決した自分のコンソールだけを対象にする"""
     try:
-        win32gui.EnumWindows(_cb, None)
+        with span("focus"):
+            WINDOWS.focus_console()
     except Exception:
         pass
 
 
 # ---------------- VOICEROID ウィンドウ検出＆接続 ----------------
 def find_voiceroid_handle() -> Tuple[Optional[int], Optional[int]]:
-    """VOICEROID ウィンドウの HWND と PID を返す"""
-    hwnd = win32gui.FindWindow(None, VOICEROID_TITLE)
-    if not hwnd:
-        return None, None
-    _, pid = win32process.GetWindowThreadProcessId(hwnd)
-    return hwnd, pid
+    """VOICEROID ウィンドウの HWND と PID を返す（キャッシュ済みハンドルが死んだときだけ再探索）"""
+    return WINDOWS.voiceroid_handle()
 
 
 def connect_by_pid_hwnd(pid: int, hwnd: int):
@@ -111,7 +109,13 @@ def ensure_phrase_tab():
     """
     VOICEROID のタブを『フレーズ編集』に合わせる。
     起動時と、再生のたびに呼ぶと安定。
+    UIA ワーカーが有効なら別プロセスで実行し、期限（KIRITAN_UIA_DEADLINE の tab）を超えたら諦める。
     """
+    if UIA is not None:
+        if not UIA.phrase_tab():
+            print("⚠️ 『フレーズ編集』タブに戻せませんでした（UIA ワーカー）")
+        return
+
     hwnd, pid = find_voiceroid_handle()
     if not (hwnd and pid):
         print("⚠️ VOICEROID ウィンドウが見つかりません（タブ切替スキップ）")
@@ -154,36 +158,78 @@ def ensure_phrase_tab():
     print("⚠️ 『フレーズ編集』タブが見つかりませんでした")
 
 
-# ---------------- 音声再生（SeikaSay2 CLI） ----------------
+def restore_phrase_tab():
+    """再生後のタブ復帰。見張りがあれば確認を頼むだけで待たない（外れていたときだけ裏で戻す）"""
+    with span("tab"):
+        if TABS is not None:
+            TABS.poke()
+        else:
+            ensure_phrase_tab()
+
+
+# ---------------- 音声再生（KIRITAN_SPEECH、既定 SeikaSay2 CLI） ----------------
+_engine = None
+
+
+def playback_engine():
+    """KIRITAN_PLAYBACK=engine のときに使うギャップレス再生エンジン（初回だけ生成）"""
+    global _engine
+    if _engine is None:
+        from kiritan_playback import PlaybackEngine, DEFAULT_LOOKAHEAD
+        from kiritan_engine_pool import pool_from_env
+        # KIRITAN_ENGINES があれば複数エンジンへ振り分け（先読み本数もエンジン数に合わせる）
+        pool = pool_from_env()
+        if pool is not None:
+            _engine = PlaybackEngine(pool.render, lookahead=max(DEFAULT_LOOKAHEAD, pool.size))
+        else:
+            _engine = PlaybackEngine(SPEECH)
+        # 再生した PCM を回り込み除去の参照にする
+        if ECHO is not None:
+            ECHO.attach(_engine)
+        if TRACE is not None:
+            TRACE.attach(_engine)
+        if TIMELINE is not None:
+            TIMELINE.attach(_engine)
+    return _engine
+
+
 def speak(text: str, speed: float = DEFAULT_SPEED):
     """
-    SeikaSay2.exe -play で非同期起動→待機。
+    読み上げの出口（既定は SeikaSay2.exe -play）で再生し、終わるまで待つ。
+    KIRITAN_PLAYBACK=engine なら文単位で先読みレンダリングし、隙間なく連続再生する。
     再生後は PowerShell を前面に戻し、VOICEROID のタブを『フレーズ編集』へ戻す。
     """
-    exe = seika_exe_path()
-    cmd = [
-        exe,
-        "-cid",   str(CID_KIRITAN),
-        "-speed", f"{float(speed):.2f}",
-        "-play",
-        "-nc",
-        "-t", text,
-    ]
+    if os.getenv("KIRITAN_PLAYBACK") == "engine":
+        engine = playback_engine()
+        try:
+            with span("speech", mode="engine"):
+                engine.speak(text, CID_KIRITAN, speed)
+                engine.wait()
+        except KeyboardInterrupt:
+            engine.cancel()
+            print("◆ 再生を中断しました。")
+        finally:
+            restore_phrase_tab()
+            bring_powershell_front()
+        return
+
+    # -play 経路は PCM が手元に無いので、文字照合用に発話だけ覚える
+    if ECHO is not None:
+        ECHO.note_text(text)
     try:
-        proc = subprocess.Popen(
-            cmd,
-            creationflags=subprocess.CREATE_NO_WINDOW
-        )
-        proc.wait()
+        t_start = time.time()
+        # -play は合成と再生が一体なので 1 区間
+        with span("render+play", backend=type(SPEECH).__name__):
+            SPEECH.speak(text, CID_KIRITAN, speed)
+        if TRACE is not None:
+            # -play は合成と再生が一体なので、起動から終了までを 1 区間として残す
+            TRACE.speech(text, t_start, time.time(), queued=t_start, cid=CID_KIRITAN, speed=speed)
     except KeyboardInterrupt:
-        try:
-            proc.terminate()
-        except Exception:
-            pass
+        SPEECH.cancel()
         print("◆ 再生を中断しました。")
     finally:
         # タブを戻す（音声効果に飛ばされる対策）
-        ensure_phrase_tab()
+        restore_phrase_tab()
         # PowerShell を前面に
         bring_powershell_front()
 
@@ -195,14 +241,16 @@ def create_client():
     key = os.getenv("OPENAI_API_KEY")
     if not key:
         raise RuntimeError("環境変数 OPENAI_API_KEY が未設定です。")
-    return OpenAI(api_key=key)
+    return limit_client(OpenAI(api_key=key))
 
 
-def chat_once(client, user_text: str) -> str:
+def chat_once(client, user_text: str, mode: str = "dual", speed: float = DEFAULT_SPEED) -> str:
     """
     利用可能そうなモデルを順に試す（環境によって異なるため）。
     OPENAI_MODEL が設定されていれば最優先。
+    返答はモード別の読み上げ予算（現在の speed で何秒か）に収まるよう文末で切る。
     """
+    limit = BUDGET.max_tokens(mode, speed)
     tried = []
     models = []
     if os.getenv("OPENAI_MODEL"):
@@ -218,8 +266,9 @@ def chat_once(client, user_text: str) -> str:
                     {"role": "system", "content": SYSTEM_PROMPT},
                     {"role": "user", "content": user_text},
                 ],
+                **token_kwargs(m, limit),
             )
-            return (res.choices[0].message.content or "").strip()
+            return collect([res.choices[0].message.content or ""], BUDGET.cutter(mode, speed))
         except Exception as e:
             tried.append(m)
             last_err = e
@@ -231,36 +280,75 @@ def listen_mic(limit: int) -> str:
     if not (sr and limit > 0):
         return ""
     r = sr.Recognizer()
-    with sr.Microphone() as mic:
+    with sr.Microphone() as mic, span("capture", source="mic"):
         print(f"[mic] 発話どうぞ（最大 {limit}s）…")
         audio = r.listen(mic, phrase_time_limit=limit)
+    if ECHO is not None:
+        with span("filter", kind="echo"):
+            raw = audio.get_raw_data(convert_rate=16000, convert_width=2)
+            raw = ECHO.filter_pcm16(raw, 16000, time.time() - len(raw) / 32000.0)
+        if raw is None:
+            print("[echo] 録音のほとんどが自分の再生音なのでスキップ")
+            return ""
+        audio = sr.AudioData(raw, 16000, 2)
     try:
-        return r.recognize_google(audio, language="ja-JP")
+        started = time.time()
+        with span("asr", model="google"):
+            text = r.recognize_google(audio, language="ja-JP")
     except Exception:
         return ""
+    trace_asr(audio, text, started)
+    return text
 
 
 def listen_loopback(limit: int) -> str:
     if not (sd and limit > 0):
         return ""
     print(f"[loop] システム音声録音（{limit}s）…")
-    rec = sd.rec(int(limit * 44100), samplerate=44100, channels=2)
-    sd.wait()
+    t0 = time.time()
+    with span("capture", source="loop"):
+        rec = sd.rec(int(limit * 44100), samplerate=44100, channels=2)
+        sd.wait()
     try:
-        data = rec.tobytes()
+        if ECHO is not None:
+            with span("filter", kind="echo"):
+                cleaned, ratio = ECHO.process(rec, 44100, t0)
+            if ECHO.should_skip(cleaned, ratio):
+                print("[echo] 録音のほとんどが自分の再生音なのでスキップ")
+                return ""
+            audio = sr.AudioData(to_pcm16(cleaned), ECHO.fs, 2)
+        else:
+            audio = sr.AudioData(rec.tobytes(), 44100, 2)
         recog = sr.Recognizer()
-        audio = sr.AudioData(data, 44100, 2)
-        return recog.recognize_google(audio, language="ja-JP")
+        started = time.time()
+        with span("asr", model="google"):
+            text = recog.recognize_google(audio, language="ja-JP")
     except Exception:
         return ""
+    trace_asr(audio, text, started)
+    return text
+
+
+def trace_asr(audio, text: str, started: float):
+    """トレース有効時、次のターンの入力として録音のハッシュと認識時間を残す"""
+    if TRACE is not None:
+        TRACE.note_audio(audio.get_raw_data(), audio.sample_rate, audio.sample_width)
+        TRACE.note_input(asr={"model": "google", "text": text, "sec": round(time.time() - started, 3)})
 
 
 # ---------------- メイン ----------------
 def main():
-    # 起動直後にタブを『フレーズ編集』へ
+    global UIA, TABS
+    UIA = open_worker(r"^" + re.escape(VOICEROID_TITLE) + r"$")
+    TABS = open_tabwatch(UIA)
+    # 起動直後にタブを『フレーズ編集』へ（UIA ワーカーは起動完了を待ってから）
+    if UIA is not None:
+        UIA.attach()
     ensure_phrase_tab()
 
     client = create_client()
+    if TRACE is not None:
+        client = TRACE.wrap(client)
     speed = DEFAULT_SPEED
     wait = DEFAULT_LISTEN
     mode = "dual"   # dual | text | mic | loop
@@ -270,6 +358,9 @@ def main():
 
     while True:
         try:
+            # mic / loop は録音からを 1 ターンの区間にする（コマンド等で終わったターンは次の開始で閉じる）
+            if TIMELINE is not None and mode in ("mic", "loop"):
+                TIMELINE.begin(mode)
             # 入力
             if mode == "dual":
                 user = input("You: ").strip()
@@ -295,6 +386,20 @@ def main():
 
             low = user.lower()
             if low in ("exit", "quit"):
+                if BUDGET_STATS.replies:
+                    print(f"[budget] {BUDGET_STATS.summary()}")
+                if ECHO is not None and ECHO.stats.checked:
+                    print(f"[echo] {ECHO.stats.summary()}")
+                if get_limiter() is not None and get_limiter().stats.requests:
+                    print(f"[ratelimit] {get_limiter().stats.summary()}")
+                if TABS is not None:
+                    print(f"[tab] {TABS.stats.summary()}")
+                    TABS.close()
+                if UIA is not None:
+                    print(f"[uia] {UIA.stats.summary()}")
+                    UIA.close()
+                if TIMELINE is not None:
+                    TIMELINE.close()
                 break
             if low.startswith("mode "):
                 v = low.split()[1]
@@ -319,19 +424,44 @@ def main():
                     print("speed X 形式")
                 continue
 
+            # 録音経路で自分の発話を拾っただけなら LLM に回さない
+            if mode in ("mic", "loop") and ECHO is not None and ECHO.is_echo_text(user):
+                print("[echo] 自分の発話の聞き取りなのでスキップ")
+                continue
+
             # 生成→読み上げ
-            reply = chat_once(client, user)
-            print(f"きりたん: {reply}")
-            speak(reply, speed)
+            if TIMELINE is not None:
+                if mode not in ("mic", "loop"):
+                    TIMELINE.begin(mode)
+                TIMELINE.label(user)
+            with trace_turn(TRACE, mode, user, speed=speed, cid=CID_KIRITAN) as turn:
+                with span("llm"):
+                    reply = chat_once(client, user, mode, speed)
+                print(f"きりたん: {reply}")
+                speak(reply, speed)
+                if turn is not None:
+                    turn.reply = reply
+            if TIMELINE is not None:
+                TIMELINE.end()
 
             # mic モードは続けて一往復
             if mode == "mic":
+                if TIMELINE is not None:
+                    TIMELINE.begin(mode)
                 follow = listen_mic(wait)
-                if follow:
+                if follow and not (ECHO is not None and ECHO.is_echo_text(follow)):
                     print(f"You (mic): {follow}")
-                    reply2 = chat_once(client, follow)
-                    print(f"きりたん: {reply2}")
-                    speak(reply2, speed)
+                    if TIMELINE is not None:
+                        TIMELINE.label(follow)
+                    with trace_turn(TRACE, mode, follow, speed=speed, cid=CID_KIRITAN) as turn:
+                        with span("llm"):
+                            reply2 = chat_once(client, follow, mode, speed)
+                        print(f"きりたん: {reply2}")
+                        speak(reply2, speed)
+                        if turn is not None:
+                            turn.reply = reply2
+                    if TIMELINE is not None:
+                        TIMELINE.end()
 
         except KeyboardInterrupt:
             print("\n(CTRL+C) 中断。続けます。")
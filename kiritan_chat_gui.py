@@ -23,7 +23,7 @@ except Exception:
 """
 GUI版：VOICEROID＋ 東北きりたん EX のウィンドウを UIA で掴み、テキストを流し込んで「再生」ボタンを押すだけ
 - AssistantSeika の HTTP/WCF などは一切使わない
-- 毎ループごとにウィンドウを再取得してタブを「フレーズ編集」に戻す
+- 毎ループごとにウィンドウを確認してタブを「フレーズ編集」に戻す（ハンドルは kiritan_winreg でキャッシュ）
 - * がタイトルに付く/付かない、全角＋/半角+ の揺れに対応
 - OpenAIキーがあれば簡易チャット応答、なければ入力そのまま読み上げ
 """
@@ -34,14 +34,17 @@ import time
 import re
 from typing import Optional
 
-from pywinauto import Desktop
-from pywinauto.application import Application
-from pywinauto.findwindows import ElementNotFoundError
 from pywinauto.base_wrapper import BaseWrapper
 
+from kiritan_winreg import WindowRegistry
+from kiritan_ratelimit import limit_client
+
 # タイトルの揺らぎ（+/＋, EX の後ろに * が付くなど）を許容
 TITLE_RE = r"VOICEROID[＋+].*東北きりたん\s*EX(?:\s*\*|\s*)$"
 
+# コンソール / VOICEROID のハンドルは起動時に 1 回だけ解決して使い回す
+WINDOWS = WindowRegistry(TITLE_RE)
+
 # -------- ユーティリティ --------
 
 def _rewrap(ctrl):
@@ -56,14 +59,7 @@ def _rewrap(ctrl):
 
 def find_voiceroid_window(timeout: float = 3.0) -> Optional[BaseWrapper]:
     """VOICEROID+ 東北きりたん EX のトップレベル Window を取る（なければ None）"""
-    end = time.time() + timeout
-    while time.time() < end:
-        wins = Desktop(backend="uia").windows(title_re=TITLE_RE, control_type="Window")
-        # 直近にアクティブっぽいものを優先（先頭）
-        if wins:
-            return _rewrap(wins[0])
-        time.sleep(0.2)
-    return None
+    return WINDOWS.voiceroid_window(timeout)
 
 def ensure_phrase_tab(win: BaseWrapper, quiet: bool = False) -> bool:
     """タブを『フレーズ編集』に確実に戻す（select→invoke→click の順でフォールバック）"""
@@ -173,29 +169,27 @@ def click_play(win: BaseWrapper) -> bool:
         return False
 
 def focus_console():
-    """PowerShell／ターミナルを前面に戻す（失敗しても無視）"""
+    """PowerShell／ターミナルを前面に戻す（起動時に解決した自分のコンソール。失敗しても無視）"""
     try:
-        # よく使うタイトルをざっくり網羅
-        cand = None
-        for w in Desktop(backend="uia").windows(control_type="Window"):
-            name = (w.element_info.name or "")
-            if ("PowerShell" in name) or ("Windows Terminal" in name) or ("ターミナル" in name):
-                cand = w; break
-        if cand:
-            _rewrap(cand).set_focus()
+        WINDOWS.focus_console()
     except Exception:
         pass
 
 # -------- 生成（任意：OPENAI_API_KEY があれば簡易応答） --------
+_client = None
+
 def gen_reply(user_text: str) -> str:
     """OPENAI_API_KEY があれば簡易チャット、なければユーザ入力をそのまま返す"""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         return user_text
+    global _client
     try:
-        # 1.x SDK を想定
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
+        # 1.x SDK を想定。クライアントは 1 つを使い回す（毎回作ると接続プールごと作り直しになる）
+        if _client is None:
+            from openai import OpenAI
+            _client = limit_client(OpenAI(api_key=api_key))
+        client = _client
         model = os.getenv("OPENAI_MODEL") or "gpt-4o-mini"
         sys_prompt = "あなたは東北きりたん風のシンプルで優しいアシスタントです。30〜60文字程度に収めて返答してください。"
         r = client.chat.completions.create(
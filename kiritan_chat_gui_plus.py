@@ -3,22 +3,17 @@
 GUI発展版（GUI Plus）
 - VOICEROID＋ 東北きりたん EX を UIA で掴み、テキストを流し込んで「再生」するだけ
 - AssistantSeika / HTTP/WCF は使わない
-- 毎ループでウィンドウを再取得 & 「フレーズ編集」タブに戻す
+- 毎ループでウィンドウを確認 & 「フレーズ編集」タブに戻す（ハンドルは kiritan_winreg でキャッシュ）
 - ターミナルにも返答を逐次表示
-- /reset /reload /retry /paste /clear /save /sys などの管理コマンド付き
+- /reset /reload /retry /paste /clear /save /sys /session などの管理コマンド付き
+- 会話履歴は SQLite（logs/sessions.db）に保存し、/session resume で再開できる
 注意: VOICEROID はユーザが先に起動しておくこと
 """
 
 import os
 import sys
-import time
-import re
 from typing import Optional, List, Dict
-
-from pywinauto import Desktop, keyboard
-from pywinauto.findwindows import ElementNotFoundError
-from pywinauto.base_wrapper import BaseWrapper
-from pywinauto.controls.hwndwrapper import HwndWrapper
+from collections import deque
 
 # ==== OpenAI ====
 try:
@@ -27,11 +22,24 @@ except Exception as e:
     print("openai パッケージが見つかりません。`pip install openai` を実行してください。", file=sys.stderr)
     raise
 
+from kiritan_hedge import get_policy, hedged_stream
+from kiritan_session import SessionStore, handle_command as session_command, trim_history
+from kiritan_memory import open_memory
+from kiritan_voiceroid_ui import (TITLE_RE, WINDOWS, find_voiceroid_window,
+                                  ensure_phrase_tab, set_phrase_text, click_play, click_save_and_type_path)
+from kiritan_budget import SpeechBudget, GUI_SPEED, token_kwargs, STATS as BUDGET_STATS
+from kiritan_uia_worker import open_worker
+from kiritan_tabwatch import open_tabwatch
+from kiritan_ratelimit import limit_client, get_limiter
+
 # ---- 設定 ----
-TITLE_RE = r"VOICEROID[＋+]\s*.*東北きりたん\s*EX(?:[^\S\r\n]*[\+\*/☆])?$"
-PLAY_LABEL_RE = r"再生"
-SAVE_LABEL_RE = r"音声保存"
-PHRASE_TAB_LABEL = "フレーズ編集"
+# 返答の長さは読み上げ秒数で縛る（KIRITAN_SPEECH_BUDGET の text）
+BUDGET = SpeechBudget.from_env()
+# UI 操作は別プロセスのワーカーで（COM のハングを期限で打ち切る。KIRITAN_UIA_WORKER=0 で無効）
+# タブが「フレーズ編集」から外れたときだけ裏で戻す（KIRITAN_TABWATCH=0 で無効）
+# どちらも子プロセス / スレッドを起こすので、import では作らず main() で作る
+UIA = None
+TABS = None
 
 DEFAULT_MODELS = ["gpt-4o-mini", "o4-mini-high", "o3-mini", "gpt-4o"]
 SYSTEM_PROMPT_DEFAULT = "あなたは気さくで、やさしく短めに返すアシスタントです。"
@@ -39,166 +47,24 @@ SYSTEM_PROMPT_DEFAULT = "あなたは気さくで、やさしく短めに返す
 LOG_DIR = "logs"
 os.makedirs(LOG_DIR, exist_ok=True)
 
-# ---- UTILS ----
-def _rewrap(ctrl) -> BaseWrapper:
-    """ElementInfo/Wrapper どちらでも Wrapper を返す"""
-    if isinstance(ctrl, BaseWrapper):
-        return ctrl
-    if hasattr(ctrl, "wrapper_object"):
-        return ctrl.wrapper_object()
-    return ctrl
-
-def find_voiceroid_window(timeout: float = 3.0) -> Optional[BaseWrapper]:
-    """VOICEROID トップレベルウィンドウを取る（見つからなければ None）"""
-    end = time.time() + timeout
-    while time.time() < end:
-        wins = Desktop(backend="uia").windows(title_re=TITLE_RE, control_type="Window")
-        if wins:
-            # 最も最近フォアグラウンドっぽいものを優先
-            return _rewrap(wins[0])
-        time.sleep(0.2)
-    return None
-
-def ensure_phrase_tab(win: BaseWrapper, timeout: float = 3.0) -> bool:
-    """「フレーズ編集」タブへ復帰（select→invoke→click_input フォールバック）"""
-    end = time.time() + timeout
-    while time.time() < end:
-        try:
-            tabs = win.descendants(control_type="TabItem")
-        except Exception:
-            tabs = []
-        for t in tabs:
-            name = (t.window_text() or t.element_info.name or "").strip()
-            if PHRASE_TAB_LABEL in name:
-                w = _rewrap(t)
-                try:
-                    w.select()
-                    return True
-                except Exception:
-                    pass
-                try:
-                    w.invoke()
-                    return True
-                except Exception:
-                    pass
-                try:
-                    w.click_input()
-                    return True
-                except Exception:
-                    pass
-        time.sleep(0.2)
-    return False
-
-def _find_text_area(win: BaseWrapper):
-    """入力欄（Document/Edit）候補を探す"""
-    nodes = []
-    try:
-        nodes = win.descendants(control_type="Document")
-    except Exception:
-        pass
-    if not nodes:
-        try:
-            nodes = win.descendants(control_type="Edit")
-        except Exception:
-            pass
-    return [_rewrap(x) for x in nodes]
+# ---- UI 操作の入口（UIA ワーカーがあれば別プロセスで、期限付き） ----
+# ワーカー使用時の win は HWND（int）。無効時は従来どおり UIA ラッパを直接操作する
+def ui_window(timeout: float = 3.0):
+    if UIA is not None:
+        return UIA.attach()
+    return find_voiceroid_window(timeout)
 
-def set_phrase_text(win: BaseWrapper, text: str) -> bool:
-    """入力欄に text を流し込む"""
-    areas = _find_text_area(win)
-    for a in areas:
-        try:
-            # UIA の edit wrapper は set_edit_text を持っていることが多い
-            if hasattr(a, "set_edit_text"):
-                a.set_edit_text(text)
-            else:
-                a.set_focus()
-                keyboard.send_keys("^a{BACKSPACE}")
-                time.sleep(0.05)
-                keyboard.send_keys(text, with_spaces=True, pause=0.01)
-            return True
-        except Exception:
-            continue
-    return False
-
-def click_play(win: BaseWrapper) -> bool:
-    """「再生」ボタンを押す -> 失敗時 F5 → Space"""
-    try:
-        btns = win.descendants(control_type="Button")
-    except Exception:
-        btns = []
-    # 名前に「再生」が含まれるボタンを可視優先で
-    cand = []
-    for b in btns:
-        name = (b.window_text() or b.element_info.name or "").strip()
-        if re.search(PLAY_LABEL_RE, name):
-            cand.append(_rewrap(b))
-    # 可視優先
-    cand = sorted(cand, key=lambda w: 0 if w.is_visible() else 1)
-    for w in cand:
-        try:
-            w.click_input()
-            return True
-        except Exception:
-            continue
-    # フォールバック
-    try:
-        win.set_focus()
-    except Exception:
-        pass
-    try:
-        keyboard.send_keys("{F5}")
-        return True
-    except Exception:
-        pass
-    try:
-        keyboard.send_keys(" ")
-        return True
-    except Exception:
-        pass
-    return False
-
-def click_save_and_type_path(win: BaseWrapper, path: str, timeout: float = 4.0) -> bool:
-    """「音声保存」→ 保存ダイアログにパス入力 → Enter"""
-    try:
-        btns = win.descendants(control_type="Button")
-    except Exception:
-        btns = []
-    target = None
-    for b in btns:
-        name = (b.window_text() or b.element_info.name or "").strip()
-        if re.search(SAVE_LABEL_RE, name):
-            target = _rewrap(b)
-            break
-    if not target:
-        return False
-    try:
-        target.click_input()
-    except Exception:
-        return False
-
-    # 保存ダイアログ（日本語/英語）にざっくり対応
-    end = time.time() + timeout
-    dlg = None
-    title_re = r"(名前を付けて保存|保存|Save As)"
-    while time.time() < end:
-        ds = Desktop(backend="uia").windows(title_re=title_re, control_type="Window")
-        if ds:
-            dlg = _rewrap(ds[0]); break
-        time.sleep(0.2)
-    if not dlg:
-        return False
-
-    try:
-        dlg.set_focus()
-        keyboard.send_keys("^l")           # パス入力ボックスへ（エクスプローラー準拠）
-        time.sleep(0.1)
-        keyboard.send_keys(path, with_spaces=True)
-        time.sleep(0.1)
-        keyboard.send_keys("{ENTER}")
-        return True
-    except Exception:
-        return False
+def ui_phrase_tab(win) -> bool:
+    return UIA.phrase_tab(hwnd=win) if UIA is not None else ensure_phrase_tab(win)
+
+def ui_set_text(win, text: str) -> bool:
+    return UIA.set_text(text, hwnd=win) if UIA is not None else set_phrase_text(win, text)
+
+def ui_play(win) -> bool:
+    return UIA.play(hwnd=win) if UIA is not None else click_play(win)
+
+def ui_save(win, path: str) -> bool:
+    return UIA.save(path, hwnd=win) if UIA is not None else click_save_and_type_path(win, path)
 
 # ==== OpenAI ====
 def choose_model() -> str:
@@ -207,22 +73,53 @@ def choose_model() -> str:
         return env
     return DEFAULT_MODELS[0]
 
+_client = None
+
+def openai_client():
+    """OpenAI クライアントは 1 つを使い回す（呼び出しごとに作ると接続プールごと作り直しになる）"""
+    global _client
+    if _client is None:
+        _client = limit_client(OpenAI(api_key=os.environ.get("OPENAI_API_KEY")))
+    return _client
+
 def chat_once(messages: List[Dict[str, str]]) -> str:
     """モデル自動フォールバック付きで 1 回会話。逐次表示も行う。"""
     models = [os.environ.get("OPENAI_MODEL", "").strip()] if os.environ.get("OPENAI_MODEL") else DEFAULT_MODELS[:]
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    client = openai_client()
+    # 読み上げ予算から max_tokens を決め、超えたら収まる最後の文末で打ち切る
+    limit = BUDGET.max_tokens("text", GUI_SPEED)
+
+    # KIRITAN_HEDGE が有効なら、1 本目が詰まったときに次のモデルへも投げて速い方を採用
+    policy = get_policy()
+    if policy is not None:
+        print(f"[model] {models[0]} (hedge {policy.deadline():.2f}s)")
+        cutter = BUDGET.cutter("text", GUI_SPEED)
+        buf = []
+        print("assistant >", end="", flush=True)
+        deltas = hedged_stream(client, models, messages, policy,
+                               model_kwargs=lambda m: token_kwargs(m, limit), temperature=0.7)
+        for delta in deltas:
+            buf.append(delta)
+            print(delta, end="", flush=True)
+            if cutter and cutter.feed(delta):
+                deltas.close()
+                break
+        print()
+        return cutter.text() if cutter else "".join(buf).strip()
 
     last_err = None
     for m in models:
         if not m: 
             continue
         print(f"[model] {m}")
+        cutter = BUDGET.cutter("text", GUI_SPEED)
         try:
             # 逐次表示: Chat Completions で chunk を受けつつ標準出力へ
             # （SDK によってストリーミング実装が変わるため、失敗したら通常モード）
             try:
                 stream = client.chat.completions.create(
-                    model=m, messages=messages, stream=True, temperature=0.7
+                    model=m, messages=messages, stream=True, temperature=0.7,
+                    **token_kwargs(m, limit)
                 )
                 buf = []
                 print("assistant >", end="", flush=True)
@@ -231,14 +128,22 @@ def chat_once(messages: List[Dict[str, str]]) -> str:
                     if delta:
                         buf.append(delta)
                         print(delta, end="", flush=True)
+                        if cutter and cutter.feed(delta):
+                            stream.close()
+                            break
                 print()
-                return "".join(buf).strip()
+                return cutter.text() if cutter else "".join(buf).strip()
             except Exception:
                 # 非ストリーミング
+                cutter = BUDGET.cutter("text", GUI_SPEED)
                 resp = client.chat.completions.create(
-                    model=m, messages=messages, temperature=0.7
+                    model=m, messages=messages, temperature=0.7,
+                    **token_kwargs(m, limit)
                 )
                 text = (resp.choices[0].message.content or "").strip()
+                if cutter:
+                    cutter.feed(text)
+                    text = cutter.text()
                 print("assistant >", text)
                 return text
         except Exception as e:
@@ -252,27 +157,65 @@ def main():
     print("[ GUI発展版 ] VOICEROID を直接操作して読み上げ（AssistantSeika 非依存）")
     print("使い方: VOICEROID＋ 東北きりたん EX を起動してから、このスクリプトを実行。")
     print("コマンド: exit / quit（それ以外は会話）")
-    print("補助コマンド: /reset /reload /retry /paste /clear /save <path> /sys <prompt>")
+    print("補助コマンド: /reset /reload /retry /paste /clear /save <path> /sys <prompt> /session list|resume|fork")
     print()
+    global UIA, TABS
+    UIA = open_worker(TITLE_RE)
+    TABS = open_tabwatch(UIA)
 
     # system プロンプト & 履歴
     system_prompt = os.environ.get("SYSTEM_PROMPT", SYSTEM_PROMPT_DEFAULT)
     history: List[Dict[str, str]] = [{"role": "system", "content": system_prompt}]
     last_reply: Optional[str] = None
 
+    # セッション（最初のターンを記録するときに作成）
+    store = SessionStore()
+    session_id: Optional[int] = None
+    # 長期記憶（numpy があれば有効）。直近の窓に入っているターンは検索結果から除く
+    memory = open_memory(store)
+    recent_ids: deque = deque(maxlen=12)
+
+    def record(role: str, content: str):
+        nonlocal session_id
+        try:
+            if session_id is None:
+                session_id = store.create(system_prompt=system_prompt)
+            tid = store.append(session_id, role, content)
+            recent_ids.append(tid)
+            if memory is not None:
+                memory.add(tid, session_id, content)
+        except Exception as e:
+            print(f"[session] 記録に失敗: {e}", file=sys.stderr)
+
     # 1回取得に失敗しても、毎ループで再取得する
     while True:
-        win = find_voiceroid_window(timeout=3.0)
+        win = ui_window(3.0)
         if not win:
             print("VOICEROID＋ 東北きりたん EX のウィンドウが見つかりません。起動してから再実行してください。")
             return
 
-        ensure_phrase_tab(win)
+        # 見張りがあれば確認を頼むだけ（入力待ちの間に裏で戻る）
+        if TABS is not None:
+            TABS.poke()
+        else:
+            ui_phrase_tab(win)
 
         user = input("あなた > ").strip()
         if not user:
             continue
         if user.lower() in ("exit", "quit"):
+            if get_policy() is not None:
+                print(f"[hedge] {get_policy().stats.summary()}")
+            if BUDGET_STATS.replies:
+                print(f"[budget] {BUDGET_STATS.summary()}")
+            if get_limiter() is not None and get_limiter().stats.requests:
+                print(f"[ratelimit] {get_limiter().stats.summary()}")
+            if TABS is not None:
+                print(f"[tab] {TABS.stats.summary()}")
+                TABS.close()
+            if UIA is not None:
+                print(f"[uia] {UIA.stats.summary()}")
+                UIA.close()
             print("終了します。")
             return
 
@@ -283,13 +226,16 @@ def main():
 
             if cmd == "reset":
                 history = [{"role": "system", "content": system_prompt}]
+                session_id = None
                 print("[reset] 履歴を消去しました。"); continue
             if cmd == "reload":
                 print("[reload] ウィンドウを再取得…")
+                WINDOWS.invalidate()
+                if UIA is not None: UIA.restart("/reload")
                 continue  # 次ループで再取得
             if cmd == "retry":
                 if last_reply:
-                    if set_phrase_text(win, last_reply) and click_play(win):
+                    if ui_set_text(win, last_reply) and ui_play(win):
                         print("[retry] 貼り付け→再生 OK")
                     else:
                         print("[retry] 実行に失敗。画面レイアウトを確認してください。", file=sys.stderr)
@@ -297,13 +243,13 @@ def main():
                     print("[retry] 直前の返答がありません。")
                 continue
             if cmd == "paste":
-                if last_reply and set_phrase_text(win, last_reply):
+                if last_reply and ui_set_text(win, last_reply):
                     print("[paste] 貼り付けました。")
                 else:
                     print("[paste] 失敗。")
                 continue
             if cmd == "clear":
-                if set_phrase_text(win, ""):
+                if ui_set_text(win, ""):
                     print("[clear] 入力欄をクリアしました。")
                 else:
                     print("[clear] 失敗。")
@@ -311,7 +257,7 @@ def main():
             if cmd == "save":
                 if not arg:
                     print("使い方: /save C:\\path\\to\\voice.wav"); continue
-                if click_save_and_type_path(win, arg):
+                if ui_save(win, arg):
                     print(f"[save] {arg} に保存を試みました。")
                 else:
                     print("[save] 失敗。音声保存ボタン/保存ダイアログが見つかりませんでした。", file=sys.stderr)
@@ -320,30 +266,49 @@ def main():
                 if arg:
                     system_prompt = arg
                     history = [{"role": "system", "content": system_prompt}]
+                    session_id = None
                     print("[sys] system プロンプトを更新し、履歴を初期化しました。")
                 else:
                     print("[sys] 使い方: /sys <新しいプロンプト>")
                 continue
 
+            if cmd == "session":
+                try:
+                    session_id, resumed = session_command(store, arg, session_id, system_prompt)
+                except Exception as e:
+                    print(f"[session] 失敗: {e}", file=sys.stderr); continue
+                if resumed:
+                    history = resumed
+                    system_prompt = resumed[0]["content"]
+                continue
+
             print(f"[info] 未知のコマンドです: /{cmd}")
             continue
 
         # ---- 通常会話 ----
         history.append({"role": "user", "content": user})
+        record("user", user)
 
         try:
-            reply = chat_once(history[-12:])  # 直近だけ送ってトークン節約
+            window = history[-12:]  # 直近だけ送ってトークン節約
+            if memory is not None:
+                window = memory.inject(window, user, exclude=set(recent_ids))
+            reply = chat_once(window)
         except Exception as e:
             print(f"[error] 生成に失敗: {e}", file=sys.stderr)
             continue
 
         last_reply = reply
         history.append({"role": "assistant", "content": reply})
+        trim_history(history)     # 全件は SQLite にある
+        record("assistant", reply)
 
-        if not set_phrase_text(win, reply):
+        if TABS is not None:
+            TABS.ensure()     # 直近に確認済みなら何もしない
+        if not ui_set_text(win, reply):
             print("本文エリアの検出/入力に失敗。VOICEROIDの画面レイアウトを確認してください。", file=sys.stderr)
             continue
-        if not click_play(win):
+        if not ui_play(win):
             print("[ 再生 ] の実行に失敗（Space/F5 も不発）。", file=sys.stderr)
             continue
 
@@ -25,11 +25,17 @@ GUI発展版-音声（Voice）
 - VOICEROID＋ 東北きりたん EX を UIA で制御（AssistantSeika 不要）
 - text/mic/loop の会話モードを /mode で切替
 - 録音は sounddevice、文字起こしは OpenAI Whisper API
+- 長い発話は話しながら区切って並行に文字起こし（/asr stream|batch、KIRITAN_ASR_STREAM=0 で従来どおり）
+- 途中の文字起こしで返答の生成を先に始める投機実行（/spec on|off、KIRITAN_SPECULATE=1）
+- 無音・雑音から出た文字起こし（定番句・繰り返し）は LLM に回さず捨てる（KIRITAN_ASR_FILTER=0 で無効）
+- KIRITAN_TIMELINE=1 / --profile N で各段階の区間を Chrome のトレース形式に書き出す（kiritan_timeline）
 - 相槌モード（/aizuchi on）で短め＆相槌多めの返答スタイルに切替
+- 会話履歴は SQLite（logs/sessions.db）に保存し、/session resume で再開できる
 """
 
-import os, sys, re, time, tempfile
+import os, sys, re, time, tempfile, threading
 from typing import Optional, List, Dict
+from collections import deque
 from datetime import datetime
 # --- console unicode safety (never crash on JP text) ---
 try:
@@ -74,12 +80,47 @@ except Exception as e:
     print("openai パッケージがありません。`pip install openai` を実行してください。", file=sys.stderr)
     raise
 
+from kiritan_hedge import get_policy, hedged_stream
+from kiritan_session import SessionStore, handle_command as session_command, trim_history
+from kiritan_memory import open_memory
+from kiritan_winreg import WindowRegistry
+from kiritan_budget import SpeechBudget, GUI_SPEED, token_kwargs, estimate_seconds, STATS as BUDGET_STATS
+from kiritan_echo import open_echo, reference_mode
+from kiritan_speech import wait_file
+from kiritan_trace import open_trace
+from kiritan_uia_worker import open_worker
+from kiritan_tabwatch import open_tabwatch
+from kiritan_asr_stream import StreamingTranscriber, listen_streaming, enabled as asr_stream_enabled, STATS as ASR_STATS
+from kiritan_speculate import Speculator, Cancelled as SpecCancelled, enabled as spec_enabled
+from kiritan_asr_filter import open_filter
+from kiritan_timeline import open_timeline, span, stream_span, bind
+from kiritan_ratelimit import limit_client, get_limiter
+
 # ====== 設定 ======
 TITLE_RE = r"VOICEROID[＋+]\s*.*東北きりたん\s*EX(?:[^\S\r\n]*[\+\*/☆])?$"
 PLAY_LABEL_RE = r"再生"
 SAVE_LABEL_RE = r"音声保存"
 PHRASE_TAB_LABEL = "フレーズ編集"
 
+# VOICEROID のハンドルは 1 回だけ解決して使い回す
+WINDOWS = WindowRegistry(TITLE_RE)
+# 返答の長さはモード別の読み上げ秒数で縛る（KIRITAN_SPEECH_BUDGET）
+BUDGET = SpeechBudget.from_env()
+# 録音に回り込んだ自分の再生音を除去（KIRITAN_ECHO=save で VOICEROID から参照音声も書き出す）
+ECHO = open_echo()
+ECHO_DIR = os.path.join("cache", "echo")
+# 会話トレース（KIRITAN_TRACE、kiritan_replay.py で再生）
+TRACE = open_trace()
+# 区間のタイムライン（KIRITAN_TIMELINE / --profile N、chrome://tracing で開く）
+TIMELINE = open_timeline()
+# UI 操作は別プロセスのワーカーで（COM のハングを期限で打ち切る。KIRITAN_UIA_WORKER=0 で無効）
+# タブが「フレーズ編集」から外れたときだけ裏で戻す（KIRITAN_TABWATCH=0 で無効）
+# どちらも子プロセス / スレッドを起こすので、import では作らず main() で作る
+UIA = None
+TABS = None
+# Whisper の幻聴（無音から出た定番句・繰り返し）を LLM の手前で捨てる（KIRITAN_ASR_FILTER=0 で無効）
+ASR_FILTER = open_filter()
+
 DEFAULT_MODELS = ["gpt-4o-mini", "o4-mini-high", "o3-mini", "gpt-4o"]
 SYSTEM_PROMPT_BASE = "あなたは気さくで優しく、短めに素早く返答するアシスタントです。"
 SYSTEM_PROMPT_AIZUCHI = (
@@ -88,6 +129,7 @@ SYSTEM_PROMPT_AIZUCHI = (
 )
 LOG_DIR = "logs"
 os.makedirs(LOG_DIR, exist_ok=True)
+ASR_STREAM_MAX = 30.0   # ストリーミング時の録音上限（話し終われば VAD でその場で止まる）
 
 # ====== 小物 ======
 def _wrap(ctrl) -> BaseWrapper:
@@ -96,12 +138,8 @@ def _wrap(ctrl) -> BaseWrapper:
     return ctrl
 
 def find_voiceroid_window(timeout: float = 3.0) -> Optional[BaseWrapper]:
-    end = time.time() + timeout
-    while time.time() < end:
-        wins = Desktop(backend="uia").windows(title_re=TITLE_RE, control_type="Window")
-        if wins: return _wrap(wins[0])
-        time.sleep(0.2)
-    return None
+    # ハンドルはキャッシュし、死んだ / タイトルが変わったときだけ再探索
+    return WINDOWS.voiceroid_window(timeout)
 
 def ensure_phrase_tab(win: BaseWrapper, timeout: float = 3.0) -> bool:
     end = time.time() + timeout
@@ -196,8 +234,9 @@ def click_save_and_type_path(win: BaseWrapper, path: str, timeout: float = 4.0)
     end = time.time() + timeout
     dlg = None
     title_re = r"(名前を付けて保存|保存|Save As)"
+    desktop = Desktop(backend="uia")
     while time.time() < end:
-        ds = Desktop(backend="uia").windows(title_re=title_re, control_type="Window")
+        ds = desktop.windows(title_re=title_re, control_type="Window")
         if ds: dlg = _wrap(ds[0]); break
         time.sleep(0.2)
     if not dlg: return False
@@ -212,44 +251,122 @@ def click_save_and_type_path(win: BaseWrapper, path: str, timeout: float = 4.0)
     except Exception:
         return False
 
+# ====== UI 操作の入口（UIA ワーカーがあれば別プロセスで、期限付き） ======
+# ワーカー使用時の win は HWND（int）。無効時は従来どおり UIA ラッパを直接操作する
+def ui_window(timeout: float = 3.0):
+    if UIA is not None:
+        return UIA.attach()
+    return find_voiceroid_window(timeout)
+
+def ui_phrase_tab(win) -> bool:
+    return UIA.phrase_tab(hwnd=win) if UIA is not None else ensure_phrase_tab(win)
+
+def ui_set_text(win, text: str) -> bool:
+    return UIA.set_text(text, hwnd=win) if UIA is not None else set_phrase_text(win, text)
+
+def ui_play(win) -> bool:
+    return UIA.play(hwnd=win) if UIA is not None else click_play(win)
+
+def ui_save(win, path: str) -> bool:
+    return UIA.save(path, hwnd=win) if UIA is not None else click_save_and_type_path(win, path)
+
 # ====== OpenAI ======
+_client = None
+_client_lock = threading.Lock()
+
+def openai_client():
+    # 呼び出しごとに作ると接続プールごと作り直しになり、長時間の運転でメモリも増えるので使い回す
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = limit_client(OpenAI(api_key=os.environ.get("OPENAI_API_KEY")))
+        return _client
+
 def _choose_models() -> List[str]:
     env = (os.environ.get("OPENAI_MODEL") or "").strip()
     if env: return [env]
     return DEFAULT_MODELS[:]
 
-def chat_once(messages: List[Dict[str, str]]) -> str:
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+def chat_once(messages: List[Dict[str, str]], mode: str = "text",
+              cancel: Optional[threading.Event] = None, quiet: bool = False) -> str:
+    # cancel / quiet は投機実行用（途中で取り消せる・画面に出さない）
+    out = (lambda *a, **k: None) if quiet else print
+    def cancelled() -> bool:
+        return cancel is not None and cancel.is_set()
+    client = openai_client()
+    # 投機実行の呼び出しはまだターンが始まっていないのでトレースしない
+    if TRACE is not None and cancel is None: client = TRACE.wrap(client)
+    # 読み上げ予算（モード別の秒数）から max_tokens を決め、超えたら文末で打ち切る
+    limit = BUDGET.max_tokens(mode, GUI_SPEED)
+    # KIRITAN_HEDGE が有効なら、1 本目が詰まったときに次のモデルへも投げて速い方を採用
+    policy = get_policy()
+    if policy is not None:
+        models = _choose_models()
+        out(f"[model] {models[0]} (hedge {policy.deadline():.2f}s)")
+        cutter = BUDGET.cutter(mode, GUI_SPEED)
+        buf = []
+        out("assistant >", end="", flush=True)
+        deltas = hedged_stream(client, models, messages, policy,
+                               model_kwargs=lambda m: token_kwargs(m, limit), temperature=0.7)
+        with stream_span("llm", model=models[0], hedge=True, spec=cancel is not None) as sp:
+            for delta in deltas:
+                if cancelled():
+                    deltas.close(); raise SpecCancelled()
+                sp.delta()
+                buf.append(delta); out(delta, end="", flush=True)
+                if cutter and cutter.feed(delta):
+                    deltas.close(); break
+        out()
+        return cutter.text() if cutter else "".join(buf).strip()
     last_err = None
     for m in _choose_models():
         if not m: continue
-        print(f"[model] {m}")
+        if cancelled(): raise SpecCancelled()
+        out(f"[model] {m}")
+        cutter = BUDGET.cutter(mode, GUI_SPEED)
         try:
             # streaming が失敗したら non-stream へフォールバック
             try:
-                stream = client.chat.completions.create(model=m, messages=messages, stream=True, temperature=0.7)
-                buf = []
-                print("assistant >", end="", flush=True)
-                for chunk in stream:
-                    delta = chunk.choices[0].delta.content or ""
-                    if delta:
-                        buf.append(delta); print(delta, end="", flush=True)
-                print()
-                return "".join(buf).strip()
+                with stream_span("llm", model=m, spec=cancel is not None) as sp:
+                    stream = client.chat.completions.create(model=m, messages=messages, stream=True,
+                                                            temperature=0.7, **token_kwargs(m, limit))
+                    buf = []
+                    out("assistant >", end="", flush=True)
+                    for chunk in stream:
+                        if cancelled():
+                            stream.close(); raise SpecCancelled()
+                        delta = chunk.choices[0].delta.content or ""
+                        if delta:
+                            sp.delta()
+                            buf.append(delta); out(delta, end="", flush=True)
+                            if cutter and cutter.feed(delta):
+                                stream.close(); break
+                out()
+                return cutter.text() if cutter else "".join(buf).strip()
+            except SpecCancelled:
+                raise
             except Exception:
-                resp = client.chat.completions.create(model=m, messages=messages, temperature=0.7)
+                cutter = BUDGET.cutter(mode, GUI_SPEED)
+                with span("llm", model=m, stream=False):
+                    resp = client.chat.completions.create(model=m, messages=messages, temperature=0.7,
+                                                          **token_kwargs(m, limit))
                 text = (resp.choices[0].message.content or "").strip()
-                print("assistant >", text)
+                if cutter:
+                    cutter.feed(text); text = cutter.text()
+                out("assistant >", text)
                 return text
+        except SpecCancelled:
+            raise
         except Exception as e:
             last_err = e
-            print(f"[warn] {m} 失敗: {e}", file=sys.stderr)
+            out(f"[warn] {m} 失敗: {e}", file=sys.stderr)
     raise RuntimeError(f"全モデル失敗: {last_err}")
 
 def transcribe_wav(path: str) -> str:
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    client = openai_client()
+    if TRACE is not None: client = TRACE.wrap(client)
     # Whisper API（whisper-1）
-    with open(path, "rb") as f:
+    with open(path, "rb") as f, span("asr", model="whisper-1"):
         try:
             r = client.audio.transcriptions.create(model="whisper-1", file=f, response_format="text")
             # 新SDKは text 文字列を返すこともあるので両対応
@@ -257,12 +374,43 @@ def transcribe_wav(path: str) -> str:
         except Exception as e:
             raise RuntimeError(f"transcribe 失敗: {e}")
 
+def transcribe_pcm(client, pcm, fs: int) -> str:
+    # チャンク 1 本分（float32 mono）をメモリ上の WAV にして Whisper へ
+    buf = io.BytesIO()
+    sf.write(buf, pcm, fs, format="WAV", subtype="PCM_16")
+    with span("asr", model="whisper-1", sec=round(len(pcm) / fs, 2)):
+        r = client.audio.transcriptions.create(model="whisper-1", file=("chunk.wav", buf.getvalue()),
+                                               response_format="text")
+    return (getattr(r, "text", None) or r or "").strip()
+
+def listen_stream(seconds: float, fs: int = 16000, on_partial=None):
+    # 文字起こしと、判定用の発話区間の音声を返す
+    print(f"[rec] 録音中 ...（話しかけてください。話し終わると止まります / 最大 {seconds:.0f}s）")
+    client = openai_client()
+    def prefilter(pcm, t0):
+        # 再生音の回り込みはチャンクごとに除去（ほぼ自分の声だけのチャンクは送らない）
+        if ECHO is None: return pcm
+        cleaned, ratio = ECHO.process(pcm, fs, t0)
+        return None if ECHO.should_skip(cleaned, ratio) else cleaned
+    # チャンクの文字起こしは別スレッドで並行に走るので、ターン ID を持たせて渡す
+    st = StreamingTranscriber(bind(lambda pcm, rate: transcribe_pcm(client, pcm, rate)), fs, seconds + 1.0,
+                              prefilter, on_partial=on_partial)
+    with span("capture", source="stream"):
+        text = listen_streaming(st, seconds)
+    print(f"[rec] 完了（チャンク {len(st.chunks)}、話し終わり→文字起こし {time.time() - (st.ended_at or time.time()):.2f}s）")
+    if TRACE is not None and st.chunks:
+        TRACE.note_input(audio={"sec": round(len(st.speech()) / fs, 3), "fs": fs},
+                         asr={"model": "whisper-1", "text": text, "chunks": len(st.chunks),
+                              "sec": round(time.time() - st.ended_at, 3)})
+    return text, st.speech()
+
 def record_to_wav(seconds: float = 6.0, fs: int = 16000) -> str:
     print(f"[rec] 録音 {seconds:.1f}s ...（話しかけてください）")
     sd.default.samplerate = fs
     sd.default.channels = 1
-    data = sd.rec(int(seconds * fs), dtype="float32")
-    sd.wait()
+    with span("capture", source="mic"):
+        data = sd.rec(int(seconds * fs), dtype="float32")
+        sd.wait()
     tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
     sf.write(tmp.name, data, fs)
     print("[rec] 完了")
@@ -270,40 +418,110 @@ def record_to_wav(seconds: float = 6.0, fs: int = 16000) -> str:
 
 # ====== MAIN ======
 def main():
+    global UIA, TABS
+    UIA = open_worker(TITLE_RE)
+    TABS = open_tabwatch(UIA)
     print("[ GUI発展版-音声 ] VOICEROID を直接操作して音声会話（AssistantSeika 不要）")
     print("先に VOICEROID＋ 東北きりたん EX を起動してください。")
     print("コマンド: exit / quit")
-    print("補助: /mode text|mic|loop, /time N, /aizuchi on|off, /reset /reload /retry /paste /clear /save <path> /sys <txt>")
+    print("補助: /mode text|mic|loop, /time N, /aizuchi on|off, /asr stream|batch, /spec on|off, /reset /reload /retry /paste /clear /save <path> /sys <txt> /session list|resume|fork")
     print()
 
     mode = "text"       # text / mic / loop
     rec_seconds = 6.0
     aizuchi = False
+    asr_stream = asr_stream_enabled()
+    speculate = spec_enabled()
 
     system_prompt = SYSTEM_PROMPT_BASE
     history: List[Dict[str, str]] = [{"role": "system", "content": system_prompt}]
     last_reply: Optional[str] = None
 
+    # セッション（最初のターンを記録するときに作成）
+    store = SessionStore()
+    session_id: Optional[int] = None
+    # 長期記憶（numpy があれば有効）。直近の窓に入っているターンは検索結果から除く
+    memory = open_memory(store)
+    recent_ids: deque = deque(maxlen=12)
+
+    def record(role: str, content: str):
+        nonlocal session_id
+        try:
+            if session_id is None:
+                session_id = store.create(system_prompt=system_prompt)
+            tid = store.append(session_id, role, content)
+            recent_ids.append(tid)
+            if memory is not None:
+                memory.add(tid, session_id, content)
+        except Exception as e:
+            print(f"[session] 記録失敗: {e}", file=sys.stderr)
+
+    def window_for(text: str) -> List[Dict[str, str]]:
+        # 今の履歴 + この発話の窓（通常の生成と投機実行で同じものを作る）
+        window = (history + [{"role": "user", "content": text}])[-12:]
+        if memory is not None:
+            window = memory.inject(window, text, exclude=set(recent_ids))
+        return window
+
+    # 途中の文字起こしで先に生成しておく（ストリーミング ASR のときだけ）
+    spec = Speculator(lambda text, cancel: chat_once(window_for(text), mode, cancel=cancel, quiet=True))
+
     while True:
+        # 前のターンで使わなかった先行分（コマンドだった等）は取り消す
+        spec.discard()
         # 毎ループでウィンドウを再取得して安定化
-        win = find_voiceroid_window(timeout=3.0)
+        win = ui_window(3.0)
         if not win:
             print("VOICEROID が見つかりません。起動してから実行してください。")
             return
-        ensure_phrase_tab(win)
+        # 見張りがあれば確認を頼むだけ（入力待ちの間に裏で戻る）
+        if TABS is not None:
+            TABS.poke()
+        else:
+            with span("tab"):
+                ui_phrase_tab(win)
+        # mic / loop は録音からを 1 ターンの区間にする（コマンド・スキップで終わったターンは次の開始で閉じる）
+        if TIMELINE is not None and mode != "text":
+            TIMELINE.begin(mode)
 
         if mode == "text":
             user = input("あなた > ").strip()
             if not user: continue
         else:
-            # mic / loop は録音→transcribe
-            wav = record_to_wav(rec_seconds)
-            try:
-                user = transcribe_wav(wav)
-            finally:
-                try: os.remove(wav)
-                except Exception: pass
+            # mic / loop は録音→（再生音を除去）→transcribe
+            audio, audio_fs = None, 16000
+            if asr_stream:
+                try:
+                    user, audio = listen_stream(max(rec_seconds, ASR_STREAM_MAX),
+                                         on_partial=spec.offer if speculate else None)
+                except Exception as e:
+                    print(f"[asr] 失敗: {e}", file=sys.stderr)
+                    continue
+            else:
+                t_rec = time.time()
+                wav = record_to_wav(rec_seconds)
+                try:
+                    with span("filter", kind="echo"):
+                        echo_only = ECHO is not None and not ECHO.filter_wav(wav, t_rec)
+                    if echo_only:
+                        print("[echo] 録音のほとんどが自分の再生音なのでスキップ")
+                        continue
+                    user = transcribe_wav(wav)
+                    if user and ASR_FILTER is not None:
+                        audio, audio_fs = sf.read(wav, dtype="float32")
+                finally:
+                    try: os.remove(wav)
+                    except Exception: pass
             print(f"you (ASR)> {user}")
+            if user and ECHO is not None and ECHO.is_echo_text(user):
+                print("[echo] 自分の発話の聞き取りなのでスキップ")
+                continue
+            if user and ASR_FILTER is not None:
+                with span("filter", kind="asr"):
+                    why = ASR_FILTER.check(user, audio, audio_fs)
+                if why:
+                    print(f"[asr] 誤認識とみなしてスキップ（{why}）")
+                    continue
             if not user:
                 if mode == "mic":
                     continue
@@ -312,6 +530,28 @@ def main():
                     continue
 
         if user.lower() in ("exit", "quit"):
+            if get_policy() is not None:
+                print(f"[hedge] {get_policy().stats.summary()}")
+            if BUDGET_STATS.replies:
+                print(f"[budget] {BUDGET_STATS.summary()}")
+            if ECHO is not None and ECHO.stats.checked:
+                print(f"[echo] {ECHO.stats.summary()}")
+            if ASR_STATS.utterances:
+                print(f"[asr] {ASR_STATS.summary()}")
+            if spec.stats.turns:
+                print(f"[spec] {spec.stats.summary()}")
+            if ASR_FILTER is not None and ASR_FILTER.stats.checked:
+                print(f"[asr-filter] {ASR_FILTER.stats.summary()}")
+            if get_limiter() is not None and get_limiter().stats.requests:
+                print(f"[ratelimit] {get_limiter().stats.summary()}")
+            if TABS is not None:
+                print(f"[tab] {TABS.stats.summary()}")
+                TABS.close()
+            if UIA is not None:
+                print(f"[uia] {UIA.stats.summary()}")
+                UIA.close()
+            if TIMELINE is not None:
+                TIMELINE.close()
             print("終了します。"); return
 
         # ====== 補助コマンド ======
@@ -332,32 +572,47 @@ def main():
                 except Exception:
                     print("使い方: /time 6  （秒を指定）")
                 continue
+            if cmd == "asr":
+                if arg in ("stream", "batch"):
+                    asr_stream = arg == "stream" and asr_stream_enabled()
+                    print(f"[asr] => {'stream' if asr_stream else 'batch'}")
+                else:
+                    print("使い方: /asr stream|batch  （stream = 話しながら区切って文字起こし）")
+                continue
+            if cmd == "spec":
+                speculate = arg.lower() in ("on", "true", "1")
+                print(f"[spec] {'ON' if speculate else 'OFF'}（途中の文字起こしで先に生成。/asr stream のときだけ）")
+                continue
             if cmd == "aizuchi":
                 on = arg.lower() in ("on","true","1")
                 aizuchi = on
                 system_prompt = SYSTEM_PROMPT_AIZUCHI if aizuchi else SYSTEM_PROMPT_BASE
                 history = [{"role":"system","content":system_prompt}]
+                session_id = None
                 print(f"[aizuchi] {'ON' if aizuchi else 'OFF'}（返答スタイル変更）")
                 continue
             if cmd == "reset":
                 history = [{"role":"system","content":system_prompt}]
+                session_id = None
                 print("[reset] 履歴クリア"); continue
             if cmd == "reload":
+                WINDOWS.invalidate()
+                if UIA is not None: UIA.restart("/reload")
                 print("[reload] 次ループでウィンドウ再取得"); continue
             if cmd == "retry":
-                if last_reply and set_phrase_text(win, last_reply) and click_play(win):
+                if last_reply and ui_set_text(win, last_reply) and ui_play(win):
                     print("[retry] 貼り付け→再生 OK")
                 else:
                     print("[retry] 失敗")
                 continue
             if cmd == "paste":
-                if last_reply and set_phrase_text(win, last_reply):
+                if last_reply and ui_set_text(win, last_reply):
                     print("[paste] OK")
                 else:
                     print("[paste] 失敗")
                 continue
             if cmd == "clear":
-                if set_phrase_text(win, ""):
+                if ui_set_text(win, ""):
                     print("[clear] OK")
                 else:
                     print("[clear] 失敗")
@@ -365,7 +620,7 @@ def main():
             if cmd == "save":
                 if not arg:
                     print("使い方: /save C:\\path\\to\\voice.wav"); continue
-                if click_save_and_type_path(win, arg):
+                if ui_save(win, arg):
                     print(f"[save] {arg} に保存実行")
                 else:
                     print("[save] 失敗（ボタン/ダイアログ未検出）")
@@ -374,32 +629,100 @@ def main():
                 if arg:
                     system_prompt = arg
                     history = [{"role":"system","content":system_prompt}]
+                    session_id = None
                     print("[sys] 更新 & 履歴初期化")
                 else:
                     print("使い方: /sys <新しいプロンプト>")
                 continue
 
+            if cmd == "session":
+                try:
+                    session_id, resumed = session_command(store, arg, session_id, system_prompt)
+                except Exception as e:
+                    print(f"[session] 失敗: {e}", file=sys.stderr); continue
+                if resumed:
+                    history = resumed
+                    system_prompt = resumed[0]["content"]
+                continue
+
             print(f"[info] 未知のコマンド: /{cmd}")
             continue
 
         # ====== 通常会話 ======
+        if TIMELINE is not None:
+            if mode == "text":
+                TIMELINE.begin(mode)
+            TIMELINE.label(user)
+        window = window_for(user)
         history.append({"role":"user","content":user})
+        record("user", user)
+        turn = TRACE.begin(mode, user, speed=GUI_SPEED) if TRACE is not None else None
         try:
-            reply = chat_once(history[-12:])
+            if mode != "text" and asr_stream and speculate:
+                # 先行した生成が同じ文ならそれを使い、違えば取り消してここで生成
+                reply = spec.resolve(user, lambda: chat_once(window, mode))
+                if spec.last.get("spec") == "hit":
+                    print("assistant >", reply)
+                    print(f"[spec] 先行した返答を使用（{spec.last['saved']:.2f}s 短縮）")
+                elif spec.last.get("spec") == "miss":
+                    print("[spec] 途中の文字起こしと違ったので生成し直し")
+            else:
+                reply = chat_once(window, mode)
         except Exception as e:
             print(f"[error] 生成失敗: {e}", file=sys.stderr)
+            if turn is not None: TRACE.end(turn, error=str(e))
             if mode == "loop": continue
             else:            continue
 
         last_reply = reply
         history.append({"role":"assistant","content":reply})
-
-        if not set_phrase_text(win, reply):
+        trim_history(history)     # 全件は SQLite にある
+        record("assistant", reply)
+
+        t_paste = time.time()
+        if TABS is not None:
+            with span("tab"):
+                TABS.ensure()     # 直近に確認済みなら何もしない
+        with span("paste", chars=len(reply)):
+            pasted = ui_set_text(win, reply)
+        if not pasted:
             print("[paste] 入力欄に貼り付け失敗。", file=sys.stderr)
+            if turn is not None: TRACE.end(turn, reply, error="paste failed")
             if mode == "loop": continue
             else:            continue
-        if not click_play(win):
+        # 参照音声: 録音するモードのときだけ、再生前に「音声保存」で書き出しておく
+        ref = None
+        if ECHO is not None and mode != "text" and reference_mode() == "save":
+            os.makedirs(ECHO_DIR, exist_ok=True)
+            ref = os.path.abspath(os.path.join(ECHO_DIR, f"{time.time():.0f}.wav"))
+            with span("render", kind="echo-ref"):
+                if not (ui_save(win, ref) and wait_file(ref, 15.0)):
+                    ref = None
+        # 再生ボタンを押すまで（音声は VOICEROID 側で非同期に鳴る）
+        with span("play"):
+            played = ui_play(win)
+        if not played:
             print("[play] 失敗（Space/F5 も不発）", file=sys.stderr)
+        if played and turn is not None:
+            # 再生は VOICEROID 側で非同期なので、終了は話速からの見積もり（貼り付け〜再生開始を合成時間として残す）
+            t_play = time.time()
+            TRACE.speech(reply, t_play, t_play + estimate_seconds(reply, GUI_SPEED),
+                         queued=t_paste, speed=GUI_SPEED, estimated=True)
+        if played and ECHO is not None:
+            try:
+                if ref:
+                    ECHO.add_wav(ref, time.time(), reply)
+                else:
+                    ECHO.note_text(reply)
+            except Exception as e:
+                print(f"[echo] 参照音声の登録失敗: {e}", file=sys.stderr)
+        if ref:
+            try: os.remove(ref)
+            except Exception: pass
+        if turn is not None:
+            TRACE.end(turn, reply)
+        if TIMELINE is not None:
+            TIMELINE.end()
 
         # ログ
         try:
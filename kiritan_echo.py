@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+自分の声（再生音）の回り込み対策（mic / loop 録音用）
+- 直近に再生した音声（再生エンジンの PCM / 書き出した WAV）を時刻付きで覚えておく
+- 録音区間と重なる再生音を FFT 相互相関で位置合わせし、ブロックごとのゲインを最小二乗で推定して差し引く
+- 差し引いた残りがほぼ無音（= ほぼ自分の声だけ）の区間は ASR に回さずスキップ
+- すり抜けて文字起こしされても、直前（話し終えて TEXT_RECENT 秒以内）にしゃべった文とほぼ同じなら
+  LLM には回さない。短い文字起こし（「はい」「そうですね」など）は照合しない
+- 無駄になった / 節約できた Whisper・LLM 呼び出しを 1 時間あたりで集計
+
+有効/無効（環境変数）:
+  KIRITAN_ECHO=0      … 無効
+  KIRITAN_ECHO=save   … GUI 音声版で、再生前に VOICEROID の「音声保存」で参照音声を書き出す（1 回分の合成が増える）
+  未設定 / 1          … 再生エンジンの PCM がある経路（CLI の KIRITAN_PLAYBACK=engine 等）と文字照合だけ
+"""
+
+import os
+import re
+import time
+import threading
+import unicodedata
+from collections import deque
+from typing import Optional, Tuple, Set
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+from kiritan_playback import decode_wav, resample
+from kiritan_budget import estimate_seconds
+
+FS = 16000                    # 内部処理のサンプルレート
+KEEP_SECONDS = 90.0           # 参照音声を覚えておく時間
+SEARCH_SECONDS = 1.0          # 想定位置から前後に探す遅延の幅（出力/入力デバイスの遅延ぶん）
+BLOCK_SECONDS = 0.25          # ゲイン推定 / ゲートのブロック長
+GATE_RATIO = 0.9              # ブロックのエネルギーの 9 割以上が再生音なら無音化
+SKIP_RATIO = 0.8              # 区間全体の 8 割以上が再生音ならスキップ
+SPEECH_RMS = 0.005            # 除去後の残りがこれ未満ならスキップ
+TEXT_CONTAIN = 0.7            # 文字起こしの 3-gram のうち、直前の発話に含まれる割合
+TEXT_MIN_GRAMS = 4            # これより短い文字起こし（正規化して 6 文字未満）は文字照合しない
+TEXT_RECENT = 10.0            # 話し終えてからこの秒数までの発話とだけ照合する
+
+
+def to_pcm16(x: "np.ndarray") -> bytes:
+    return (np.clip(x, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+def _norm_text(text: str) -> str:
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"[\s\W_]+", "", t)
+
+
+def _grams(t: str) -> Set[str]:
+    return {t[i:i + 3] for i in range(max(1, len(t) - 2))} if t else set()
+
+
+# ---------------- 統計 ----------------
+class EchoStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.checked = 0          # 調べた録音区間
+        self.skipped = 0          # ASR 前にスキップ（Whisper + LLM を節約）
+        self.cleaned = 0          # 再生音を差し引いて ASR に回した
+        self.slipped = 0          # 文字起こし後に自分の発話と判定（Whisper 1 回が無駄、LLM は節約）
+        self.proc_ms: deque = deque(maxlen=500)
+
+    def summary(self) -> str:
+        with self.lock:
+            hours = max(1e-6, (time.time() - self.started) / 3600.0)
+            saved = self.skipped * 2 + self.slipped
+            ms = sorted(self.proc_ms)
+            p50 = ms[len(ms) // 2] if ms else 0.0
+            return (f"録音 {self.checked} 区間: スキップ {self.skipped} / 除去して送信 {self.cleaned}"
+                    f" / すり抜け {self.slipped} | 無駄 Whisper {self.slipped / hours:.1f} 回/時"
+                    f" 節約 {saved / hours:.1f} 回/時 | 処理 p50 {p50:.1f}ms")
+
+
+# ---------------- 本体 ----------------
+class EchoCanceller:
+    def __init__(self, fs: int = FS, keep: float = KEEP_SECONDS, search: float = SEARCH_SECONDS):
+        self.fs = fs
+        self.keep = keep
+        self.search = search
+        self._refs: deque = deque()           # (開始時刻, mono float32 @ fs)
+        self._texts: deque = deque(maxlen=8)  # 直近の発話の (話し終わりの時刻, 3-gram)
+        self._lock = threading.Lock()
+        self.stats = EchoStats()
+
+    # ---- 参照の登録 ----
+    def add(self, pcm, fs: int, started_at: float, text: Optional[str] = None):
+        if pcm is None or not len(pcm):
+            return
+        x = np.asarray(pcm, dtype=np.float32)
+        if x.ndim > 1:
+            x = x.mean(axis=1)
+        if fs != self.fs:
+            x = resample(x, fs, self.fs)
+        with self._lock:
+            self._refs.append((started_at, x))
+            while self._refs and self._refs[0][0] + len(self._refs[0][1]) / self.fs < time.time() - self.keep:
+                self._refs.popleft()
+        if text:
+            self.note_text(text, started_at + len(x) / self.fs)
+
+    def add_wav(self, path: str, started_at: float, text: Optional[str] = None):
+        pcm, fs = decode_wav(path)
+        self.add(pcm, fs, started_at, text)
+
+    def attach(self, engine):
+        """PlaybackEngine の再生開始ごとに、その PCM を参照として登録する"""
+        def _on_start(seg):
+            if seg.pcm is not None:
+                self.add(seg.pcm, seg.fs, seg.started_at or time.time(), seg.text)
+            else:
+                self.note_text(seg.text)
+        engine.on_start.append(_on_start)
+
+    def note_text(self, text: str, ended_at: Optional[float] = None):
+        """発話の文字を覚える。ended_at（話し終わりの時刻）が無ければ今から話す長さの見積もりで"""
+        g = _grams(_norm_text(text))
+        if g:
+            if ended_at is None:
+                ended_at = time.time() + estimate_seconds(text)
+            with self._lock:
+                self._texts.append((ended_at, g))
+
+    # ---- 判定 ----
+    def _reference(self, t0: float, n: int) -> Optional["np.ndarray"]:
+        """[t0 - search, t0 + n/fs + search] の再生音を時刻どおりに並べた配列（重なりが無ければ None）"""
+        s = int(self.search * self.fs)
+        ref = np.zeros(n + 2 * s, dtype=np.float32)
+        base = t0 - self.search
+        hit = False
+        with self._lock:
+            refs = list(self._refs)
+        for start, pcm in refs:
+            a = int(round((start - base) * self.fs))
+            lo, hi = max(0, a), min(len(ref), a + len(pcm))
+            if lo < hi:
+                ref[lo:hi] += pcm[lo - a:hi - a]
+                hit = True
+        return ref if hit else None
+
+    def process(self, pcm, fs: int, t0: float) -> Tuple["np.ndarray", float]:
+        """
+        録音（開始時刻 t0）から再生音を取り除く。
+        戻り値: (除去後の mono float32 @ self.fs, 再生音が占めたエネルギーの割合 0..1)
+        """
+        t_start = time.perf_counter()
+        x = np.asarray(pcm, dtype=np.float32)
+        if x.ndim > 1:
+            x = x.mean(axis=1)
+        if fs != self.fs:
+            x = resample(x, fs, self.fs)
+        n = len(x)
+        ref = self._reference(t0, n) if n else None
+        ratio = 0.0
+        if ref is not None and np.any(ref):
+            # 相互相関（FFT）: corr[k] = Σ ref[k + i] · x[i]、k = 0..2S が探索範囲
+            nfft = 1 << int(np.ceil(np.log2(len(ref) + n)))
+            corr = np.fft.irfft(np.fft.rfft(ref, nfft) * np.conj(np.fft.rfft(x, nfft)), nfft)[:len(ref) - n + 1]
+            # 参照側の窓エネルギーで正規化（大きい音の場所に引っ張られないように）
+            c = np.concatenate(([0.0], np.cumsum(ref.astype(np.float64) ** 2)))
+            energy = c[n:] - c[:-n]
+            k = int(np.argmax(np.abs(corr) / np.sqrt(energy + 1e-9)))
+            r = ref[k:k + n]
+
+            # ブロックごとにゲインを推定して差し引く（距離・音量の揺れに追従）
+            b = max(1, int(BLOCK_SECONDS * self.fs))
+            nb = n // b
+            if nb:
+                X = x[:nb * b].reshape(nb, b)
+                R = r[:nb * b].reshape(nb, b)
+                g = (X * R).sum(axis=1) / ((R * R).sum(axis=1) + 1e-9)
+                E = X - g[:, None] * R
+                ex = (X * X).sum(axis=1)
+                ee = (E * E).sum(axis=1)
+                echo = 1.0 - ee / (ex + 1e-12)
+                E[echo > GATE_RATIO] = 0.0
+                ratio = float(max(0.0, 1.0 - ee.sum() / (ex.sum() + 1e-12)))
+                x = np.concatenate([E.reshape(-1), x[nb * b:] - g[-1] * r[nb * b:]])
+        with self.stats.lock:
+            self.stats.checked += 1
+            self.stats.proc_ms.append((time.perf_counter() - t_start) * 1000)
+        return x.astype(np.float32), ratio
+
+    def should_skip(self, cleaned: "np.ndarray", ratio: float) -> bool:
+        """ほぼ自分の声だけの区間なら True（ASR に回さない）"""
+        rms = float(np.sqrt(np.mean(cleaned * cleaned))) if len(cleaned) else 0.0
+        skip = ratio >= SKIP_RATIO or (ratio > 0.3 and rms < SPEECH_RMS)
+        with self.stats.lock:
+            if skip:
+                self.stats.skipped += 1
+            elif ratio > 0.0:
+                self.stats.cleaned += 1
+        return skip
+
+    # ---- 録音経路向けの入口 ----
+    def filter_pcm16(self, raw: bytes, fs: int, t0: float, channels: int = 1) -> Optional[bytes]:
+        """int16 の録音を処理して、除去後の int16 mono @ self.fs を返す（スキップなら None）"""
+        x = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768.0
+        if channels > 1:
+            x = x.reshape(-1, channels)
+        cleaned, ratio = self.process(x, fs, t0)
+        if self.should_skip(cleaned, ratio):
+            return None
+        return to_pcm16(cleaned)
+
+    def filter_wav(self, path: str, t0: float) -> bool:
+        """WAV を除去後の音声で上書きする（スキップなら False）"""
+        pcm, fs = decode_wav(path)
+        cleaned, ratio = self.process(pcm, fs, t0)
+        if self.should_skip(cleaned, ratio):
+            return False
+        if ratio > 0.0:
+            import wave
+            with wave.open(path, "wb") as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(self.fs)
+                w.writeframes(to_pcm16(cleaned))
+        return True
+
+    def is_echo_text(self, text: str) -> bool:
+        """文字起こしが直前の自分の発話とほぼ同じなら True（LLM に回さない）"""
+        g = _grams(_norm_text(text))
+        if len(g) < TEXT_MIN_GRAMS:
+            return False
+        since = time.time() - TEXT_RECENT
+        with self._lock:
+            texts = [t for ended_at, t in self._texts if ended_at >= since]
+        for t in texts:
+            if len(g & t) >= TEXT_CONTAIN * len(g):
+                with self.stats.lock:
+                    self.stats.slipped += 1
+                return True
+        return False
+
+
+def open_echo() -> Optional[EchoCanceller]:
+    """KIRITAN_ECHO=0 / numpy なしなら None"""
+    if np is None or os.getenv("KIRITAN_ECHO", "1").strip().lower() in ("0", "off", "false"):
+        return None
+    return EchoCanceller()
+
+
+def reference_mode() -> str:
+    return os.getenv("KIRITAN_ECHO", "1").strip().lower()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+音声エンジンのプール（複数の VOICEROID / AssistantSeika にレンダリングを振り分ける）
+- 同じ声を出せるエンジンを複数登録（VOICEROID ウィンドウ複数、SeikaSay2 の別 cid、AssistantSeika HTTP）
+- ジョブは「未処理の仕事量（文字数 × 直近のレンダリング速度）」が最小のエンジンへ
+- 連続失敗 / ヘルスチェック失敗で退役（evict）、定期チェックで復帰したら再投入
+- 各エンジンの中身は kiritan_speech の SpeechBackend（書き出しできるものだけ使う）
+- RenderFn 互換（pool.render(text, cid, speed, path)）なので PlaybackEngine にそのまま渡せる
+- 一括レンダリング（render_many）は生きているエンジン数だけ並列に走る
+
+設定（環境変数 KIRITAN_ENGINES, カンマ区切り）:
+  seika:1707                    … SeikaSay2 で cid 1707
+  seika:1708=1707               … cid 1708 の別インスタンスを「1707 の声」として使う
+  http://host:7180/1707         … AssistantSeika の HTTP 機能（SEIKA_HTTP_USER / SEIKA_HTTP_PASS）
+  voiceroid=1707                … 起動中の VOICEROID ウィンドウ全部（「音声保存」で書き出し）
+  null=1707 / file:dir=1707     … ヘッドレス（合成音 / 録り置き。kiritan_speech.py）
+  例: KIRITAN_ENGINES=seika:1707,seika:1708=1707,voiceroid=1707
+
+  python kiritan_engine_pool.py --status
+  python kiritan_engine_pool.py --render lines.txt --out out_dir
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Iterable
+
+from kiritan_playback import RenderFn, seika_save
+from kiritan_speech import SpeechBackend, parse_backends, backend_from_env, RENDER, CID_KIRITAN
+
+MAX_FAILURES = 3              # 連続でこれだけ失敗したら退役
+CHECK_INTERVAL = 15.0         # ヘルスチェック間隔（秒）
+INITIAL_SEC_PER_CHAR = 0.05   # レンダリング速度の初期見積もり
+EWMA = 0.3
+
+
+# ---------------- エンジン ----------------
+class SpeechEngine:
+    """プール内の 1 台（SpeechBackend + 割り当て・健康状態の記録）。同時に 1 ジョブだけ処理する"""
+
+    def __init__(self, backend: SpeechBackend, voices: Iterable[int] = ()):
+        self.backend = backend
+        self.name = backend.name
+        self.kind = backend.kind
+        self.voices = set(voices) or backend.voices or {CID_KIRITAN}
+        self.busy = threading.Lock()
+        self.alive = True
+        self.failures = 0
+        self.outstanding_chars = 0    # 割り当て済みで未完了の文字数
+        self.sec_per_char = INITIAL_SEC_PER_CHAR
+        self.rendered = 0
+        self.errors = 0
+
+    def render(self, text: str, cid: int, speed: float, path: str) -> bool:
+        return self.backend.render_to_file(text, cid, speed, path)
+
+    def health(self) -> bool:
+        return self.backend.health()
+
+    def expected_wait(self, chars: int = 0) -> float:
+        return (self.outstanding_chars + chars) * self.sec_per_char
+
+    def __repr__(self):
+        return f"<{self.kind} {self.name}>"
+
+
+# ---------------- プール ----------------
+class EnginePool:
+    def __init__(self, engines: Iterable[SpeechEngine] = (), fallback: Optional[RenderFn] = seika_save,
+                 max_failures: int = MAX_FAILURES, check_interval: float = CHECK_INTERVAL):
+        self.engines: List[SpeechEngine] = list(engines)
+        self.fallback = fallback          # どのエンジンも担当しない cid 用
+        self.max_failures = max_failures
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.evictions = 0
+        if check_interval > 0:
+            threading.Thread(target=self._health_loop, daemon=True).start()
+
+    def add(self, engine: SpeechEngine):
+        with self._lock:
+            self.engines.append(engine)
+
+    def alive(self, cid: Optional[int] = None) -> List[SpeechEngine]:
+        with self._lock:
+            return [e for e in self.engines if e.alive and (cid is None or cid in e.voices)]
+
+    @property
+    def size(self) -> int:
+        return len(self.alive())
+
+    def close(self):
+        self._stop.set()
+
+    # ---- 割り当て ----
+    def _acquire(self, cid: int, chars: int, tried: set) -> Optional[SpeechEngine]:
+        with self._lock:
+            cands = [e for e in self.engines
+                     if e.alive and cid in e.voices and e not in tried]
+            if not cands:
+                return None
+            e = min(cands, key=lambda x: x.expected_wait(chars))
+            e.outstanding_chars += chars
+            return e
+
+    def render(self, text: str, cid: int, speed: float, path: str) -> bool:
+        """RenderFn 互換。失敗したら別のエンジンで再試行"""
+        chars = max(1, len(text))
+        tried: set = set()
+        while True:
+            e = self._acquire(cid, chars, tried)
+            if e is None:
+                break
+            tried.add(e)
+            ok = False
+            try:
+                with e.busy:
+                    # 1 文あたりの秒数の学習に、前の文が終わるのを待った時間を混ぜない
+                    t0 = time.time()
+                    ok = e.render(text, cid, speed, path)
+                    elapsed = time.time() - t0
+            except Exception as ex:
+                print(f"[pool] {e.name} 失敗: {ex}", file=sys.stderr)
+            finally:
+                with self._lock:
+                    e.outstanding_chars -= chars
+            if ok:
+                self._succeeded(e, elapsed / chars)
+                return True
+            self._failed(e)
+        if not tried and self.fallback is not None:
+            return self.fallback(text, cid, speed, path)
+        return False
+
+    def render_many(self, jobs: List[Tuple[str, int, float, str]]) -> List[bool]:
+        """一括レンダリング（生きているエンジン数だけ並列）"""
+        workers = max(1, self.size)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pool") as ex:
+            return list(ex.map(lambda j: self.render(*j), jobs))
+
+    def _succeeded(self, e: SpeechEngine, sec_per_char: float):
+        with self._lock:
+            e.failures = 0
+            e.rendered += 1
+            e.sec_per_char = (1 - EWMA) * e.sec_per_char + EWMA * sec_per_char
+
+    def _failed(self, e: SpeechEngine):
+        with self._lock:
+            e.errors += 1
+            e.failures += 1
+            if e.alive and e.failures >= self.max_failures:
+                self._evict(e, f"{e.failures} 回連続で失敗")
+
+    def _evict(self, e: SpeechEngine, reason: str):
+        e.alive = False
+        self.evictions += 1
+        print(f"[pool] {e.name} を退役（{reason}）", file=sys.stderr)
+
+    # ---- ヘルスチェック ----
+    def check(self):
+        """全エンジンを確認。死んでいれば退役、退役中でも復帰していれば戻す（busy 中のものは飛ばす）"""
+        with self._lock:
+            engines = list(self.engines)
+        for e in engines:
+            if not e.busy.acquire(blocking=False):
+                continue
+            try:
+                ok = e.health()
+            except Exception:
+                ok = False
+            finally:
+                e.busy.release()
+            with self._lock:
+                if e.alive and not ok:
+                    self._evict(e, "ヘルスチェック失敗")
+                elif not e.alive and ok:
+                    e.alive = True
+                    e.failures = 0
+                    print(f"[pool] {e.name} が復帰", file=sys.stderr)
+
+    def _health_loop(self):
+        while not self._stop.wait(self.check_interval):
+            self.check()
+
+    def status(self) -> str:
+        with self._lock:
+            lines = [f"{'alive' if e.alive else 'DEAD '} {e.name:<28} voices={sorted(e.voices)}"
+                     f" 完了={e.rendered} 失敗={e.errors} 待ち={e.expected_wait():.1f}s"
+                     f" {e.sec_per_char * 1000:.0f}ms/字"
+                     for e in self.engines]
+        return "\n".join(lines + [f"退役 {self.evictions} 回"])
+
+
+# ---------------- 設定から作る ----------------
+def parse_engines(spec: str) -> List[SpeechEngine]:
+    engines = []
+    for b in parse_backends(spec):
+        if RENDER not in b.caps:
+            print(f"[pool] {b.name} は書き出しできないので使いません", file=sys.stderr)
+            continue
+        engines.append(SpeechEngine(b))
+    return engines
+
+
+def pool_from_env() -> Optional[EnginePool]:
+    """KIRITAN_ENGINES が設定されていればプールを作る（未設定なら None）"""
+    spec = os.getenv("KIRITAN_ENGINES", "").strip()
+    if not spec:
+        return None
+    engines = parse_engines(spec)
+    print(f"[pool] エンジン {len(engines)} 台: {', '.join(e.name for e in engines)}")
+    # どのエンジンも担当しない cid は KIRITAN_SPEECH（既定 SeikaSay2）へ
+    return EnginePool(engines, fallback=backend_from_env())
+
+
+# ---------------- CLI ----------------
+def main():
+    p = argparse.ArgumentParser(prog="kiritan_engine_pool")
+    p.add_argument("--engines", default=os.getenv("KIRITAN_ENGINES", ""))
+    p.add_argument("--status", action="store_true", help="ヘルスチェックして一覧表示")
+    p.add_argument("--render", help="1 行 1 文のテキストを一括レンダリング")
+    p.add_argument("--out", default=os.path.join("cache", "batch"))
+    p.add_argument("--cid", type=int, default=CID_KIRITAN)
+    p.add_argument("--speed", type=float, default=1.0)
+    args = p.parse_args()
+
+    pool = EnginePool(parse_engines(args.engines), check_interval=0)
+    if not pool.engines:
+        print("エンジンが指定されていません（--engines または KIRITAN_ENGINES）")
+        return
+    pool.check()
+    if args.render:
+        with open(args.render, "r", encoding="utf-8") as f:
+            lines = [x.strip() for x in f if x.strip()]
+        os.makedirs(args.out, exist_ok=True)
+        jobs = [(t, args.cid, args.speed, os.path.join(args.out, f"{i:04d}.wav")) for i, t in enumerate(lines)]
+        t0 = time.time()
+        ok = pool.render_many(jobs)
+        dt = time.time() - t0
+        print(f"[pool] {sum(ok)}/{len(jobs)} 件 {dt:.1f}s（{len(jobs) / max(dt, 1e-6):.2f} 件/s, エンジン {pool.size} 台）")
+    print(pool.status())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+フェイクの LLM / 音声合成 / 再生（API キー・SeikaSay2・音声デバイスなしで会話パイプラインを回す）
+- FakeLLM: OpenAI クライアント互換（chat.completions.create / audio.transcriptions.create）
+    台本（トレースの LLM 呼び出し）があれば、そのモデル・delta・時刻どおりに返す。無ければ定型文を一定速度で流す
+- FakeSpeech: HeadlessBackend（RenderFn 互換）。台本のレンダリング時間だけ待って、発話長ぶんの無音 WAV を書き出す
+- FakePlaybackEngine: PlaybackEngine の出力だけ差し替え（WAV の長さだけ待つ）
+- scale で時間を伸縮（1.0 = 実時間、0.1 = 10 倍速、0 = 待たずに最速）
+
+使い方:
+  llm = FakeLLM(scale=0.1)
+  engine = FakePlaybackEngine(FakeSpeech(scale=0.1), scale=0.1)
+"""
+
+import time
+import threading
+from collections import deque
+from types import SimpleNamespace
+from typing import Optional, List, Dict, Callable
+
+from kiritan_budget import estimate_seconds
+from kiritan_playback import PlaybackEngine, DEFAULT_LOOKAHEAD
+from kiritan_speech import HeadlessBackend, wav_seconds
+
+FAKE_TTFT = 0.4               # 台本が無いときの最初の delta までの秒数
+FAKE_CHARS_PER_SEC = 40.0     # 台本が無いときの生成速度（文字/秒）
+FAKE_RENDER_SEC = 0.3         # 台本が無いときの 1 文のレンダリング時間
+FAKE_FS = 16000
+
+
+def _sleep(seconds: float):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def _chunk(text: str):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+def _default_reply(messages: List[Dict[str, str]]) -> str:
+    user = next((m.get("content", "") for m in reversed(messages or []) if m.get("role") == "user"), "")
+    return f"（フェイク）「{user[:20]}」ですね。わかりました！"
+
+
+# ---------------- LLM ----------------
+class FakeStream:
+    """delta を台本の時刻（呼び出し開始からの相対秒 × scale）に合わせて返す"""
+
+    def __init__(self, deltas: List, scale: float, error: Optional[str] = None, end: float = 0.0):
+        self.deltas = deltas
+        self.scale = scale
+        self.error = error
+        self.end = end
+        self.closed = False
+        self._t0 = time.perf_counter()
+
+    def __iter__(self):
+        for at, text in self.deltas:
+            _sleep(self._t0 + at * self.scale - time.perf_counter())
+            if self.closed:
+                return
+            yield _chunk(text)
+        if self.error:
+            _sleep(self._t0 + self.end * self.scale - time.perf_counter())
+            raise RuntimeError(self.error)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeLLM:
+    def __init__(self, scale: float = 1.0, reply_fn: Callable[[List[Dict[str, str]]], str] = _default_reply):
+        self.scale = max(0.0, float(scale))
+        self.reply_fn = reply_fn
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._transcribe))
+        self._calls: List[Dict] = []
+        self._asr: deque = deque()
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def script(self, calls: Optional[List[Dict]] = None, asr: Optional[Dict] = None):
+        """次のターンの台本（トレースの calls / input.asr）を差し替える"""
+        with self._lock:
+            self._calls = [dict(c) for c in calls or []]
+            self._asr.clear()
+            if asr:
+                self._asr.append(asr)
+
+    def _take(self, model: str) -> Optional[Dict]:
+        # 同じモデルの未使用の呼び出しを優先、無ければ先頭の未使用分
+        with self._lock:
+            for c in self._calls:
+                if c.get("model") == model:
+                    self._calls.remove(c)
+                    return c
+            return self._calls.pop(0) if self._calls else None
+
+    def _synth(self, messages) -> Dict:
+        text = self.reply_fn(messages)
+        step = 4
+        deltas = [[FAKE_TTFT + i / FAKE_CHARS_PER_SEC, text[i:i + step]] for i in range(0, len(text), step)]
+        return {"deltas": deltas, "end": deltas[-1][0] if deltas else FAKE_TTFT}
+
+    def _create(self, model: str = "", messages=None, stream: bool = False, **kwargs):
+        self.requests += 1
+        call = self._take(model) or self._synth(messages)
+        deltas = call.get("deltas") or []
+        error = call.get("error")
+        if error and not deltas:
+            _sleep((call.get("end") or 0.0) * self.scale)
+            raise RuntimeError(error)
+        if stream:
+            return FakeStream(deltas, self.scale, error, call.get("end") or 0.0)
+        _sleep((call.get("end") or (deltas[-1][0] if deltas else 0.0)) * self.scale)
+        if error:
+            raise RuntimeError(error)
+        content = "".join(d for _, d in deltas)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    def _transcribe(self, model: str = "", file=None, **kwargs):
+        with self._lock:
+            asr = self._asr.popleft() if self._asr else {}
+        _sleep(asr.get("sec", 0.0) * self.scale)
+        return asr.get("text", "")
+
+
+# ---------------- 合成 / 再生 ----------------
+class FakeSpeech(HeadlessBackend):
+    """ヘッドレスの SpeechBackend。台本（text → レンダリング秒・発話秒）が無い文は既定値と話速の見積もりで作る"""
+
+    def __init__(self, scale: float = 1.0, render_sec: float = FAKE_RENDER_SEC, fs: int = FAKE_FS):
+        super().__init__(fs=fs, render_sec=render_sec, scale=scale)
+        self.name = "fake"
+        self._timings: Dict[str, tuple] = {}
+
+    def script(self, speech: Optional[List[Dict]] = None):
+        """トレースの speech 記録から、文ごとのレンダリング時間と発話長を覚える"""
+        self._timings = {}
+        for s in speech or []:
+            render = s["r"] - s["q"] if s.get("r") is not None and s.get("q") is not None else None
+            dur = s.get("dur") or ((s["e"] - s["s"]) if s.get("e") is not None and s.get("s") is not None else None)
+            self._timings[s.get("text", "")] = (render, dur)
+
+    def render_to_file(self, text: str, cid: int, speed: float, path: str) -> bool:
+        self.renders += 1
+        render, dur = self._timings.get(text, (None, None))
+        _sleep((self.render_sec if render is None else render) * self.scale)
+        self.synth(dur or estimate_seconds(text, speed), path)
+        return True
+
+
+class FakePlaybackEngine(PlaybackEngine):
+    """音を出さずに、WAV の長さ × scale だけ待つ PlaybackEngine"""
+
+    def __init__(self, render, scale: float = 1.0, lookahead: int = DEFAULT_LOOKAHEAD):
+        super().__init__(render, lookahead=lookahead, cache_dir=None)
+        self.gapless = False
+        self.scale = max(0.0, float(scale))
+
+    def _play_blocking(self, seg):
+        with self._lock:
+            self._unqueued -= 1
+        seg.enqueued = True
+        dur = wav_seconds(seg.path)
+        now = time.time()
+        self._events.put(("start", seg, now))
+        self._events.put(("finish", seg, now + dur * self.scale))
+        _sleep(dur * self.scale)
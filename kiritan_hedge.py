@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+LLM リクエストのヘッジ（テール遅延対策）
+- 1 本目のモデルが期限内に最初のトークンを返さなければ、次のモデルへ 2 本目を投げる
+- 先に出力を返したストリームを採用し、負けた方はキャンセル（stream.close）
+- 期限は固定秒数、または直近の TTFT（最初のトークンまでの時間）の p95 から自動算出
+- ヘッジ率・勝敗・TTFT を HedgeStats に記録
+- レート制限（kiritan_ratelimit）の待ちはヘッジの時計にも TTFT にも数えない。時計は実際に送ってから動かし、
+  1 本目が送れずに待っている間（429 の Retry-After 待ちを含む）はヘッジしない
+
+有効化（環境変数）:
+  KIRITAN_HEDGE=auto   … 適応期限（p95）
+  KIRITAN_HEDGE=1.5    … 固定期限（秒）
+  未設定 / 0           … 無効（従来どおり順番にフォールバック）
+"""
+
+import os
+import sys
+import time
+import queue
+import threading
+from collections import deque
+from typing import Optional, List, Dict, Iterator, Callable
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(q * (len(s) - 1)))))
+    return s[k]
+
+
+# ---------------- 統計 ----------------
+class HedgeStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0          # 期限切れで 2 本目を投げた回数
+        self.failovers = 0       # エラーで次のモデルへ移った回数
+        self.wins = {"primary": 0, "hedge": 0, "failover": 0}
+        self.cancelled = 0
+        self.ttft: deque = deque(maxlen=1000)
+
+    def summary(self) -> str:
+        with self.lock:
+            n = max(1, self.requests)
+            ms = [x * 1000 for x in self.ttft]
+            return (f"requests={self.requests} hedge率={self.hedged / n:.1%} "
+                    f"勝ち(primary/hedge/failover)={self.wins['primary']}/{self.wins['hedge']}/{self.wins['failover']} "
+                    f"cancel={self.cancelled} TTFT p50={_percentile(ms, 0.5):.0f}ms p95={_percentile(ms, 0.95):.0f}ms")
+
+
+# ---------------- ポリシー ----------------
+class HedgePolicy:
+    """ヘッジ期限の決め方。fixed を渡せば固定、None なら直近 TTFT の quantile"""
+
+    def __init__(self, fixed: Optional[float] = None, quantile: float = 0.95,
+                 initial: float = 2.0, floor: float = 0.25, ceiling: float = 8.0,
+                 window: int = 100, warmup: int = 10):
+        self.fixed = fixed
+        self.quantile = quantile
+        self.initial = initial
+        self.floor = floor
+        self.ceiling = ceiling
+        self.warmup = warmup
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.stats = HedgeStats()
+
+    def deadline(self) -> float:
+        if self.fixed:
+            return self.fixed
+        with self._lock:
+            samples = list(self._samples)
+        if len(samples) < self.warmup:
+            return self.initial
+        return max(self.floor, min(self.ceiling, _percentile(samples, self.quantile)))
+
+    def observe(self, ttft: float):
+        with self._lock:
+            self._samples.append(ttft)
+        with self.stats.lock:
+            self.stats.ttft.append(ttft)
+
+
+_policy: Optional[HedgePolicy] = None
+_policy_lock = threading.Lock()
+
+
+def get_policy() -> Optional[HedgePolicy]:
+    """環境変数 KIRITAN_HEDGE からポリシーを作る（プロセス内で共有）"""
+    global _policy
+    raw = (os.getenv("KIRITAN_HEDGE") or "").strip().lower()
+    if raw in ("", "0", "off", "false"):
+        return None
+    with _policy_lock:
+        if _policy is None:
+            if raw == "auto":
+                _policy = HedgePolicy()
+            else:
+                try:
+                    _policy = HedgePolicy(fixed=max(0.05, float(raw)))
+                except ValueError:
+                    print(f"[hedge] KIRITAN_HEDGE の値が不正です: {raw}（auto を使用）", file=sys.stderr)
+                    _policy = HedgePolicy()
+        return _policy
+
+
+# ---------------- 実行 ----------------
+class _Attempt(threading.Thread):
+    """1 モデル分のストリーミング要求。イベントは共有キューへ流す"""
+
+    def __init__(self, client, model: str, role: str, messages, out: queue.Queue, kwargs: Dict):
+        super().__init__(daemon=True)
+        self.client = client
+        self.model = model
+        self.role = role
+        self.messages = messages
+        self.out = out
+        self.kwargs = kwargs
+        self.stream = None
+        self.finished = False
+        self.cancelled = threading.Event()
+        self.sent_at: Optional[float] = None     # 実際に送った時刻（レート制限で待っている間は None）
+
+    def _sent(self):
+        self.sent_at = time.time()
+
+    def run(self):
+        try:
+            kwargs = dict(self.kwargs)
+            if getattr(self.client, "limiter", None) is not None:
+                kwargs["on_send"] = self._sent     # LimitedClient: 待ちを抜けて送る直前に時計を合わせる
+            else:
+                self._sent()
+            self.stream = self.client.chat.completions.create(
+                model=self.model, messages=self.messages, stream=True, **kwargs)
+            if self.cancelled.is_set():
+                self._close()
+                return
+            for chunk in self.stream:
+                if self.cancelled.is_set():
+                    break
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if delta:
+                    self.out.put(("delta", self, delta))
+            self.out.put(("done", self, None))
+        except Exception as e:
+            self.out.put(("error", self, e))
+        finally:
+            if self.cancelled.is_set():
+                self._close()
+
+    def cancel(self):
+        self.cancelled.set()
+        self._close()
+
+    def _close(self):
+        s = self.stream
+        if s is None:
+            return
+        try:
+            s.close()
+        except Exception:
+            pass
+
+
+def hedged_stream(client, models: List[str], messages: List[Dict[str, str]],
+                  policy: HedgePolicy, model_kwargs: Optional[Callable[[str], Dict]] = None,
+                  **kwargs) -> Iterator[str]:
+    """
+    ヘッジ付きで delta を順に yield する。
+    1 本目が期限内に最初のトークンを出さなければ次のモデルへ 2 本目を投げ、先に出力した方を採用。
+    エラーのときは（ヘッジとは別に）次のモデルへ即フォールバック。
+    model_kwargs はモデルごとの追加引数（max_tokens の有無など）。
+    途中で close された（呼び出し側が読むのをやめた）ときは採用ストリームも止める。
+    """
+    models = [m for m in models if m]
+    if not models:
+        raise RuntimeError("モデルが指定されていません")
+    # モデルが 1 つしか無いときは同じモデルへ重複リクエストする
+    backups = models[1:] or models[:1]
+    stats = policy.stats
+    out: queue.Queue = queue.Queue()
+    attempts: List[_Attempt] = []
+
+    def launch(model: str, role: str) -> _Attempt:
+        extra = model_kwargs(model) if model_kwargs else {}
+        a = _Attempt(client, model, role, messages, out, dict(kwargs, **extra))
+        attempts.append(a)
+        a.start()
+        return a
+
+    with stats.lock:
+        stats.requests += 1
+    # ヘッジの期限は「先頭の要求（primary / failover）を実際に送ってから」数える
+    lead = launch(models[0], "primary")
+    hedged = False
+    errors = []
+    winner: Optional[_Attempt] = None
+    first: Optional[str] = None
+
+    while winner is None:
+        timeout = None
+        if not hedged and backups:
+            sent = lead.sent_at
+            timeout = policy.deadline() if sent is None else max(0.0, sent + policy.deadline() - time.time())
+        try:
+            kind, a, payload = out.get(timeout=timeout)
+        except queue.Empty:
+            sent = lead.sent_at
+            if sent is None or time.time() < sent + policy.deadline():
+                continue                    # まだレート制限の待ち（または送り直した直後）
+            hedged = True
+            m = backups.pop(0)
+            print(f"[hedge] {policy.deadline():.2f}s 以内に応答なし → {m} へも送信", file=sys.stderr)
+            with stats.lock:
+                stats.hedged += 1
+            launch(m, "hedge")
+            continue
+
+        if kind == "delta":
+            winner, first = a, payload
+            ttft = time.time() - (a.sent_at or time.time())
+        elif kind == "done":
+            a.finished = True
+            winner = a                      # 空応答でも完了は完了
+        else:
+            a.finished = True
+            errors.append(f"{a.model}: {payload}")
+            print(f"[warn] {a.model} 失敗: {payload}", file=sys.stderr)
+            if all(x.finished for x in attempts):
+                if not backups:
+                    raise RuntimeError(f"全モデル失敗: {errors}")
+                with stats.lock:
+                    stats.failovers += 1
+                lead = launch(backups.pop(0), "failover")
+                hedged = False
+
+    # 負けたストリームを止める
+    for a in attempts:
+        if a is not winner and not a.finished:
+            a.cancel()
+            with stats.lock:
+                stats.cancelled += 1
+    with stats.lock:
+        stats.wins[winner.role] += 1
+    if first is not None:
+        policy.observe(ttft)
+        if winner.role != "primary":
+            print(f"[hedge] {winner.model} を採用", file=sys.stderr)
+    try:
+        if first is not None:
+            yield first
+        if winner.finished:
+            return
+
+        while True:
+            kind, a, payload = out.get()
+            if a is not winner:
+                continue
+            if kind == "delta":
+                yield payload
+            elif kind == "done":
+                winner.finished = True
+                return
+            else:
+                winner.finished = True
+                raise RuntimeError(f"{a.model} ストリーム途中で失敗: {payload}")
+    finally:
+        if not winner.finished:
+            winner.cancel()
+
+
+def stream_chat(client, models: List[str], messages: List[Dict[str, str]],
+                max_tokens: Optional[int] = None, temperature: float = 0.7) -> Iterator[str]:
+    """
+    delta を順に yield する共通入口。KIRITAN_HEDGE が有効ならヘッジ、無効なら順番にフォールバック。
+    close されたら（呼び出し側が読むのをやめたら）上流のストリームも閉じる。
+    """
+    from kiritan_budget import token_kwargs
+    policy = get_policy()
+    if policy is not None:
+        yield from hedged_stream(client, models, messages, policy,
+                                 model_kwargs=lambda m: token_kwargs(m, max_tokens), temperature=temperature)
+        return
+    last_err = None
+    for m in [m for m in models if m]:
+        try:
+            stream = client.chat.completions.create(model=m, messages=messages, stream=True,
+                                                    temperature=temperature, **token_kwargs(m, max_tokens))
+        except Exception as e:
+            last_err = e
+            print(f"[warn] {m} 失敗: {e}", file=sys.stderr)
+            continue
+        try:
+            for chunk in stream:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content or ""
+                    if delta:
+                        yield delta
+        finally:
+            try:
+                stream.close()
+            except Exception:
+                pass
+        return
+    raise RuntimeError(f"全モデル失敗: {last_err}")
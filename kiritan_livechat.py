@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+ライブチャット取り込みモード（コメントが多い配信向け）
+- 入力: ファイル追尾（tail -f）/ 標準入力 / ローカル TCP ソケット（1 行 1 コメント）
+  形式: `名前: 本文` / `名前<TAB>本文` / JSON {"user": ..., "text": ...}（名前なしは anon）
+- 優先度付きキュー: 呼びかけ（きりたん 等）> 初見さん > その他、同じ優先度なら古い順
+- ほぼ同じコメント（連投・コピペ）は正規化 + 文字 3-gram の Jaccard で重複扱いして捨てる
+- 読み上げの残り（再生バックログ）が少なくなるまで次の生成を待ち、その間に溜まった分を 1 回のプロンプトにまとめる
+  → 混んでいるほど 1 回あたりのまとめ数が増え、LLM 呼び出しと発話の回数は増えない
+- 古くなったコメント（既定 45 秒）は拾わずに捨てる
+- KIRITAN_ADAPTIVE_SPEED があれば、まとめたコメントの待ち + 読み上げ残りに応じて話速を上げる（kiritan_speedctl）
+- 受信 / 処理できた件数を 1 分ごとに集計（持続的に捌ける件数/分 = 処理能力）
+
+使い方:
+  python kiritan_livechat.py --file chat.log
+  some_chat_bridge | python kiritan_livechat.py --stdin
+  python kiritan_livechat.py --port 8766      （nc 127.0.0.1 8766 で流し込める）
+  --no-speak で読み上げなし（発話時間は見積もりで代用するので、処理能力の試算にも使える）
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import argparse
+import threading
+import itertools
+import unicodedata
+import socketserver
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Set, Tuple
+
+try:
+    from openai import OpenAI
+except Exception:
+    OpenAI = None
+
+from kiritan_hedge import stream_chat
+from kiritan_budget import SpeechBudget, estimate_seconds, collect
+from kiritan_playback import PlaybackEngine, DEFAULT_LOOKAHEAD
+from kiritan_speech import backend_from_env
+from kiritan_speedctl import open_speedctl, unstarted_seconds
+from kiritan_ratelimit import limit_client, get_limiter
+
+# ---------------- 設定 ----------------
+CID_KIRITAN = 1707
+DEFAULT_MODELS = ["gpt-4o-mini", "o4-mini-high", "o3-mini", "gpt-4o"]
+MENTION_RE = os.getenv("KIRITAN_LIVE_NAMES") or r"きりたん|キリタン|kiritan"
+MAX_AGE = 45.0                # これより古いコメントは捨てる（秒）
+MAX_BATCH = 8                 # 1 回のプロンプトにまとめる最大件数
+LEAD_SECONDS = 2.0            # 読み上げ残りがこれを切ったら次を生成
+DEDUP_WINDOW = 120.0          # 重複判定の対象にする直近の秒数
+DEDUP_JACCARD = 0.8
+MAX_QUEUE = 2000              # キューがこれを超えたら優先度の低い古いものから捨てる
+REPORT_EVERY = 60.0
+HISTORY_WINDOW = 6
+
+PRI_MENTION, PRI_FIRST, PRI_NORMAL = 0, 1, 2
+
+SYSTEM_PROMPT = (
+    "あなたは配信者『東北きりたんEX』です。視聴者のコメントがまとめて届きます。"
+    "全部に個別に答えず、拾えるものを自然にまとめて、短く親しみやすい話し言葉で返してください。"
+    "【呼びかけ】は優先して拾い、【初見】さんには軽く歓迎を。名前は必要なときだけ呼んでください。"
+)
+
+BUDGET = SpeechBudget.from_env()
+
+
+# ---------------- コメント ----------------
+@dataclass(order=True)
+class ChatMessage:
+    priority: int
+    ts: float
+    seq: int
+    user: str = field(compare=False)
+    text: str = field(compare=False)
+    mention: bool = field(default=False, compare=False)
+    first_time: bool = field(default=False, compare=False)
+
+
+def parse_line(line: str) -> Optional[Tuple[str, str]]:
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith("{"):
+        try:
+            d = json.loads(line)
+            return str(d.get("user") or d.get("name") or "anon"), str(d.get("text") or d.get("message") or "")
+        except ValueError:
+            pass
+    m = re.match(r"^([^:：\t]{1,40})[:：\t]\s*(.+)$", line)
+    if m:
+        return m.group(1).strip(), m.group(2).strip()
+    return "anon", line
+
+
+def normalize(text: str) -> str:
+    """
+    重複判定用: NFKC・小文字化・記号/空白を除去・連続する同じ文字は 1 つに（草草草 / ｗｗｗ）。
+    数字は残す（「1位」と「2位」は別の質問）。同じ数字が 3 つ以上続くもの（8888）だけ 1 つにする
+    """
+    t = unicodedata.normalize("NFKC", text).lower()
+    t = re.sub(r"[\s\W_]+", "", t)
+    t = re.sub(r"(\d)\1{2,}", r"\1", t)
+    return re.sub(r"(\D)\1+", r"\1", t)
+
+
+def shingles(t: str) -> Set[str]:
+    return {t[i:i + 3] for i in range(max(1, len(t) - 2))} if t else set()
+
+
+# ---------------- 統計 ----------------
+class LiveStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.received = 0
+        self.answered = 0
+        self.duplicates = 0
+        self.stale = 0
+        self.overflow = 0
+        self.batches: List[int] = []
+        self.waits: deque = deque(maxlen=2000)    # 受信 → プロンプト投入までの秒数
+        self._mark = (time.time(), 0, 0)
+
+    def tick(self) -> Optional[str]:
+        """REPORT_EVERY ごとに直近の件数/分を返す"""
+        now = time.time()
+        t0, r0, a0 = self._mark
+        if now - t0 < REPORT_EVERY:
+            return None
+        with self.lock:
+            rin = (self.received - r0) * 60.0 / (now - t0)
+            rout = (self.answered - a0) * 60.0 / (now - t0)
+            self._mark = (now, self.received, self.answered)
+        return f"直近 受信 {rin:.1f}件/分 処理 {rout:.1f}件/分"
+
+    def summary(self, queued: int) -> str:
+        with self.lock:
+            mins = max(1e-6, (time.time() - self.started) / 60.0)
+            nb = len(self.batches)
+            ws = sorted(self.waits)
+            p50 = ws[len(ws) // 2] if ws else 0.0
+            p95 = ws[min(len(ws) - 1, int(len(ws) * 0.95))] if ws else 0.0
+            return (f"受信 {self.received}（{self.received / mins:.1f}件/分） 処理 {self.answered}（{self.answered / mins:.1f}件/分）"
+                    f" 重複 {self.duplicates} 期限切れ {self.stale} 溢れ {self.overflow} 待機中 {queued}"
+                    f" | 生成 {nb} 回 平均まとめ {self.answered / max(1, nb):.1f}件"
+                    f" | 待ち p50 {p50:.1f}s p95 {p95:.1f}s")
+
+
+# ---------------- キュー ----------------
+class LiveQueue:
+    """優先度付き + 重複除去 + 期限切れ破棄。put は入力スレッドから、take は生成スレッドから"""
+
+    def __init__(self, stats: LiveStats, max_age: float = MAX_AGE, mention_re: str = MENTION_RE):
+        self.stats = stats
+        self.max_age = max_age
+        self.mention = re.compile(mention_re, re.I)
+        self._heap: List[ChatMessage] = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._seen_users: Set[str] = set()
+        self._recent: deque = deque()                 # (時刻, 正規化文字列, shingles)
+        self._recent_exact: Dict[str, float] = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _is_duplicate(self, norm: str, now: float) -> bool:
+        while self._recent and now - self._recent[0][0] > DEDUP_WINDOW:
+            _, old, _ = self._recent.popleft()
+            if self._recent_exact.get(old, 0) <= now - DEDUP_WINDOW:
+                self._recent_exact.pop(old, None)
+        if norm in self._recent_exact:
+            return True
+        sh = shingles(norm)
+        for _, _, other in self._recent:
+            if sh and other and len(sh & other) >= DEDUP_JACCARD * len(sh | other):
+                return True
+        self._recent.append((now, norm, sh))
+        self._recent_exact[norm] = now
+        return False
+
+    def put(self, user: str, text: str, ts: Optional[float] = None):
+        ts = ts or time.time()
+        norm = normalize(text)
+        with self._cond:
+            self.stats.received += 1
+            # 記号や絵文字だけのコメントはキーが空になるので重複判定しない（全部同じ扱いにしない）
+            if norm and self._is_duplicate(norm, ts):
+                self.stats.duplicates += 1
+                return
+            first = user not in self._seen_users and user != "anon"
+            self._seen_users.add(user)
+            mention = bool(self.mention.search(text))
+            pri = PRI_MENTION if mention else (PRI_FIRST if first else PRI_NORMAL)
+            heapq.heappush(self._heap, ChatMessage(pri, ts, next(self._seq), user, text, mention, first))
+            if len(self._heap) > MAX_QUEUE:
+                # いちばん後回しになるもの（優先度が低く新しい）を落とす
+                self._heap.remove(max(self._heap))
+                heapq.heapify(self._heap)
+                self.stats.overflow += 1
+            self._cond.notify()
+
+    def take(self, n: int, timeout: Optional[float] = None) -> List[ChatMessage]:
+        """優先度順に最大 n 件。期限切れは捨てる。1 件も無ければ timeout まで待つ"""
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                out: List[ChatMessage] = []
+                while self._heap and len(out) < n:
+                    m = heapq.heappop(self._heap)
+                    if now - m.ts > self.max_age:
+                        self.stats.stale += 1
+                        continue
+                    out.append(m)
+                if out:
+                    return out
+                left = None if end is None else end - now
+                if left is not None and left <= 0:
+                    return []
+                self._cond.wait(left)
+
+
+# ---------------- 入力 ----------------
+def follow_file(path: str, q: LiveQueue, stop: threading.Event):
+    """ファイル末尾を追尾（ローテーションで縮んだら先頭から読み直す）"""
+    while not os.path.exists(path) and not stop.is_set():
+        time.sleep(0.5)
+    f = open(path, "r", encoding="utf-8", errors="replace")
+    f.seek(0, os.SEEK_END)
+    partial = ""
+    while not stop.is_set():
+        line = f.readline()
+        if line:
+            partial += line
+            if partial.endswith("\n"):
+                p = parse_line(partial)
+                partial = ""
+                if p:
+                    q.put(*p)
+            continue
+        try:
+            if os.path.getsize(path) < f.tell():
+                f.close()
+                f = open(path, "r", encoding="utf-8", errors="replace")
+        except OSError:
+            pass
+        time.sleep(0.1)
+    f.close()
+
+
+def read_stdin(q: LiveQueue, stop: threading.Event):
+    for line in sys.stdin:
+        if stop.is_set():
+            break
+        p = parse_line(line)
+        if p:
+            q.put(*p)
+
+
+def serve_socket(port: int, q: LiveQueue) -> socketserver.ThreadingTCPServer:
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                p = parse_line(raw.decode("utf-8", "replace"))
+                if p:
+                    q.put(*p)
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------------- 本体 ----------------
+def build_prompt(batch: List[ChatMessage], history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    lines = []
+    for m in batch:
+        tags = ("【呼びかけ】" if m.mention else "") + ("【初見】" if m.first_time else "")
+        lines.append(f"{tags}{m.user}: {m.text}")
+    return ([{"role": "system", "content": SYSTEM_PROMPT}] + history[-HISTORY_WINDOW:]
+            + [{"role": "user", "content": "\n".join(lines)}])
+
+
+class LiveChat:
+    def __init__(self, client, queue: LiveQueue, engine: Optional[PlaybackEngine],
+                 speed: float = 1.0, max_batch: int = MAX_BATCH, lead: float = LEAD_SECONDS):
+        self.client = client
+        self.queue = queue
+        self.stats = queue.stats
+        self.engine = engine
+        self.speed = speed
+        self.speedctl = open_speedctl(speed, tag="live")
+        self.max_batch = max_batch
+        self.lead = lead
+        self.history: List[Dict[str, str]] = []
+        self._last_segments: list = []
+        self._speaking_until = 0.0            # --no-speak 時の見積もり
+
+    def backlog(self) -> float:
+        """まだ話していない音声の残り（秒）。未レンダリングの文は見積もりで足す"""
+        if self.engine is None:
+            return max(0.0, self._speaking_until - time.time())
+        return self.engine.backlog_seconds() + unstarted_seconds(self._last_segments)
+
+    def step(self, stop: threading.Event) -> bool:
+        # 読み上げが残り lead 秒を切るまで待つ（その間にコメントが溜まる → まとめ数が増える）
+        while self.backlog() > self.lead and not stop.is_set():
+            time.sleep(0.05)
+        batch = self.queue.take(self.max_batch, timeout=0.5)
+        if not batch:
+            return False
+        now = time.time()
+        with self.stats.lock:
+            self.stats.batches.append(len(batch))
+            self.stats.answered += len(batch)
+            self.stats.waits.extend(now - m.ts for m in batch)
+        print(f"[live] {len(batch)} 件をまとめて応答（待機 {len(self.queue)}）")
+        # 返答が遅れている（いちばん古いコメントの待ち + 読み上げ残り）ほど速く読む。予算は基準の話速のまま
+        speed = (self.speedctl.update(now - min(m.ts for m in batch) + self.backlog())
+                 if self.speedctl is not None else self.speed)
+        messages = build_prompt(batch, self.history)
+        reply = collect(stream_chat(self.client, _choose_models(), messages,
+                                    BUDGET.max_tokens("live", self.speed)),
+                        BUDGET.cutter("live", self.speed))
+        if not reply:
+            return True
+        print(f"きりたん > {reply}")
+        self.history += [messages[-1], {"role": "assistant", "content": reply}]
+        self.history = self.history[-HISTORY_WINDOW:]
+        if self.engine is not None:
+            self._last_segments = self.engine.speak(reply, CID_KIRITAN, speed)
+        else:
+            self._speaking_until = max(time.time(), self._speaking_until) + estimate_seconds(reply, speed)
+        return True
+
+    def run(self, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                self.step(stop)
+            except Exception as e:
+                print(f"[error] 生成失敗: {e}", file=sys.stderr)
+                time.sleep(1.0)
+            line = self.stats.tick()
+            if line:
+                print(f"[live] {line}")
+
+
+def _choose_models() -> List[str]:
+    env = (os.environ.get("OPENAI_MODEL") or "").strip()
+    return [env] if env else DEFAULT_MODELS[:]
+
+
+def main():
+    p = argparse.ArgumentParser(prog="kiritan_livechat")
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument("--file", help="追尾するチャットログ")
+    src.add_argument("--stdin", action="store_true")
+    src.add_argument("--port", type=int, help="ローカル TCP で受ける（1 行 1 コメント）")
+    p.add_argument("--max-age", type=float, default=MAX_AGE)
+    p.add_argument("--batch", type=int, default=MAX_BATCH)
+    p.add_argument("--lead", type=float, default=LEAD_SECONDS, help="読み上げ残りがこの秒数を切ったら次を生成")
+    p.add_argument("--speed", type=float, default=1.0)
+    p.add_argument("--no-speak", action="store_true")
+    args = p.parse_args()
+
+    if OpenAI is None:
+        raise RuntimeError("openai ライブラリが未インストールです。`pip install openai`")
+    stats = LiveStats()
+    q = LiveQueue(stats, max_age=args.max_age)
+    stop = threading.Event()
+    if args.file:
+        threading.Thread(target=follow_file, args=(args.file, q, stop), daemon=True).start()
+    elif args.stdin:
+        threading.Thread(target=read_stdin, args=(q, stop), daemon=True).start()
+    else:
+        serve_socket(args.port, q)
+        print(f"[live] 127.0.0.1:{args.port} で待機中")
+
+    engine = None
+    if not args.no_speak:
+        from kiritan_engine_pool import pool_from_env
+        pool = pool_from_env()
+        engine = (PlaybackEngine(pool.render, lookahead=max(DEFAULT_LOOKAHEAD, pool.size))
+                  if pool else PlaybackEngine(backend_from_env()))
+    live = LiveChat(limit_client(OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))), q, engine,
+                    speed=max(0.5, min(4.0, args.speed)), max_batch=args.batch, lead=args.lead)
+    print("=== ライブチャット取り込み === (Ctrl+C で終了)")
+    try:
+        live.run(stop)
+    except KeyboardInterrupt:
+        stop.set()
+    print(f"\n[live] {stats.summary(len(q))}")
+    if live.speedctl is not None:
+        print(f"[live] 話速: {live.speedctl.stats.summary()}")
+    if get_limiter() is not None:
+        print(f"[live] ratelimit: {get_limiter().stats.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+長期記憶（過去の会話からの関連スニペット検索）
+- 埋め込みはオフライン・ローカル: 文字 2-gram / 3-gram をハッシュした TF-IDF ベクトル（NumPy）
+- 転置インデックスをセグメント単位で持ち、追加は小さなセグメントを作って大きさの近いもの同士をマージ（増分）
+- 検索はクエリの特徴量に当たる posting だけをベクトル化して集計 → コサイン類似度の上位 k 件
+- 取得したスニペットはトークン予算内で system メッセージとしてプロンプトに差し込む
+- 索引の元データは SQLite のセッションストア（kiritan_session）。logs/memory.npz に保存して次回は差分だけ索引
+
+ベンチマーク:
+  python kiritan_memory.py --bench 100000
+"""
+
+import os
+import sys
+import atexit
+import time
+import unicodedata
+from typing import Optional, List, Dict, Tuple, Set
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+from kiritan_session import SessionStore, estimate_tokens
+
+INDEX_PATH = os.path.join("logs", "memory.npz")
+DIM_BITS = 20                 # ハッシュ空間 2^20
+STOP_DF_RATIO = 0.05          # これより多くの文書に出る n-gram はクエリから外す（「です」等）
+FLUSH_EVERY = 64              # 未索引の文書がこれだけ溜まったらセグメント化
+DEFAULT_TOP_K = 3
+DEFAULT_MEMORY_TOKENS = 300   # プロンプトに差し込む記憶のトークン予算
+MIN_SCORE = 0.15
+SNIPPET_CHARS = 120
+
+if np is not None:
+    _P1, _P2, _P3 = np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(0x165667B19E3779F9)
+
+
+def _normalize(text: str) -> str:
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(t.split())
+
+
+def featurize(text: str, dim_bits: int = DIM_BITS) -> Tuple["np.ndarray", "np.ndarray"]:
+    """文字 2-gram / 3-gram をハッシュして (特徴 id, 出現回数) を返す（ベクトル化）"""
+    t = _normalize(text)
+    if not t:
+        return np.empty(0, np.int64), np.empty(0, np.float32)
+    cp = np.frombuffer(t.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(cp) == 1:
+        h = cp * _P1
+    else:
+        bi = (cp[:-1] * _P1) ^ (cp[1:] * _P2)
+        tri = (bi[:-1] * _P3) ^ (cp[2:] * _P1) ^ _P2
+        h = np.concatenate([bi, tri])
+    h ^= h >> np.uint64(31)
+    h *= _P3
+    h >>= np.uint64(64 - dim_bits)
+    feats, counts = np.unique(h.astype(np.int64), return_counts=True)
+    return feats, counts.astype(np.float32)
+
+
+class _Segment:
+    """不変の転置インデックス片（特徴でソート済みの posting 列）"""
+
+    def __init__(self, feats, docs, counts, weights):
+        self.uniq, self.starts = np.unique(feats, return_index=True)
+        self.ends = np.append(self.starts[1:], len(feats))
+        self.docs = docs
+        self.counts = counts
+        self.weights = weights
+        self.n_docs = len(np.unique(docs)) if len(docs) else 0
+
+    def triples(self):
+        feats = np.repeat(self.uniq, self.ends - self.starts)
+        return feats, self.docs, self.counts
+
+    def gather(self, qf: "np.ndarray", qw: "np.ndarray"):
+        pos = np.searchsorted(self.uniq, qf)
+        pos[pos >= len(self.uniq)] = 0
+        hit = self.uniq[pos] == qf if len(self.uniq) else np.zeros(len(qf), bool)
+        if not hit.any():
+            return None
+        s, e = self.starts[pos[hit]], self.ends[pos[hit]]
+        lens = e - s
+        total = int(lens.sum())
+        # 各範囲 [s, e) を連結した添字列をループ無しで作る
+        idx = np.repeat(s - (np.cumsum(lens) - lens), lens) + np.arange(total)
+        return self.docs[idx], self.weights[idx] * np.repeat(qw[hit], lens)
+
+
+class MemoryIndex:
+    def __init__(self, store: Optional[SessionStore] = None, dim_bits: int = DIM_BITS):
+        if np is None:
+            raise RuntimeError("numpy が必要です。`pip install numpy`")
+        self.store = store
+        self.dim_bits = dim_bits
+        self.df = np.zeros(1 << dim_bits, np.int32)
+        self.turn_ids: List[int] = []         # 文書番号 → turns.id
+        self.session_ids: List[int] = []
+        self.segments: List[_Segment] = []
+        self._pending: List[Tuple[int, "np.ndarray", "np.ndarray"]] = []
+        self.high_water = 0                   # 索引済みの最大 turns.id
+
+    def __len__(self):
+        return len(self.turn_ids)
+
+    # ---- 追加（増分） ----
+    def add(self, turn_id: int, session_id: int, text: str):
+        feats, counts = featurize(text, self.dim_bits)
+        doc = len(self.turn_ids)
+        self.turn_ids.append(turn_id)
+        self.session_ids.append(session_id)
+        self.high_water = max(self.high_water, turn_id)
+        if len(feats):
+            self.df[feats] += 1
+            self._pending.append((doc, feats, counts))
+        if len(self._pending) >= FLUSH_EVERY:
+            self.flush()
+
+    def _weights(self, feats, docs, counts):
+        n = len(self.turn_ids)
+        idf = np.log((n + 1) / (self.df[feats] + 1.0)) + 1.0
+        w = ((1.0 + np.log(counts)) * idf).astype(np.float32)
+        norms = np.sqrt(np.bincount(docs, weights=w.astype(np.float64) ** 2, minlength=n))
+        return (w / norms[docs]).astype(np.float32)
+
+    def _build(self, feats, docs, counts) -> _Segment:
+        order = np.argsort(feats, kind="stable")
+        feats, docs, counts = feats[order], docs[order], counts[order]
+        return _Segment(feats, docs, counts, self._weights(feats, docs, counts))
+
+    def flush(self):
+        """未索引分をセグメント化し、大きさの近いセグメント同士をマージ"""
+        if not self._pending:
+            return
+        feats = np.concatenate([f for _, f, _ in self._pending])
+        counts = np.concatenate([c for _, _, c in self._pending])
+        docs = np.repeat(np.array([d for d, _, _ in self._pending], np.int64),
+                         [len(f) for _, f, _ in self._pending])
+        self._pending = []
+        self.segments.append(self._build(feats, docs, counts))
+        while len(self.segments) > 1 and self.segments[-2].n_docs <= 2 * self.segments[-1].n_docs:
+            b = self.segments.pop()
+            a = self.segments.pop()
+            fa, da, ca = a.triples()
+            fb, db, cb = b.triples()
+            self.segments.append(self._build(np.concatenate([fa, fb]), np.concatenate([da, db]),
+                                             np.concatenate([ca, cb])))
+
+    def sync(self, batch: int = 2000) -> int:
+        """セッションストアから high_water より新しいターンを取り込む"""
+        if self.store is None:
+            return 0
+        n = 0
+        while True:
+            rows = self.store.turns_after(self.high_water, batch)
+            if not rows:
+                break
+            for tid, sid, role, content in rows:
+                self.add(tid, sid, content)
+                n += 1
+        self.flush()
+        return n
+
+    # ---- 検索 ----
+    def search(self, query: str, k: int = DEFAULT_TOP_K,
+               exclude: Optional[Set[int]] = None) -> List[Tuple[int, float]]:
+        """(turn_id, cosine) を類似度順に返す。exclude は除外する turns.id"""
+        self.flush()
+        n = len(self.turn_ids)
+        qf, qc = featurize(query, self.dim_bits)
+        if not n or not len(qf):
+            return []
+        df = self.df[qf]
+        keep = (df > 0) & (df <= max(1, STOP_DF_RATIO * n))
+        if not keep.any():
+            keep = df > 0
+        if not keep.any():
+            return []
+        qf, qc, df = qf[keep], qc[keep], df[keep]
+        qw = (1.0 + np.log(qc)) * (np.log((n + 1) / (df + 1.0)) + 1.0)
+        qw = (qw / np.linalg.norm(qw)).astype(np.float32)
+
+        ids, ws = [], []
+        for seg in self.segments:
+            got = seg.gather(qf, qw)
+            if got is not None:
+                ids.append(got[0])
+                ws.append(got[1])
+        if not ids:
+            return []
+        ids, ws = np.concatenate(ids), np.concatenate(ws)
+        if len(ids) * 8 < n:
+            # 候補が少ないときは候補だけで集計（全文書長の配列を作らない）
+            cand, inv = np.unique(ids, return_inverse=True)
+            scores = np.bincount(inv, weights=ws)
+        else:
+            scores = np.bincount(ids, weights=ws)
+            cand = np.arange(len(scores))
+        want = min(len(scores), k + (len(exclude) if exclude else 0))
+        top = np.argpartition(scores, len(scores) - want)[len(scores) - want:]
+        top = top[np.argsort(-scores[top])]
+        out = []
+        for j in top:
+            tid = self.turn_ids[cand[j]]
+            if scores[j] <= 0 or (exclude and tid in exclude):
+                continue
+            out.append((tid, float(scores[j])))
+            if len(out) >= k:
+                break
+        return out
+
+    def context(self, query: str, exclude: Optional[Set[int]] = None,
+                k: int = DEFAULT_TOP_K, token_budget: int = DEFAULT_MEMORY_TOKENS) -> Optional[str]:
+        """プロンプトに差し込む記憶メモ（該当なしなら None）"""
+        hits = [(t, s) for t, s in self.search(query, k, exclude) if s >= MIN_SCORE]
+        if not hits or self.store is None:
+            return None
+        rows = {tid: (role, content) for tid, role, content in self.store.get_turns([t for t, _ in hits])}
+        lines, used, seen = [], 0, set()
+        for tid, _ in hits:
+            if tid not in rows or rows[tid][1] in seen:
+                continue
+            role, content = rows[tid]
+            seen.add(content)
+            snippet = content if len(content) <= SNIPPET_CHARS else content[:SNIPPET_CHARS] + "…"
+            line = f"- {'ユーザ' if role == 'user' else 'あなた'}: {snippet}"
+            cost = estimate_tokens(line)
+            if used + cost > token_budget:
+                break
+            lines.append(line)
+            used += cost
+        if not lines:
+            return None
+        return "参考: 以前の会話で出た内容（必要なときだけ自然に踏まえてください）\n" + "\n".join(lines)
+
+    def inject(self, messages: List[Dict[str, str]], query: str,
+               exclude: Optional[Set[int]] = None) -> List[Dict[str, str]]:
+        """messages（直近の窓）の system の直後に記憶メモを差し込んだ新しいリストを返す"""
+        memo = self.context(query, exclude)
+        if not memo:
+            return messages
+        at = 1 if messages and messages[0]["role"] == "system" else 0
+        return messages[:at] + [{"role": "system", "content": memo}] + messages[at:]
+
+    # ---- 保存 / 読み込み ----
+    def save(self, path: str = INDEX_PATH):
+        self.flush()
+        arrays = {
+            "meta": np.array([self.dim_bits, self.high_water, len(self.segments)], np.int64),
+            "df": self.df,
+            "turn_ids": np.array(self.turn_ids, np.int64),
+            "session_ids": np.array(self.session_ids, np.int64),
+        }
+        for i, seg in enumerate(self.segments):
+            f, d, c = seg.triples()
+            arrays[f"s{i}_f"], arrays[f"s{i}_d"], arrays[f"s{i}_c"] = f, d, c
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def open(cls, store: SessionStore, path: str = INDEX_PATH) -> "MemoryIndex":
+        """保存済みの索引を読み、ストアの差分だけ追加で索引する"""
+        idx = None
+        if os.path.exists(path):
+            try:
+                z = np.load(path)
+                dim_bits, high_water, nseg = (int(x) for x in z["meta"])
+                idx = cls(store, dim_bits)
+                idx.df = z["df"]
+                idx.turn_ids = z["turn_ids"].tolist()
+                idx.session_ids = z["session_ids"].tolist()
+                idx.high_water = high_water
+                for i in range(nseg):
+                    idx.segments.append(idx._build(z[f"s{i}_f"], z[f"s{i}_d"], z[f"s{i}_c"]))
+            except Exception as e:
+                print(f"[memory] 索引の読み込みに失敗（作り直します）: {e}", file=sys.stderr)
+                idx = None
+        if idx is None:
+            idx = cls(store)
+        idx.sync()
+        return idx
+
+
+def open_memory(store: SessionStore) -> Optional[MemoryIndex]:
+    """GUI 版から使う入口。numpy が無い / KIRITAN_MEMORY=0 なら None"""
+    if np is None or (os.getenv("KIRITAN_MEMORY") or "").strip() in ("0", "off"):
+        return None
+    try:
+        t0 = time.perf_counter()
+        mem = MemoryIndex.open(store)
+        atexit.register(mem.save)
+        print(f"[memory] 長期記憶 {len(mem)} 件を読み込み（{(time.perf_counter() - t0) * 1000:.0f}ms）")
+        return mem
+    except Exception as e:
+        print(f"[memory] 無効化します: {e}", file=sys.stderr)
+        return None
+
+
+# ---------------- ベンチマーク ----------------
+def _bench(n: int):
+    import random
+    rnd = random.Random(0)
+    # 会話っぽい語彙: かな/漢字を組み合わせた 3000 語 + 定型の語尾
+    chars = [chr(c) for c in range(0x3041, 0x3094)] + [chr(c) for c in range(0x4E00, 0x4E00 + 800)]
+    words = ["".join(rnd.choice(chars) for _ in range(rnd.randint(2, 4))) for _ in range(3000)]
+    tails = ["が好きです。", "について話そう。", "はどうだった？", "に行きたいな。", "って難しいよね。"]
+    idx = MemoryIndex()
+    t0 = time.perf_counter()
+    for i in range(n):
+        text = "".join(rnd.choice(words) + rnd.choice(tails) for _ in range(rnd.randint(1, 4)))
+        idx.add(i + 1, 1, text)
+    idx.flush()
+    build = time.perf_counter() - t0
+    queries = [words[i] + "と" + words[i + 1] + "の話をしたよね" for i in range(0, 40, 2)]
+    for q in queries:
+        idx.search(q)
+    lat = []
+    for i in range(200):
+        t = time.perf_counter()
+        idx.search(queries[i % len(queries)])
+        lat.append((time.perf_counter() - t) * 1000)
+    lat.sort()
+    print(f"[bench] {n} 件: 索引 {build:.1f}s（{len(idx.segments)} セグメント）"
+          f" / 検索 p50 {lat[len(lat) // 2]:.3f}ms p95 {lat[int(len(lat) * 0.95)]:.3f}ms")
+
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser(prog="kiritan_memory")
+    p.add_argument("--bench", type=int, default=0, help="合成データ N 件で索引/検索速度を測る")
+    p.add_argument("--rebuild", action="store_true", help="セッションストアから索引を作り直す")
+    args = p.parse_args()
+    if args.bench:
+        _bench(args.bench)
+    elif args.rebuild:
+        store = SessionStore()
+        mem = MemoryIndex(store)
+        print(f"[memory] {mem.sync()} 件を索引しました。")
+        mem.save()
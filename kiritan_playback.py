@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+"""
+ギャップレス再生エンジン（in-process）
+- 常駐させた sounddevice.OutputStream に、デコード済み PCM バッファのキューを流し込む
+- 次の N セグメントを先読みレンダリング（SeikaSay2 -save → WAV）し、再生中の音声へ隙間なく連結
+- セグメントごとの再生開始/終了イベントを、DAC 出力時刻ベースで通知（on_start / on_finish）
+- 複数文の返答は文単位に分割して、1 本の連続ストリームとして再生
+- sounddevice / numpy が無い環境では winsound で 1 セグメントずつ再生（ギャップあり。winsound も無ければ長さだけ待つ）
+- KIRITAN_TIMESTRETCH=1 なら基準話速で合成・キャッシュし、話速はデコード後の伸縮（WSOLA）で付ける
+- KIRITAN_POSTPROC=1 ならレンダリングのワーカーで無音カット・ラウドネス正規化し（結果はキャッシュの隣に保存）、
+  文のつなぎ目は短くクロスフェードする
+
+使い方:
+  engine = PlaybackEngine(seika_save, lookahead=2)
+  engine.on_start.append(lambda seg: print("start", seg.text))
+  engine.speak("こんにちは。今日はいい天気ですね！", cid=1707, speed=1.0)
+  engine.wait()
+"""
+
+import os
+import re
+import sys
+import time
+import wave
+import queue
+import hashlib
+import itertools
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Callable, Tuple
+
+from kiritan_timestretch import time_stretch, enabled as stretch_enabled, STRETCH_BASE
+from kiritan_postproc import PostProcessor, open_postproc, crossfade
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+try:
+    import sounddevice as sd
+except Exception:
+    sd = None
+
+try:
+    import soundfile as sf
+except Exception:
+    sf = None
+
+
+# ---------------- 設定 ----------------
+DEFAULT_SEIKA_EXE = (
+    r"C:\Users\takum\Downloads\assistantseika20250113a\SeikaSay2\SeikaSay2.exe"
+)
+RENDER_CACHE_DIR = os.path.join("cache", "render")
+RENDER_CACHE_MAX = 500        # これを超えたら古い順に削除
+DEFAULT_LOOKAHEAD = 2         # 再生中のセグメントに加えて何本先までレンダリングするか
+BLOCKSIZE = 512
+
+# 文末（。！？ 等）で区切る。閉じ括弧は前の文に含める
+SENTENCE_RE = re.compile(r"[^。！？!?♪\n]*[。！？!?♪]+[」』）)]*|[^。！？!?♪\n]+")
+
+RenderFn = Callable[[str, int, float, str], bool]
+
+
+# ---------------- ユーティリティ ----------------
+def seika_exe_path() -> str:
+    p = os.getenv("SEIKA_EXE") or DEFAULT_SEIKA_EXE
+    if not os.path.exists(p):
+        raise FileNotFoundError(
+            f"SeikaSay2.exe が見つかりません: {p}\n"
+            "環境変数 SEIKA_EXE で正しいパスを指定してください。"
+        )
+    return p
+
+
+def seika_save(text: str, cid: int, speed: float, path: str) -> bool:
+    """SeikaSay2 -save で path に WAV を書き出す"""
+    cmd = [seika_exe_path(), "-cid", str(cid), "-speed", f"{float(speed):.2f}",
+           "-save", path, "-nc", "-t", text]
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0), check=False)
+    return os.path.exists(path) and os.path.getsize(path) > 44
+
+
+def split_sentences(text: str, min_chars: int = 6) -> List[str]:
+    """文単位に分割。短すぎる断片（「うん。」等）は直前の文に寄せる"""
+    out: List[str] = []
+    for m in SENTENCE_RE.finditer(text or ""):
+        s = m.group(0).strip()
+        if not s:
+            continue
+        if out and len(s) < min_chars:
+            out[-1] += s
+        else:
+            out.append(s)
+    return out
+
+
+class SentenceStream:
+    """ストリーミングの delta から、文末が確定した文を順に取り出す（閉じ括弧は次の 1 文字を見て確定）"""
+    END_RE = re.compile(r"[。！？!?♪\n]+[」』）)]*")
+
+    def __init__(self):
+        self.buf = ""
+        self.fed = ""             # feed された全文
+        self.consumed = 0         # そのうち文として取り出し済みの文字数
+
+    def feed(self, delta: str) -> List[str]:
+        self.buf += delta
+        self.fed += delta
+        out: List[str] = []
+        while True:
+            m = self.END_RE.search(self.buf)
+            if not m or m.end() == len(self.buf):
+                return out
+            s = self.buf[:m.end()].strip()
+            self.buf = self.buf[m.end():]
+            self.consumed += m.end()
+            if s:
+                out.append(s)
+
+    def flush(self) -> List[str]:
+        s, self.buf = self.buf.strip(), ""
+        self.consumed = len(self.fed)
+        return [s] if s else []
+
+    def rest(self, text: str) -> List[str]:
+        """
+        打ち切った最終テキスト text（feed した全文を strip して切り詰めたもの）のうち、まだ取り出していない
+        部分を同じ規則で文にする（抱えていた最後の文や、予算で読点の所まで切った文）
+        """
+        lead = len(self.fed) - len(self.fed.lstrip())
+        self.buf = ""
+        out = self.feed(text[max(0, self.consumed - lead):])
+        return out + self.flush()
+
+
+def cache_key(text: str, cid: int, speed: float) -> str:
+    return hashlib.sha1(f"{cid}|{float(speed):.2f}|{text}".encode("utf-8")).hexdigest()
+
+
+def render_cached(render: RenderFn, text: str, cid: int, speed: float,
+                  cache_dir: str = RENDER_CACHE_DIR) -> Optional[str]:
+    """レンダリング結果を cache_dir に保存して再利用する（失敗時 None）"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, cache_key(text, cid, speed) + ".wav")
+    if os.path.exists(path):
+        return path
+    tmp = path + f".{threading.get_ident()}.tmp.wav"
+    try:
+        if not render(text, cid, speed, tmp):
+            return None
+        os.replace(tmp, path)
+        return path
+    finally:
+        if os.path.exists(tmp):
+            try:
+                os.remove(tmp)
+            except Exception:
+                pass
+
+
+def prune_cache(cache_dir: str = RENDER_CACHE_DIR, keep: int = RENDER_CACHE_MAX):
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return
+    # 後処理の結果（<キー>.pp-*.wav）は元のレンダリングと一緒に消す
+    files = [os.path.join(cache_dir, f) for f in names if f.endswith(".wav") and ".pp-" not in f]
+    if len(files) <= keep:
+        return
+    files.sort(key=os.path.getmtime)
+    doomed = {os.path.basename(f)[:-4] for f in files[:len(files) - keep]}
+    for f in names:
+        if f.endswith(".wav") and f.split(".", 1)[0] in doomed:
+            try:
+                os.remove(os.path.join(cache_dir, f))
+            except Exception:
+                pass
+
+
+def decode_wav(path: str) -> Tuple["np.ndarray", int]:
+    """WAV を mono float32 にデコード（soundfile が無ければ wave + numpy）"""
+    if sf is not None:
+        data, fs = sf.read(path, dtype="float32", always_2d=True)
+        return data.mean(axis=1).astype(np.float32), int(fs)
+    with wave.open(path, "rb") as w:
+        fs, ch, width = w.getframerate(), w.getnchannels(), w.getsampwidth()
+        raw = w.readframes(w.getnframes())
+    if width == 2:
+        a = np.frombuffer(raw, "<i2").astype(np.float32) / 32768.0
+    elif width == 4:
+        a = np.frombuffer(raw, "<i4").astype(np.float32) / 2147483648.0
+    elif width == 1:
+        a = (np.frombuffer(raw, np.uint8).astype(np.float32) - 128.0) / 128.0
+    else:
+        raise ValueError(f"未対応の WAV 形式です（sampwidth={width}）: {path}")
+    return a.reshape(-1, ch).mean(axis=1), fs
+
+
+def resample(pcm: "np.ndarray", src: int, dst: int) -> "np.ndarray":
+    """線形補間でリサンプル（声の再生用途なら十分）"""
+    if src == dst or len(pcm) == 0:
+        return pcm
+    n = int(round(len(pcm) * dst / src))
+    x = np.linspace(0.0, len(pcm) - 1, n, dtype=np.float64)
+    return np.interp(x, np.arange(len(pcm)), pcm).astype(np.float32)
+
+
+# ---------------- セグメント ----------------
+class Segment:
+    """再生単位（1 文）。started / finished は再生開始/終了で set される"""
+    _ids = itertools.count(1)
+
+    def __init__(self, text: str, cid: int, speed: float, group=None):
+        self.id = next(Segment._ids)
+        self.text = text
+        self.cid = cid
+        self.speed = speed
+        self.group = group            # 呼び出し側の任意タグ（ターン等）
+        self.path: Optional[str] = None
+        self.pcm = None
+        self.fs = 0
+        self.error: Optional[str] = None
+        self.gen = 0
+        self.enqueued = False
+        self.queued_at = time.time()
+        self.rendered_at: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+
+    @property
+    def duration(self) -> float:
+        return len(self.pcm) / self.fs if (self.pcm is not None and self.fs) else 0.0
+
+    def __repr__(self):
+        return f"<Segment #{self.id} {self.text[:16]!r}>"
+
+
+# ---------------- 再生エンジン ----------------
+class PlaybackEngine:
+    def __init__(self, render: RenderFn = seika_save, lookahead: int = DEFAULT_LOOKAHEAD,
+                 samplerate: int = 0, channels: int = 1, cache_dir: Optional[str] = RENDER_CACHE_DIR,
+                 stretch: Optional[bool] = None, post: Optional[PostProcessor] = None):
+        self.render = render
+        self.lookahead = max(1, int(lookahead))
+        self.samplerate = samplerate      # 0 = 最初のセグメントに合わせる
+        self.channels = channels
+        self.cache_dir = cache_dir
+        self.gapless = sd is not None and np is not None
+        # 話速を合成に渡さず伸縮で付ける（キャッシュは基準話速の 1 本で済む）。PCM を持つ gapless 再生のときだけ効く
+        self.stretch = stretch_enabled() if stretch is None else stretch
+        self.post = post or open_postproc()
+
+        self.on_start: List[Callable[[Segment], None]] = []
+        self.on_finish: List[Callable[[Segment], None]] = []
+
+        self._gen = 0
+        self._pending: "queue.Queue[Segment]" = queue.Queue()
+        self._ordered: "queue.Queue[Tuple[Segment, object]]" = queue.Queue()
+        self._events: "queue.Queue[Tuple[str, Segment, float]]" = queue.Queue()
+        # 再生中 1 本 + 先読み N 本
+        self._slots = threading.Semaphore(self.lookahead + 1)
+        self._pool = ThreadPoolExecutor(max_workers=self.lookahead, thread_name_prefix="render")
+
+        self._lock = threading.Lock()
+        self._play: deque = deque()       # [Segment, 再生位置]
+        self._stream = None
+        self._outstanding = 0             # 投入済みで未終了のセグメント数
+        self._unqueued = 0                # 投入済みでまだ PCM が再生キューに入っていない数
+        self._idle = threading.Condition()
+        self._closed = False
+
+        self.underrun_s = 0.0             # 後続があるのにバッファが尽きた時間（= 文間の隙間）
+
+        if cache_dir:
+            prune_cache(cache_dir)
+        for target in (self._dispatch_loop, self._feed_loop, self._event_loop):
+            threading.Thread(target=target, daemon=True).start()
+
+    # ---- 投入 ----
+    def submit(self, text: str, cid: int, speed: float = 1.0, group=None) -> Segment:
+        seg = Segment(text, cid, speed, group)
+        seg.gen = self._gen
+        with self._idle:
+            self._outstanding += 1
+        with self._lock:
+            self._unqueued += 1
+        self._pending.put(seg)
+        return seg
+
+    def speak(self, text: str, cid: int, speed: float = 1.0, group=None) -> List[Segment]:
+        """文単位に分割して投入（連続ストリームとして再生される）"""
+        return [self.submit(s, cid, speed, group) for s in split_sentences(text)]
+
+    def wait(self, seg: Optional[Segment] = None, timeout: Optional[float] = None) -> bool:
+        """seg 指定時はその終了まで、未指定なら全セグメントの終了まで待つ"""
+        if seg is not None:
+            return seg.finished.wait(timeout)
+        with self._idle:
+            return self._idle.wait_for(lambda: self._outstanding == 0, timeout)
+
+    def cancel(self):
+        """未再生分を破棄し、再生中のセグメントも止める"""
+        self._gen += 1
+        while True:
+            try:
+                self._done(self._pending.get_nowait(), error="cancelled", release=False)
+            except queue.Empty:
+                break
+        with self._lock:
+            dropped = list(self._play)
+            self._play.clear()
+        for seg, _ in dropped:
+            self._done(seg, error="cancelled")
+
+    def backlog_seconds(self, match: Optional[Callable[[Segment], bool]] = None) -> float:
+        """デコード済みで未再生の音声の長さ（秒）。match を渡せばそれに当てはまるセグメントだけ"""
+        with self._lock:
+            return sum((len(s.pcm) - pos) / s.fs for s, pos in self._play
+                       if s.fs and (match is None or match(s)))
+
+    def close(self):
+        self.cancel()
+        self._closed = True
+        self._pending.put(None)
+        self._pool.shutdown(wait=False)
+        if self._stream is not None:
+            try:
+                self._stream.stop()
+                self._stream.close()
+            except Exception:
+                pass
+            self._stream = None
+
+    # ---- 内部: レンダリング ----
+    def _render(self, seg: Segment):
+        if seg.gen != self._gen:
+            return
+        speed = STRETCH_BASE if (self.stretch and self.gapless) else seg.speed
+        if self.cache_dir:
+            seg.path = render_cached(self.render, seg.text, seg.cid, speed, self.cache_dir)
+        else:
+            import tempfile
+            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
+            tmp.close()
+            seg.path = tmp.name if self.render(seg.text, seg.cid, speed, tmp.name) else None
+        if not seg.path:
+            seg.error = "render failed"
+            return
+        if self.post is not None:
+            seg.path = self.post.apply_file(seg.path, cache=bool(self.cache_dir))
+        if self.gapless:
+            pcm, fs = decode_wav(seg.path)
+            if speed != seg.speed:
+                pcm = time_stretch(pcm, fs, seg.speed / speed)
+            seg.pcm, seg.fs = pcm, fs
+        seg.rendered_at = time.time()
+
+    def _dispatch_loop(self):
+        # 投入順にスロットを確保してレンダリングを開始（N 本先まで）
+        while True:
+            seg = self._pending.get()
+            if seg is None:
+                return
+            self._slots.acquire()
+            if seg.gen != self._gen:
+                self._done(seg, error="cancelled")
+                continue
+            self._ordered.put((seg, self._pool.submit(self._render, seg)))
+
+    def _feed_loop(self):
+        # レンダリング完了を投入順に待ち、再生キューへ連結する
+        while True:
+            seg, fut = self._ordered.get()
+            try:
+                fut.result()
+            except Exception as e:
+                seg.error = f"render error: {e}"
+            if seg.error or seg.gen != self._gen:
+                if seg.error:
+                    print(f"[playback] {seg.error}: {seg.text[:20]}", file=sys.stderr)
+                self._done(seg, error=seg.error or "cancelled")
+                continue
+            if self.gapless:
+                self._enqueue_pcm(seg)
+            else:
+                self._play_blocking(seg)
+
+    def _enqueue_pcm(self, seg: Segment):
+        if self._stream is None:
+            self._open_stream(seg.fs)
+        if seg.fs != self._stream_fs:
+            seg.pcm = resample(seg.pcm, seg.fs, self._stream_fs)
+            seg.fs = self._stream_fs
+        xf = int(self.post.xfade * seg.fs) if self.post is not None else 0
+        with self._lock:
+            if xf and self._play and len(seg.pcm) > 2 * xf:
+                prev, pos = self._play[-1]
+                # 前の文の末尾がまだ出力されていなければ、次の文の頭を重ねてつなぐ
+                if len(prev.pcm) - pos > xf:
+                    seg.pcm = crossfade(prev.pcm, seg.pcm, xf)
+                    with self.post.stats.lock:
+                        self.post.stats.crossfades += 1
+            self._play.append([seg, 0])
+            self._unqueued -= 1
+        seg.enqueued = True
+
+    def _play_blocking(self, seg: Segment):
+        # sounddevice が無いときの保険（セグメント間に隙間が出る）
+        with self._lock:
+            self._unqueued -= 1
+        seg.enqueued = True
+        self._events.put(("start", seg, time.time()))
+        try:
+            import winsound
+        except ImportError:
+            winsound = None
+        try:
+            if winsound is not None:
+                winsound.PlaySound(seg.path, winsound.SND_FILENAME)
+            else:
+                # 音が出せない環境（ヘッドレス）では長さだけ待つ
+                with wave.open(seg.path, "rb") as w:
+                    time.sleep(w.getnframes() / float(w.getframerate()))
+        except Exception as e:
+            print(f"[playback] 再生失敗: {e}", file=sys.stderr)
+        self._events.put(("finish", seg, time.time()))
+
+    # ---- 内部: 出力ストリーム ----
+    def _open_stream(self, fs: int):
+        self._stream_fs = int(self.samplerate or fs)
+        self._stream = sd.OutputStream(samplerate=self._stream_fs, channels=self.channels,
+                                       dtype="float32", blocksize=BLOCKSIZE, callback=self._callback)
+        self._stream.start()
+
+    def _callback(self, outdata, frames, t, status):
+        fs = self._stream_fs
+        # このバッファの先頭サンプルが DAC から出る時刻（wall clock）
+        base = time.time() + max(0.0, t.outputBufferDacTime - t.currentTime)
+        filled = 0
+        with self._lock:
+            while filled < frames and self._play:
+                item = self._play[0]
+                seg, pos = item
+                if pos == 0:
+                    self._events.put(("start", seg, base + filled / fs))
+                n = min(frames - filled, len(seg.pcm) - pos)
+                outdata[filled:filled + n] = seg.pcm[pos:pos + n, None]
+                filled += n
+                item[1] = pos + n
+                if item[1] >= len(seg.pcm):
+                    self._play.popleft()
+                    self._events.put(("finish", seg, base + filled / fs))
+            starving = self._unqueued > 0
+        if filled < frames:
+            outdata[filled:] = 0
+            if starving:
+                # 後続セグメントがあるのに PCM が間に合っていない
+                self.underrun_s += (frames - filled) / fs
+
+    # ---- 内部: イベント ----
+    def _event_loop(self):
+        while True:
+            kind, seg, at = self._events.get()
+            delay = at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if kind == "start":
+                seg.started_at = at
+                seg.started.set()
+                self._fire(self.on_start, seg)
+            else:
+                seg.finished_at = at
+                self._done(seg)
+
+    def _done(self, seg: Segment, error: Optional[str] = None, release: bool = True):
+        if seg.finished.is_set():
+            return
+        if error:
+            seg.error = error
+            seg.started.set()
+        if not seg.enqueued:
+            with self._lock:
+                self._unqueued -= 1
+        if not self.cache_dir and seg.path:
+            try:
+                os.remove(seg.path)
+            except Exception:
+                pass
+        seg.finished.set()
+        if release:
+            self._slots.release()
+        self._fire(self.on_finish, seg)
+        with self._idle:
+            self._outstanding -= 1
+            if self._outstanding <= 0:
+                self._outstanding = 0
+                self._idle.notify_all()
+
+    @staticmethod
+    def _fire(callbacks, seg: Segment):
+        for cb in list(callbacks):
+            try:
+                cb(seg)
+            except Exception as e:
+                print(f"[playback] callback error: {e}", file=sys.stderr)
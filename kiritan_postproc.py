@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+レンダリング後の音声の後処理（無音の切り詰め・ラウドネスの正規化・つなぎ目のクロスフェード）
+- 合成した WAV は前後に無音が付いていて、そのぶん話し始めが遅れ、文と文の間も空く。
+  また cid やセッションによって音量がばらつく
+- 切り詰め: 10ms ごとの RMS が閾値（既定 -50 dBFS）を超える最初と最後のフレームを探し、
+  前 LEAD 秒・後ろ TAIL 秒だけ余白を残して切る（後ろは息の減衰を切らないよう少し長め）
+- 正規化: EBU R128（ITU-R BS.1770）のラウドネス。K 特性（高域シェルフ + 高域通過の 2 段）は
+  FFT 上で振幅特性を掛けて当て、400ms ブロック / 75% 重ねで平均二乗を出し、
+  絶対ゲート（-70 LUFS）と相対ゲート（-10 LU）を通したブロックで測る。目標（既定 -20 LUFS）に
+  合わせつつ、サンプルピークが -1 dBFS を超えない範囲にゲインを抑える
+- クロスフェード: PlaybackEngine が文をつなぐとき、前の文の末尾と次の文の先頭を XFADE 秒だけ
+  等パワーで重ねる（前の文のその部分がまだ再生されていないときだけ）
+- 処理はレンダリング用のワーカースレッド（先読み）で行い、結果はレンダリングのキャッシュの隣に
+  `<キー>.pp-<設定のハッシュ>.wav` として保存して再利用する（設定を変えれば作り直し）
+
+使い方:
+  post = open_postproc()                       # 無効なら None
+  path = post.apply_file(render_path, cache=True)
+  y, report = post.process(pcm, fs)
+
+設定（環境変数）:
+  KIRITAN_POSTPROC=1                          … 既定値で有効
+  KIRITAN_POSTPROC=trim=-50,lufs=-20,xfade=10 … 切り詰めの閾値 dBFS / 目標 LUFS / クロスフェード ms
+                                                （trim=off / lufs=off / xfade=0 でその処理だけ無効）
+  未設定 / 0                                  … 無効（既定）
+"""
+
+import os
+import sys
+import time
+import wave
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Optional, Tuple, Dict
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+TRIM_DBFS = -50.0             # これより小さいフレームを無音とみなす
+TRIM_FRAME = 0.01
+LEAD = 0.02                   # 切り詰め後に前へ残す余白（秒）
+TAIL = 0.08                   # 後ろへ残す余白（秒）
+TARGET_LUFS = -20.0
+PEAK_DBFS = -1.0
+MAX_GAIN_DB = 20.0
+XFADE = 0.01
+BLOCK = 0.4                   # BS.1770 のゲーティングブロック
+BLOCK_STEP = 0.1              # 75% 重ね
+ABS_GATE = -70.0
+REL_GATE = -10.0
+
+
+# ---------------- K 特性 ----------------
+def _k_weighting(fs: int):
+    """BS.1770 の 2 段の biquad 係数（48kHz の規定値を任意のサンプリング周波数へ双一次変換で作り直す）"""
+    # 1 段目: 頭部の影響を模した高域シェルフ（+4 dB）
+    f0, g, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = np.tan(np.pi * f0 / fs)
+    vh = 10 ** (g / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+             [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    # 2 段目: 低域を落とす高域通過（RLB）
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = np.tan(np.pi * f0 / fs)
+    a0 = 1 + k / q + k * k
+    rlb = ([1.0, -2.0, 1.0], [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return shelf, rlb
+
+
+def _k_response(n: int, fs: int) -> "np.ndarray":
+    """長さ n の rfft の各ビンでの K 特性の振幅"""
+    z = np.exp(-1j * 2 * np.pi * np.fft.rfftfreq(n, 1.0 / fs) / fs)
+    h = np.ones(len(z))
+    for b, a in _k_weighting(fs):
+        h = h * np.abs((b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z))
+    return h
+
+
+def loudness(pcm: "np.ndarray", fs: int) -> float:
+    """ゲート付きラウドネス（LUFS、mono）。無音なら -inf"""
+    x = np.asarray(pcm, dtype=np.float64).reshape(-1)
+    if len(x) == 0:
+        return float("-inf")
+    # IIR の尾が巡回しないよう少し足してから周波数領域で K 特性を当てる（パワーだけ見るので振幅特性で十分）
+    n = len(x) + int(fs * 0.1)
+    y = np.fft.irfft(np.fft.rfft(x, n) * _k_response(n, fs), n)[:len(x)]
+    sq = np.concatenate([[0.0], np.cumsum(y * y)])
+    blk, step = int(fs * BLOCK), int(fs * BLOCK_STEP)
+    if len(x) < blk:
+        z = np.array([sq[-1] / len(x)])
+    else:
+        starts = np.arange(0, len(x) - blk + 1, step)
+        z = (sq[starts + blk] - sq[starts]) / blk
+    with np.errstate(divide="ignore"):
+        lk = -0.691 + 10 * np.log10(z)
+    z = z[lk > ABS_GATE]
+    if len(z) == 0:
+        return float("-inf")
+    rel = -0.691 + 10 * np.log10(z.mean()) + REL_GATE
+    with np.errstate(divide="ignore"):
+        z = z[-0.691 + 10 * np.log10(z) > rel]
+    return float(-0.691 + 10 * np.log10(z.mean()))
+
+
+def silence_bounds(pcm: "np.ndarray", fs: int, threshold_db: float) -> Tuple[int, int]:
+    """閾値を超える最初のフレームの先頭と、最後のフレームの末尾（サンプル位置）。全部無音なら (0, 0)"""
+    n = max(1, int(fs * TRIM_FRAME))
+    frames = len(pcm) // n
+    if frames == 0:
+        return 0, len(pcm)
+    body = np.asarray(pcm[:frames * n], dtype=np.float32).reshape(frames, n)
+    rms = np.sqrt(np.mean(body * body, axis=1) + 1e-12)
+    loud = np.flatnonzero(20 * np.log10(rms) > threshold_db)
+    if len(loud) == 0:
+        return 0, 0
+    end = len(pcm) if loud[-1] == frames - 1 else (loud[-1] + 1) * n
+    return int(loud[0] * n), int(end)
+
+
+def crossfade(prev: "np.ndarray", nxt: "np.ndarray", n: int) -> "np.ndarray":
+    """prev の末尾 n サンプルに nxt の先頭を等パワーで重ねる（prev はその場で書き換え）。残りの nxt を返す"""
+    t = (np.arange(n, dtype=np.float32) + 0.5) / n * (np.pi / 2)
+    prev[-n:] = prev[-n:] * np.cos(t) + nxt[:n] * np.sin(t)
+    return nxt[n:]
+
+
+# ---------------- 統計 ----------------
+class PostStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segments = 0
+        self.cached = 0
+        self.trimmed_lead = 0.0   # 切った前の無音（秒）
+        self.trimmed_tail = 0.0
+        self.gain_db = 0.0        # 掛けたゲインの合計（平均の表示用）
+        self.limited = 0          # ピークで目標まで上げられなかった数
+        self.crossfades = 0
+        self.cpu_s = 0.0
+
+    def summary(self) -> str:
+        with self.lock:
+            n = max(1, self.segments)
+            return (f"処理 {self.segments} 文（キャッシュ {self.cached}）/ 無音カット 前 {self.trimmed_lead:.1f}s"
+                    f"・後 {self.trimmed_tail:.1f}s / ゲイン平均 {self.gain_db / n:+.1f}dB（ピーク制限 {self.limited}）"
+                    f" / クロスフェード {self.crossfades} / CPU {self.cpu_s * 1000:.0f}ms")
+
+
+# ---------------- 本体 ----------------
+@dataclass
+class PostConfig:
+    trim_db: Optional[float] = TRIM_DBFS      # None = 切り詰めない
+    target_lufs: Optional[float] = TARGET_LUFS  # None = 正規化しない
+    xfade: float = XFADE
+
+    def tag(self) -> str:
+        return hashlib.sha1(f"{self.trim_db}|{self.target_lufs}|{LEAD}|{TAIL}|{PEAK_DBFS}".encode()).hexdigest()[:8]
+
+
+class PostProcessor:
+    def __init__(self, config: Optional[PostConfig] = None):
+        self.config = config or PostConfig()
+        self.stats = PostStats()
+
+    @property
+    def xfade(self) -> float:
+        return self.config.xfade
+
+    def process(self, pcm: "np.ndarray", fs: int) -> Tuple["np.ndarray", Dict]:
+        cfg = self.config
+        x = np.asarray(pcm, dtype=np.float32).reshape(-1)
+        report = {"lead": 0.0, "tail": 0.0, "gain_db": 0.0, "limited": False}
+        if cfg.trim_db is not None and len(x):
+            start, end = silence_bounds(x, fs, cfg.trim_db)
+            if end > start:
+                start = max(0, start - int(fs * LEAD))
+                end = min(len(x), end + int(fs * TAIL))
+                report["lead"], report["tail"] = start / fs, (len(x) - end) / fs
+                x = x[start:end]
+        if cfg.target_lufs is not None and len(x):
+            lufs = loudness(x, fs)
+            peak = float(np.max(np.abs(x)))
+            if np.isfinite(lufs) and peak > 0:
+                gain = max(-MAX_GAIN_DB, min(MAX_GAIN_DB, cfg.target_lufs - lufs))
+                ceiling = PEAK_DBFS - 20 * np.log10(peak)
+                if gain > ceiling:
+                    gain, report["limited"] = ceiling, True
+                report["gain_db"] = float(gain)
+                x = x * np.float32(10 ** (gain / 20))
+        return x, report
+
+    def apply_file(self, path: str, cache: bool = True) -> str:
+        """WAV を後処理する。cache なら隣に保存して再利用（元の WAV はそのまま）、でなければ上書き"""
+        out = f"{os.path.splitext(path)[0]}.pp-{self.config.tag()}.wav" if cache else path
+        if cache and os.path.exists(out):
+            with self.stats.lock:
+                self.stats.cached += 1
+            return out
+        from kiritan_playback import decode_wav
+        t0 = time.process_time()
+        pcm, fs = decode_wav(path)
+        y, rep = self.process(pcm, fs)
+        tmp = out + f".{threading.get_ident()}.tmp"
+        with wave.open(tmp, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(fs)
+            w.writeframes((np.clip(y, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+        os.replace(tmp, out)
+        with self.stats.lock:
+            self.stats.segments += 1
+            self.stats.trimmed_lead += rep["lead"]
+            self.stats.trimmed_tail += rep["tail"]
+            self.stats.gain_db += rep["gain_db"]
+            self.stats.limited += int(rep["limited"])
+            self.stats.cpu_s += time.process_time() - t0
+        return out
+
+
+def _parse(raw: str) -> PostConfig:
+    cfg = PostConfig()
+    for item in raw.split(","):
+        key, _, val = item.strip().partition("=")
+        key, val = key.strip().lower(), val.strip().lower()
+        off = val in ("off", "none", "")
+        if key == "trim":
+            cfg.trim_db = None if off else float(val)
+        elif key == "lufs":
+            cfg.target_lufs = None if off else float(val)
+        elif key == "xfade":
+            cfg.xfade = 0.0 if off else max(0.0, float(val) / 1000.0)
+        elif key:
+            raise ValueError(key)
+    return cfg
+
+
+def open_postproc() -> Optional[PostProcessor]:
+    """KIRITAN_POSTPROC から作る（未設定 / 0 なら None）"""
+    raw = (os.getenv("KIRITAN_POSTPROC") or "").strip()
+    if raw.lower() in ("", "0", "off", "false") or np is None:
+        return None
+    if raw.lower() in ("1", "on", "true"):
+        return PostProcessor()
+    try:
+        return PostProcessor(_parse(raw))
+    except ValueError:
+        print(f"[postproc] KIRITAN_POSTPROC の値が不正です: {raw}（既定値を使用）", file=sys.stderr)
+        return PostProcessor()
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(prog="kiritan_postproc", description="WAV の後処理（無音カット・ラウドネス正規化）を試す")
+    p.add_argument("wav", nargs="+")
+    args = p.parse_args()
+    from kiritan_playback import decode_wav
+    post = open_postproc() or PostProcessor()
+    for path in args.wav:
+        pcm, fs = decode_wav(path)
+        y, rep = post.process(pcm, fs)
+        print(f"{path}: {len(pcm) / fs:.2f}s → {len(y) / fs:.2f}s（前 -{rep['lead']:.2f}s / 後 -{rep['tail']:.2f}s）"
+              f" {loudness(pcm, fs):.1f} → {loudness(y, fs):.1f} LUFS（{rep['gain_db']:+.1f}dB"
+              f"{' ピーク制限' if rep['limited'] else ''}）")
+
+
+if __name__ == "__main__":
+    main()
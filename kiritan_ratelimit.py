@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+クライアント側のレート制限（モデルごとのトークンバケット + Retry-After）
+- 429 を他のエラーと同じに扱って次のモデルへ移ると、絞られているのを全モデルへ広げてしまう
+  （同時に動くセッションが多いほど悪化する）。ここでは 429 を「待てば通る」として同じモデルで並び直す
+- モデルごとに「リクエスト / 分」と「トークン / 分」の 2 つのバケット。送る前に予約し、足りなければ
+  空くまで待つ（予約した順に通るので、同時に来た要求は自然に列になる）
+- 上限は環境変数で与えるか、応答ヘッダ（x-ratelimit-limit-* / remaining-* / reset-*）から学習する。
+  学習した上限には少し余裕（SAFETY）を持たせ、残量は小さい方（手元の見積もり / サーバの値）に合わせる
+- 429 を受けたら Retry-After（retry-after-ms / 秒 / HTTP 日付）まで、そのモデルへの送信を全員止める。
+  ヘッダが無ければ指数バックオフ。待ちが MAX_WAIT を超える場合だけ従来どおりエラーにして次のモデルへ
+- 待った時間（モデル別 / p50・p95）と 429 の回数を RateStats に記録
+
+使い方:
+  client = limit_client(OpenAI(...))     # 無効なら client をそのまま返す
+  client.chat.completions.create(...)    # 送る前に待ち、429 なら待って同じモデルで送り直す
+
+設定（環境変数）:
+  KIRITAN_RATELIMIT=1                                    … ヘッダから学習するだけ（上限は指定しない）
+  KIRITAN_RATELIMIT=gpt-4o-mini=500/200000,*=60/40000    … モデル=RPM/TPM（* はその他のモデル）
+  KIRITAN_RATELIMIT=0 / 未設定                           … 無効（既定）
+  KIRITAN_RATELIMIT_WAIT=20                              … これより長く待つなら次のモデルへ（秒）
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Tuple, Callable
+
+from kiritan_session import estimate_tokens
+from kiritan_timeline import span
+
+SAFETY = 0.95                 # 学習した上限のこれだけを使う（ぴったりだと時計のずれで 429 になる）
+MAX_WAIT = 20.0               # 1 回の要求でこれ以上待つなら諦めて呼び出し元のフォールバックへ（秒）
+MAX_RETRIES = 4               # 429 を受けて同じモデルで送り直す回数
+BACKOFF_BASE = 1.0            # Retry-After が無いときの初回の待ち（秒）
+BACKOFF_CAP = 30.0
+DEFAULT_COMPLETION = 256      # max_tokens の指定が無いときの出力トークンの見積もり
+WINDOW = 1000
+
+
+def _percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(q * (len(s) - 1)))))
+    return s[k]
+
+
+# ---------------- ヘッダ ----------------
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_duration(value) -> Optional[float]:
+    """x-ratelimit-reset-* の "1s" / "6m0s" / "20ms" / "1h2m3.5s"、または素の秒数"""
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    try:
+        return max(0.0, float(text))
+    except ValueError:
+        pass
+    parts = _DURATION.findall(text)
+    if not parts:
+        return None
+    unit = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(n) * unit[u] for n, u in parts)
+
+
+def retry_after(headers) -> Optional[float]:
+    """retry-after-ms / retry-after（秒 or HTTP 日付）から待つ秒数"""
+    if not headers:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms is not None:
+        try:
+            return max(0.0, float(ms) / 1000.0)
+        except ValueError:
+            pass
+    ra = headers.get("retry-after")
+    if ra is None:
+        return None
+    try:
+        return max(0.0, float(ra))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(ra).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _int(headers, key: str) -> Optional[int]:
+    v = headers.get(key)
+    try:
+        return int(float(v)) if v is not None else None
+    except ValueError:
+        return None
+
+
+def headers_of(obj):
+    """例外（e.response.headers）やストリーム（stream.response.headers）から応答ヘッダを取り出す"""
+    resp = getattr(obj, "response", None)
+    headers = getattr(resp, "headers", None)
+    return headers if hasattr(headers, "get") else None
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    if getattr(exc, "status_code", None) == 429 or type(exc).__name__ == "RateLimitError":
+        return True
+    resp = getattr(exc, "response", None)
+    return getattr(resp, "status_code", None) == 429
+
+
+def estimate_request(kwargs: Dict) -> int:
+    """送るトークン数の見積もり（入力 + 出力の上限）。サーバも max_tokens ぶんを先に数える"""
+    prompt = sum(estimate_tokens(str(m.get("content") or "")) for m in kwargs.get("messages") or [])
+    out = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or DEFAULT_COMPLETION
+    return prompt + int(out)
+
+
+# ---------------- バケット ----------------
+class TokenBucket:
+    """連続的に補充されるバケット。reserve は借り越しを許し、返り値が「空くまでの秒数」"""
+
+    def __init__(self, per_minute: float = 0.0):
+        self.rate = 0.0           # 1 秒あたりの補充量（0 = 制限なし）
+        self.capacity = 0.0
+        self.level = 0.0
+        self.at = time.monotonic()
+        if per_minute > 0:
+            self.set_limit(per_minute)
+
+    def set_limit(self, per_minute: float):
+        now = time.monotonic()
+        self._refill(now)
+        first = self.rate <= 0
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity if first else min(self.level, self.capacity)
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.level = min(self.capacity, self.level + (now - self.at) * self.rate)
+        self.at = now
+
+    def reserve(self, n: float, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        # 1 回で容量を超える要求は容量ぶんとして扱う（永久に通らなくならないように）
+        self.level -= min(n, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, n: float):
+        if self.rate > 0:
+            self.level = min(self.capacity, self.level + min(n, self.capacity))
+
+    def sync(self, remaining: float, now: float):
+        """サーバの残量が手元の見積もりより少なければ合わせる（多い方へは合わせない：送信中の分が未反映）"""
+        if self.rate > 0:
+            self._refill(now)
+            self.level = min(self.level, float(remaining))
+
+
+class ModelLimit:
+    def __init__(self, rpm: float = 0.0, tpm: float = 0.0, learn: bool = True):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.learn = learn        # 上限を明示したモデルはヘッダの上限で上書きしない
+        self.blocked_until = 0.0  # monotonic。429 / 残量 0 で全員止める期限
+        self.strikes = 0          # 連続した 429（バックオフ用）
+
+
+# ---------------- 統計 ----------------
+class RateStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.waited = 0           # 待たされた要求
+        self.wait_s = 0.0
+        self.waits: deque = deque(maxlen=WINDOW)
+        self.by_model: Dict[str, float] = {}
+        self.throttled = 0        # 受けた 429
+        self.retried = 0          # 同じモデルで送り直した回数
+        self.gave_up = 0          # 待ちが長すぎて呼び出し元へ返した回数
+
+    def as_dict(self) -> Dict:
+        with self.lock:
+            ms = [x * 1000 for x in self.waits]
+            return {"requests": self.requests, "waited": self.waited, "wait_s": round(self.wait_s, 2),
+                    "wait_p50_ms": round(_percentile(ms, 0.5)), "wait_p95_ms": round(_percentile(ms, 0.95)),
+                    "throttled": self.throttled, "retried": self.retried, "gave_up": self.gave_up,
+                    "by_model": {m: round(s, 2) for m, s in self.by_model.items()}}
+
+    def summary(self) -> str:
+        with self.lock:
+            ms = [x * 1000 for x in self.waits]
+            per = " / ".join(f"{m} {s:.1f}s" for m, s in sorted(self.by_model.items(), key=lambda kv: -kv[1]))
+            return (f"要求 {self.requests} / 待ち {self.waited} 回 計 {self.wait_s:.1f}s"
+                    f"（p50 {_percentile(ms, 0.5):.0f}ms / p95 {_percentile(ms, 0.95):.0f}ms）"
+                    f" / 429 {self.throttled} / 送り直し {self.retried} / 諦め {self.gave_up}"
+                    + (f" / モデル別 {per}" if per else ""))
+
+
+class Throttled(RuntimeError):
+    """待ちが MAX_WAIT を超える。呼び出し元は従来どおり次のモデルへ"""
+
+
+# ---------------- 本体 ----------------
+class RateLimiter:
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, float]]] = None,
+                 max_wait: float = MAX_WAIT, max_retries: int = MAX_RETRIES,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.limits = dict(limits or {})
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.stats = RateStats()
+        self._models: Dict[str, ModelLimit] = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, model: str) -> ModelLimit:
+        lim = self._models.get(model)
+        if lim is None:
+            rpm, tpm = self.limits.get(model) or self.limits.get("*") or (0.0, 0.0)
+            lim = self._models[model] = ModelLimit(rpm, tpm, learn=model not in self.limits)
+        return lim
+
+    def reserve(self, model: str, tokens: int) -> float:
+        """1 要求ぶんを予約して、送ってよくなるまでの秒数を返す。長すぎれば予約を戻して Throttled"""
+        now = time.monotonic()
+        with self._lock:
+            lim = self._limit(model)
+            wait = max(lim.requests.reserve(1, now), lim.tokens.reserve(tokens, now), lim.blocked_until - now)
+            if wait > self.max_wait:
+                lim.requests.refund(1)
+                lim.tokens.refund(tokens)
+        if wait > self.max_wait:
+            with self.stats.lock:
+                self.stats.gave_up += 1
+            raise Throttled(f"{model}: レート制限で {wait:.0f}s 待ちになるため見送り")
+        return max(0.0, wait)
+
+    def acquire(self, model: str, tokens: int) -> float:
+        wait = self.reserve(model, tokens)
+        if wait > 0:
+            with span("ratelimit.wait", model=model, tokens=tokens):
+                self.sleep(wait)
+        with self.stats.lock:
+            self.stats.requests += 1
+            if wait > 0:
+                self.stats.waited += 1
+                self.stats.wait_s += wait
+                self.stats.by_model[model] = self.stats.by_model.get(model, 0.0) + wait
+            self.stats.waits.append(wait)
+        return wait
+
+    def on_headers(self, model: str, headers):
+        """成功した応答のヘッダから上限と残量を学ぶ"""
+        if not headers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            lim = self._limit(model)
+            lim.strikes = 0
+            for bucket, kind in ((lim.requests, "requests"), (lim.tokens, "tokens")):
+                limit = _int(headers, f"x-ratelimit-limit-{kind}")
+                if limit and lim.learn and abs(bucket.capacity - limit * SAFETY) >= 1:
+                    bucket.set_limit(limit * SAFETY)
+                remaining = _int(headers, f"x-ratelimit-remaining-{kind}")
+                if remaining is None:
+                    continue
+                bucket.sync(remaining, now)
+                if remaining <= 0:
+                    reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                    if reset:
+                        lim.blocked_until = max(lim.blocked_until, now + reset)
+
+    def on_throttled(self, model: str, headers) -> float:
+        """429 を受けた。そのモデルを Retry-After（無ければ指数バックオフ）まで止め、その秒数を返す"""
+        now = time.monotonic()
+        with self._lock:
+            lim = self._limit(model)
+            lim.strikes += 1
+            delay = retry_after(headers)
+            if delay is None:
+                delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (lim.strikes - 1)) * random.uniform(0.8, 1.2)
+            lim.blocked_until = max(lim.blocked_until, now + delay)
+            # 429 の時点で手元のバケットは空とみなす（ヘッダの残量で後から補正される）
+            lim.requests.sync(0, now)
+        with self.stats.lock:
+            self.stats.throttled += 1
+        return delay
+
+    def call(self, model: str, fn: Callable, tokens: int, on_send: Optional[Callable[[], None]] = None):
+        """予約 → 送信。429 なら待って同じモデルで送り直す。on_send は待ち終えて実際に送る直前に毎回呼ぶ"""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, tokens)
+            if on_send is not None:
+                on_send()
+            try:
+                res = fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                delay = self.on_throttled(model, headers_of(e))
+                if attempt >= self.max_retries or delay > self.max_wait:
+                    raise
+                print(f"[ratelimit] {model}: 429。{delay:.1f}s 待って送り直します", file=sys.stderr)
+                with self.stats.lock:
+                    self.stats.retried += 1
+                continue
+            self.on_headers(model, headers_of(res))
+            return res
+
+
+class _Completions:
+    def __init__(self, client, limiter: RateLimiter):
+        self._client = client
+        self._limiter = limiter
+
+    def create(self, on_send: Optional[Callable[[], None]] = None, **kwargs):
+        """on_send: レート制限の待ちを抜けて送る直前に呼ばれる（ヘッジの時計を待ちの後から始めるため）"""
+        return self._limiter.call(kwargs.get("model") or "", lambda: self._client.chat.completions.create(**kwargs),
+                                  estimate_request(kwargs), on_send=on_send)
+
+
+class _Chat:
+    def __init__(self, completions: _Completions):
+        self.completions = completions
+
+
+class LimitedClient:
+    """chat.completions.create だけを制限する。それ以外（audio 等）は元のクライアントへ"""
+
+    def __init__(self, client, limiter: RateLimiter):
+        self._client = client
+        self.limiter = limiter
+        self.chat = _Chat(_Completions(client, limiter))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+# ---------------- 設定 ----------------
+def parse_limits(raw: str) -> Dict[str, Tuple[float, float]]:
+    """"gpt-4o-mini=500/200000,*=60/40000" → {model: (rpm, tpm)}。TPM は省略可"""
+    limits = {}
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model, _, spec = item.rpartition("=")
+        rpm, _, tpm = spec.partition("/")
+        limits[model.strip() or "*"] = (float(rpm), float(tpm) if tpm else 0.0)
+    return limits
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> Optional[RateLimiter]:
+    """環境変数 KIRITAN_RATELIMIT から作る（プロセス内で共有。未設定 / 0 なら None）"""
+    global _limiter
+    raw = (os.getenv("KIRITAN_RATELIMIT") or "").strip()
+    if raw.lower() in ("", "0", "off", "false"):
+        return None
+    with _limiter_lock:
+        if _limiter is None:
+            limits = {}
+            if raw.lower() not in ("1", "on", "true", "auto"):
+                try:
+                    limits = parse_limits(raw)
+                except ValueError:
+                    print(f"[ratelimit] KIRITAN_RATELIMIT の値が不正です: {raw}（ヘッダからの学習だけ使用）",
+                          file=sys.stderr)
+            try:
+                max_wait = float(os.getenv("KIRITAN_RATELIMIT_WAIT") or MAX_WAIT)
+            except ValueError:
+                max_wait = MAX_WAIT
+            _limiter = RateLimiter(limits, max_wait=max_wait)
+        return _limiter
+
+
+def limit_client(client):
+    """有効なら共有の RateLimiter を通すクライアントを返す（無効ならそのまま）"""
+    limiter = get_limiter()
+    return client if limiter is None or client is None else LimitedClient(client, limiter)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+トレースの再生（kiritan_trace.py で記録した JSONL を、フェイクの LLM / 合成で再現する）
+- 各ターンの LLM 呼び出し（モデル・delta・時刻）と、文ごとのレンダリング時間・発話長を台本にする
+- パイプラインは今のコード（stream_chat → 読み上げ予算 → 文確定 → 再生エンジン）をそのまま通す
+  → 「昨日遅かった」を手元で再現したり、パイプラインの変更前後を実トラフィックの形で比べたりできる
+- --scale 1 で元の時間どおり（ターン間の間隔も再現）、--scale 0.1 で 10 倍速、--fast で待ちなし
+- ターンごとに 最初の delta / 最初の再生開始 / ターン終了 を「記録 → 再生」で並べ、p50 / p95 を集計
+
+使い方:
+  python kiritan_replay.py traces/20250101-120000-1234.jsonl [--scale 0.2] [--fast]
+                           [--pipeline stream|batch] [--limit N] [--json out.json]
+"""
+
+import sys
+import json
+import time
+import argparse
+from typing import Optional, List, Dict
+
+from kiritan_trace import load, turn_metrics
+from kiritan_fake import FakeLLM, FakeSpeech, FakePlaybackEngine
+from kiritan_hedge import stream_chat
+from kiritan_budget import SpeechBudget
+from kiritan_playback import SentenceStream, split_sentences, DEFAULT_LOOKAHEAD
+
+DEFAULT_CID = 1707
+DEFAULT_MODEL = "gpt-4o-mini"
+METRICS = ("ttft", "first", "total")
+LABELS = {"ttft": "最初の delta", "first": "最初の再生", "total": "ターン終了"}
+
+
+def _pct(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(q * (len(s) - 1))))]
+
+
+def _fmt(v: Optional[float]) -> str:
+    return "  -  " if v is None else f"{v:5.2f}"
+
+
+class Replayer:
+    def __init__(self, scale: float = 1.0, pipeline: str = "stream", lookahead: int = DEFAULT_LOOKAHEAD):
+        self.scale = max(0.0, scale)
+        self.pipeline = pipeline
+        self.llm = FakeLLM(scale=self.scale)
+        self.speech = FakeSpeech(scale=self.scale)
+        self.engine = FakePlaybackEngine(self.speech, scale=self.scale, lookahead=lookahead)
+        self.budget = SpeechBudget.from_env()
+        self._first: Optional[float] = None
+        self.engine.on_start.append(self._on_start)
+
+    def _on_start(self, seg):
+        if self._first is None:
+            self._first = time.perf_counter()
+
+    def _unscale(self, dt: float) -> Optional[float]:
+        # 再生側の経過時間を、記録と同じ「実時間」の秒に戻す（--fast では比べられない）
+        return round(dt / self.scale, 3) if self.scale > 0 else None
+
+    def run_turn(self, rec: Dict) -> Dict:
+        mode = rec.get("mode") or "text"
+        speed = float(rec.get("speed") or 1.0)
+        cid = int(rec.get("cid") or DEFAULT_CID)
+        messages = rec.get("prompt") or [{"role": "user", "content": rec["input"].get("text", "")}]
+        models = []
+        for c in rec.get("calls") or []:
+            if c.get("model") and c["model"] not in models:
+                models.append(c["model"])
+        models = models or [DEFAULT_MODEL]
+
+        self.llm.script(rec.get("calls"), rec["input"].get("asr"))
+        self.speech.script(rec.get("speech"))
+        self._first = None
+        t0 = time.perf_counter()
+        ttft = None
+
+        # 録音の文字起こしがあった経路は、その時間も再現する
+        if rec["input"].get("asr"):
+            self.llm.audio.transcriptions.create(model="whisper-1", file=None)
+
+        cutter = self.budget.cutter(mode, speed)
+        splitter = SentenceStream()
+        deltas = stream_chat(self.llm, models, messages, self.budget.max_tokens(mode, speed))
+        buf: List[str] = []
+        n = 0
+        error = None
+        try:
+            for delta in deltas:
+                if ttft is None:
+                    ttft = time.perf_counter()
+                if cutter and cutter.feed(delta):
+                    break
+                buf.append(delta)
+                if self.pipeline == "stream":
+                    for s in splitter.feed(delta):
+                        self.engine.submit(s, cid, speed)
+                        n += 1
+        except RuntimeError as e:
+            error = str(e)
+        finally:
+            deltas.close()
+        if cutter is not None and cutter.exceeded:
+            reply = cutter.text()
+            # 本番と同じく、読み上げ済みの所より後ろを SentenceStream の区切りで
+            rest = splitter.rest(reply) if self.pipeline == "stream" else split_sentences(reply)
+        else:
+            reply = cutter.text() if cutter else "".join(buf).strip()
+            rest = splitter.flush() if self.pipeline == "stream" else split_sentences(reply)
+        for s in rest:
+            self.engine.submit(s, cid, speed)
+        self.engine.wait()
+        t_end = time.perf_counter()
+
+        got = {"ttft": self._unscale(ttft - t0) if ttft else None,
+               "first": self._unscale(self._first - t0) if self._first else None,
+               "total": self._unscale(t_end - t0)}
+        return {"seq": rec.get("seq"), "mode": mode, "orig": turn_metrics(rec), "replay": got,
+                "reply_same": reply == (rec.get("reply") or "").strip(), "error": error,
+                "wall": round(t_end - t0, 3)}
+
+    def run(self, turns: List[Dict], keep_gaps: bool = True) -> List[Dict]:
+        results = []
+        base_orig = turns[0].get("t", 0.0) if turns else 0.0
+        base = time.perf_counter()
+        for rec in turns:
+            # 元のターン開始時刻に合わせる（遅れていたらすぐ始める）
+            if keep_gaps and self.scale > 0:
+                wait = base + (rec.get("t", base_orig) - base_orig) * self.scale - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            res = self.run_turn(rec)
+            results.append(res)
+            print(self.line(res))
+        return results
+
+    @staticmethod
+    def line(res: Dict) -> str:
+        cols = "  ".join(f"{LABELS[k]} {_fmt(res['orig'][k])}→{_fmt(res['replay'][k])}s" for k in METRICS)
+        flags = ("" if res["reply_same"] else "  [返答が変化]") + (f"  [error] {res['error']}" if res["error"] else "")
+        return f"#{res['seq']:<4} {res['mode']:<8} {cols}{flags}"
+
+    def close(self):
+        self.engine.close()
+
+
+def summarize(results: List[Dict]) -> str:
+    lines = [f"[replay] {len(results)} ターン"]
+    for k in METRICS:
+        orig = [r["orig"][k] for r in results if r["orig"][k] is not None]
+        rep = [r["replay"][k] for r in results if r["replay"][k] is not None]
+        lines.append(f"  {LABELS[k]:<8} p50 {_fmt(_pct(orig, 0.5))}→{_fmt(_pct(rep, 0.5))}s"
+                     f"  p95 {_fmt(_pct(orig, 0.95))}→{_fmt(_pct(rep, 0.95))}s")
+    changed = sum(1 for r in results if not r["reply_same"])
+    if changed:
+        lines.append(f"  返答が変化: {changed} ターン（読み上げ予算などの違い）")
+    return "\n".join(lines)
+
+
+def main():
+    p = argparse.ArgumentParser(prog="kiritan_replay")
+    p.add_argument("traces", nargs="+", help="KIRITAN_TRACE で記録した JSONL")
+    p.add_argument("--scale", type=float, default=1.0, help="時間の倍率（1 = 記録どおり、0.1 = 10 倍速）")
+    p.add_argument("--fast", action="store_true", help="待ちなしで最速（遅延の比較はしない）")
+    p.add_argument("--pipeline", choices=("stream", "batch"), default="stream",
+                   help="stream = 文が確定するたびに再生へ / batch = 返答を全部受けてから再生")
+    p.add_argument("--lookahead", type=int, default=DEFAULT_LOOKAHEAD)
+    p.add_argument("--no-gaps", action="store_true", help="ターン間の間隔を詰める")
+    p.add_argument("--limit", type=int, default=0, help="先頭 N ターンだけ")
+    p.add_argument("--json", help="ターンごとの結果を書き出す（変更前後の比較用）")
+    args = p.parse_args()
+
+    turns: List[Dict] = []
+    for path in args.traces:
+        turns += load(path)
+    if args.limit:
+        turns = turns[:args.limit]
+    if not turns:
+        print("[replay] ターンがありません", file=sys.stderr)
+        sys.exit(1)
+
+    rp = Replayer(scale=0.0 if args.fast else args.scale, pipeline=args.pipeline, lookahead=args.lookahead)
+    t0 = time.perf_counter()
+    try:
+        results = rp.run(turns, keep_gaps=not args.no_gaps)
+    except KeyboardInterrupt:
+        print("\n(CTRL+C) 中断しました。")
+        return
+    finally:
+        rp.close()
+    print(summarize(results))
+    print(f"[replay] 所要 {time.perf_counter() - t0:.1f}s  LLM 要求 {rp.llm.requests} / レンダリング {rp.speech.renders}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
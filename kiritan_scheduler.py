@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+複数セッションで 1 つの読み上げエンジンを共有するスケジューラ（重み付き公平キューイング）
+- セッション（ユーザ / チャンネル）ごとにキューを持ち、話す秒数（見積もり）÷ 重み で仮想終了時刻を付けて小さい順に出す
+  （Self-Clocked Fair Queuing。長文を連投するセッションがあっても、他のセッションの順番は必ず回ってくる）
+- セッションごとのキュー上限（溢れた分は受け付けない）と、urgent（最優先）の項目
+- urgent の preempt=True は再生中の他セッションの文を止めて割り込む（止めた文はそのセッションの先頭に戻して後で読み直す）
+- エンジンには常に lookahead + 1 本まで投入しておく（先読みレンダリングが途切れず、稼働率を保つ）
+- セッションごとの待ち時間（投入 → 再生開始）の p50 / p95、話した秒数、拒否数を集計
+
+使い方:
+  sched = FairScheduler(PlaybackEngine(backend_from_env()))
+  sched.session("alice", weight=2.0, max_queue=20)
+  item = sched.submit("alice", "こんにちは。", cid=1707)
+  item.done.wait()
+  python kiritan_scheduler.py --check   … 割り込みの後もセッション内の文の順番が保たれるかの確認
+"""
+
+import sys
+import time
+import itertools
+import threading
+from collections import deque
+from typing import Optional, List, Dict, Callable
+
+from kiritan_budget import estimate_seconds
+
+NORMAL = 0
+URGENT = 1
+DEFAULT_WEIGHT = 1.0
+DEFAULT_MAX_QUEUE = 32        # セッションごとの未再生の上限（文の数）
+MIN_COST = 0.2                # 見積もり 0 秒の文でも仮想時間を進める
+
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(q * (len(s) - 1))))]
+
+
+# ---------------- 項目 / セッション ----------------
+class SpeechItem:
+    _ids = itertools.count(1)
+
+    def __init__(self, session: "Session", text: str, cid: int, speed: float, priority: int, tag=None):
+        self.id = next(SpeechItem._ids)
+        self.session = session
+        self.text = text
+        self.cid = cid
+        self.speed = speed
+        self.priority = priority
+        self.tag = tag                    # 呼び出し側の任意タグ（ジョブ id 等）
+        self.cost = max(MIN_COST, estimate_seconds(text, speed))
+        self.finish_tag = 0.0
+        self.enqueued_at = time.time()
+        self.started_at: Optional[float] = None
+        self.segment = None
+        self.cancelled = False
+        self.preempted = 0
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return f"<SpeechItem #{self.id} {self.session.name} {self.text[:12]!r}>"
+
+
+class Session:
+    def __init__(self, name: str, weight: float = DEFAULT_WEIGHT, max_queue: int = DEFAULT_MAX_QUEUE):
+        self.name = name
+        self.weight = max(0.01, float(weight))
+        self.max_queue = max(1, int(max_queue))
+        self.queue: deque = deque()
+        self.last_finish = 0.0            # このセッションの最後の項目の仮想終了時刻
+        # 統計
+        self.waits: deque = deque(maxlen=500)
+        self.spoken_s = 0.0
+        self.submitted = 0
+        self.rejected = 0
+        self.preempted = 0
+
+    def status(self) -> Dict:
+        waits = list(self.waits)
+        return {"weight": self.weight, "queued": len(self.queue), "submitted": self.submitted,
+                "rejected": self.rejected, "preempted": self.preempted, "spoken_s": round(self.spoken_s, 1),
+                "wait_p50": round(_pct(waits, 0.5), 2), "wait_p95": round(_pct(waits, 0.95), 2)}
+
+
+# ---------------- スケジューラ ----------------
+class FairScheduler:
+    def __init__(self, engine, depth: Optional[int] = None):
+        """engine は PlaybackEngine（KIRITAN_ENGINES のプールを render に渡したものでもよい）"""
+        self.engine = engine
+        self.depth = depth or (getattr(engine, "lookahead", 1) + 1)
+        self.sessions: Dict[str, Session] = {}
+        self.vtime = 0.0
+        self.on_start: List[Callable[[SpeechItem], None]] = []
+        self.on_finish: List[Callable[[SpeechItem], None]] = []
+        self._inflight: List[SpeechItem] = []
+        self._holding: set = set()        # 割り込みで止めた文。全部戻ってくるまで次を投入しない
+        self._cv = threading.Condition()
+        self._busy_s = 0.0
+        self._started = time.time()
+        engine.on_start.append(self._on_start)
+        engine.on_finish.append(self._on_finish)
+
+    # ---- セッション ----
+    def session(self, name: str, weight: Optional[float] = None, max_queue: Optional[int] = None) -> Session:
+        """取得（無ければ作成）。weight / max_queue を渡せば更新"""
+        with self._cv:
+            s = self.sessions.get(name)
+            if s is None:
+                s = self.sessions[name] = Session(name)
+            if weight is not None:
+                s.weight = max(0.01, float(weight))
+            if max_queue is not None:
+                s.max_queue = max(1, int(max_queue))
+            return s
+
+    def remove(self, name: str) -> bool:
+        """セッションを片付ける（未再生の文も再生中の文も無いときだけ）。消したら True"""
+        with self._cv:
+            s = self.sessions.get(name)
+            if s is None:
+                return True
+            if s.queue or any(x.session is s for x in self._inflight):
+                return False
+            del self.sessions[name]
+            return True
+
+    # ---- 投入 ----
+    def submit(self, session: str, text: str, cid: int, speed: float = 1.0, priority: int = NORMAL,
+               preempt: bool = False, tag=None) -> Optional[SpeechItem]:
+        """キューに積む。セッションのキューが上限なら None（urgent は上限を無視）"""
+        s = self.session(session)
+        with self._cv:
+            s.submitted += 1
+            if priority < URGENT and len(s.queue) >= s.max_queue:
+                s.rejected += 1
+                return None
+            item = SpeechItem(s, text, cid, speed, priority, tag)
+            self._tag(item)
+            if priority >= URGENT:
+                # urgent はセッション内でも先頭へ（他の urgent よりは後ろ）
+                i = next((k for k, x in enumerate(s.queue) if x.priority < URGENT), len(s.queue))
+                s.queue.insert(i, item)
+            else:
+                s.queue.append(item)
+            victims = self._victims(item) if preempt and priority >= URGENT else []
+            if not self._holding:
+                self._dispatch()
+        if victims:
+            self._preempt(victims)
+        return item
+
+    def _tag(self, item: SpeechItem):
+        s = item.session
+        start = max(self.vtime, s.last_finish)
+        item.finish_tag = start + item.cost / s.weight
+        s.last_finish = item.finish_tag
+
+    def _victims(self, item: SpeechItem) -> List[SpeechItem]:
+        return [x for x in self._inflight if x.priority < URGENT and x.session is not item.session]
+
+    def _preempt(self, victims: List[SpeechItem]):
+        # エンジンの cancel は全体に効くので、止めたくない分は _on_finish で先頭に戻る
+        print(f"[sched] urgent の割り込みで {len(victims)} 文を中断", file=sys.stderr)
+        with self._cv:
+            self._holding = set(self._inflight)
+        self.engine.cancel()
+
+    # ---- 取り出し ----
+    def _pick(self) -> Optional[SpeechItem]:
+        best = None
+        for s in self.sessions.values():
+            if not s.queue:
+                continue
+            head = s.queue[0]
+            key = (-head.priority, head.finish_tag, head.id)
+            if best is None or key < best[0]:
+                best = (key, s)
+        if best is None:
+            return None
+        item = best[1].queue.popleft()
+        self.vtime = max(self.vtime, item.finish_tag - item.cost / item.session.weight)
+        return item
+
+    def _dispatch(self):
+        # _cv を持った状態で呼ぶ。エンジンに depth 本まで投入しておく
+        while len(self._inflight) < self.depth:
+            item = self._pick()
+            if item is None:
+                return
+            self._inflight.append(item)
+            item.segment = self.engine.submit(item.text, item.cid, item.speed, group=item)
+
+    def cancel(self, session: Optional[str] = None):
+        """セッション（None なら全部）の未再生分を捨て、再生中のものも止める"""
+        with self._cv:
+            targets = [self.sessions[session]] if session in self.sessions else (
+                list(self.sessions.values()) if session is None else [])
+            dropped = []
+            for s in targets:
+                dropped += list(s.queue)
+                s.queue.clear()
+            running = [x for x in self._inflight if session is None or x.session.name == session]
+            for x in dropped + running:
+                x.cancelled = True
+            if running:
+                # エンジンの cancel は全体に効く。巻き添えの文が全部戻るまで投入しない（順番を保つ）
+                self._holding = set(self._inflight)
+        for x in dropped:
+            x.error = "cancelled"
+            x.done.set()
+            self._fire(self.on_finish, x)
+        if running:
+            self.engine.cancel()
+
+    # ---- エンジンのイベント ----
+    def _on_start(self, seg):
+        item = seg.group
+        if not isinstance(item, SpeechItem):
+            return
+        item.started_at = seg.started_at or time.time()
+        with self._cv:
+            item.session.waits.append(item.started_at - item.enqueued_at)
+        self._fire(self.on_start, item)
+
+    def _on_finish(self, seg):
+        item = seg.group
+        if not isinstance(item, SpeechItem):
+            return
+        requeued = False
+        with self._cv:
+            if item in self._inflight:
+                self._inflight.remove(item)
+            self._holding.discard(item)
+            if seg.error == "cancelled" and not item.cancelled:
+                # 割り込み / 他セッションの cancel の巻き添え → 先頭側に戻して読み直す。
+                # 中断の通知は文の順に来るとは限らないので、元の順（urgent が先、次に id 順）の位置へ入れる
+                item.preempted += 1
+                item.session.preempted += 1
+                q = item.session.queue
+                key = (-item.priority, item.id)
+                q.insert(next((k for k, x in enumerate(q) if (-x.priority, x.id) > key), len(q)), item)
+                requeued = True
+            elif not seg.error:
+                played = (seg.finished_at or time.time()) - (seg.started_at or time.time())
+                item.session.spoken_s += played
+                self._busy_s += played
+            # 止めた文が 1 つずつ戻ってくる途中で投入すると、戻った順に読まれて順番が入れ替わる
+            if not self._holding:
+                self._dispatch()
+        if requeued:
+            return
+        item.error = seg.error
+        item.done.set()
+        self._fire(self.on_finish, item)
+
+    @staticmethod
+    def _fire(callbacks, item: SpeechItem):
+        for cb in list(callbacks):
+            try:
+                cb(item)
+            except Exception as e:
+                print(f"[sched] callback error: {e}", file=sys.stderr)
+
+    # ---- 状態 ----
+    def backlog_seconds(self, session: Optional[str] = None) -> float:
+        """キューに待っている文（見積もり）+ エンジンに投入済みで未再生の分（秒）。session 指定時はそのセッションだけ"""
+        with self._cv:
+            targets = [self.sessions[session]] if session in self.sessions else (
+                list(self.sessions.values()) if session is None else [])
+            queued = sum(x.cost for s in targets for x in s.queue)
+            inflight = [x for x in self._inflight if session is None or x.session.name == session]
+            # レンダリング待ち（PCM がまだ無い）の文は見積もりで、再生キューに入った文は残りの PCM で数える（二重に数えない）
+            pending = sum(x.cost for x in inflight
+                          if x.segment is None or (x.segment.pcm is None and x.started_at is None))
+        if session is None:
+            return queued + pending + self.engine.backlog_seconds()
+        mine = set(inflight)
+        return queued + pending + self.engine.backlog_seconds(lambda seg: seg.group in mine)
+
+    def status(self) -> Dict:
+        with self._cv:
+            up = max(1e-6, time.time() - self._started)
+            return {"utilization": round(self._busy_s / up, 3), "inflight": len(self._inflight),
+                    "sessions": {n: s.status() for n, s in self.sessions.items()}}
+
+    def summary(self) -> str:
+        st = self.status()
+        parts = [f"{n}: 待ち p50 {v['wait_p50']:.2f}s p95 {v['wait_p95']:.2f}s / 発話 {v['spoken_s']:.0f}s"
+                 f" / 拒否 {v['rejected']} / 中断 {v['preempted']}" for n, v in st["sessions"].items()]
+        return f"稼働率 {st['utilization']:.0%} | " + " | ".join(parts)
+
+
+# ---------------- 確認 ----------------
+class _StubEngine:
+    """音を出さないエンジン。play() で先頭を 1 本再生し、cancel() は中断を投入と逆の順で知らせる"""
+
+    def __init__(self, lookahead: int = 2):
+        self.lookahead = lookahead
+        self.on_start: List[Callable] = []
+        self.on_finish: List[Callable] = []
+        self.live: List = []
+
+    def submit(self, text: str, cid: int, speed: float = 1.0, group=None):
+        from types import SimpleNamespace
+        seg = SimpleNamespace(text=text, group=group, error=None, pcm=None, started_at=None, finished_at=None)
+        self.live.append(seg)
+        return seg
+
+    def _finish(self, seg):
+        for cb in list(self.on_finish):
+            cb(seg)
+
+    def play(self) -> Optional[str]:
+        if not self.live:
+            return None
+        seg = self.live.pop(0)
+        seg.started_at = seg.finished_at = time.time()
+        for cb in list(self.on_start):
+            cb(seg)
+        self._finish(seg)
+        return seg.text
+
+    def cancel(self):
+        segs, self.live = self.live[::-1], []
+        for seg in segs:
+            seg.error = "cancelled"
+            self._finish(seg)
+
+    def backlog_seconds(self, match=None) -> float:
+        return 0.0
+
+
+def check() -> bool:
+    engine = _StubEngine()
+    sched = FairScheduler(engine)
+    texts = ["一つ目です。", "二つ目です。", "三つ目です。", "四つ目です。", "五つ目です。"]
+    for t in texts:
+        sched.submit("a", t, 1707)
+    sched.submit("b", "緊急です。", 1707, priority=URGENT, preempt=True)
+    order = []
+    while True:
+        t = engine.play()
+        if t is None:
+            break
+        order.append(t)
+    ok = order == ["緊急です。"] + texts
+    print(f"[check] 割り込み後の再生順: {' / '.join(order)} → {'OK' if ok else 'NG'}")
+    return ok
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(prog="kiritan_scheduler")
+    p.add_argument("--check", action="store_true", help="割り込み後の順番を確認する")
+    args = p.parse_args()
+    if args.check:
+        sys.exit(0 if check() else 1)
+    p.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,655 @@
+# -*- coding: utf-8 -*-
+"""
+ローカル WebSocket / HTTP サーバ（配信オーバーレイ・字幕・アバター連携用）
+- 標準ライブラリの asyncio だけで動く（WebSocket は RFC 6455 の必要最小限）
+- chat / say を受け付け、生成中の delta・文の確定・再生開始/終了・（任意で）PCM をその場で push
+- イベントは 1 回だけエンコードして全クライアントへ配る。ポーリング不要
+- クライアントごとに上限付きキュー。溢れたら PCM から捨て、それでも詰まるクライアントは切断
+  （TCP 側の詰まりは writer.drain() で待つので、遅いクライアントが他を巻き込まない）
+- session ごとに会話履歴とジョブの列を持ち、生成はセッション間で並行。読み上げは 1 つのエンジンを
+  重み付き公平キュー（kiritan_scheduler.py）で分け合う。urgent は他のセッションの再生に割り込む
+- セッションは MAX_SESSIONS まで。SESSION_IDLE 秒使われていないセッションは片付け、満杯なら
+  いちばん長く使われていない空きのセッションを譲らせる（全部が処理中なら新しいセッションは断る）
+- KIRITAN_ADAPTIVE_SPEED があれば、全セッションの読み上げ待ちに応じて話速を一律に上げる（kiritan_speedctl）
+
+起動:
+  python kiritan_server.py [--host 127.0.0.1] [--port 8765] [--no-speak]
+  （読み上げの出口は KIRITAN_SPEECH。Linux では null や http://<Windows>:7180/1707 で合成だけ Windows へ）
+
+エンドポイント:
+  GET  /ws[?pcm=1]   … WebSocket。送信: {"type":"chat"|"say","text":...} / {"type":"cancel"}
+                       任意で "session"（既定 default）/ "weight"（読み上げの取り分）/ "urgent": true
+  GET  /events       … Server-Sent Events（テキストのイベントのみ。EventSource でそのまま読める）
+  POST /chat /say    … {"text": ...} を受け付けて {"id": n} を返す（結果は /ws か /events へ流れる）
+  POST /cancel       … 生成と再生を中断（{"session": ...} でそのセッションだけ）
+  GET  /status       … 接続数・破棄数・セッションごとの待ち時間 p50 / p95 など
+
+イベント（JSON テキストフレーム）:
+  accepted / delta / sentence / reply / play_start / play_end / dropped / error
+  （dropped … セッションの読み上げキューが上限で、その文は読まれなかった）
+  PCM（?pcm=1 のときだけ）はバイナリフレーム:
+    先頭 8 バイト = セグメント id (uint32 LE) + サンプルレート (uint32 LE)、以降 int16 LE モノラル
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import base64
+import struct
+import socket
+import asyncio
+import hashlib
+import argparse
+import threading
+from collections import deque
+from typing import Optional, List, Dict
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+try:
+    from openai import OpenAI
+except Exception:
+    OpenAI = None
+
+from kiritan_hedge import stream_chat
+from kiritan_budget import SpeechBudget
+from kiritan_playback import PlaybackEngine, Segment, SentenceStream, split_sentences, DEFAULT_LOOKAHEAD
+from kiritan_speech import backend_from_env
+from kiritan_scheduler import FairScheduler, SpeechItem, NORMAL, URGENT
+from kiritan_speedctl import open_speedctl
+from kiritan_ratelimit import limit_client, get_limiter
+
+# ---------------- 設定 ----------------
+CID_KIRITAN = 1707
+DEFAULT_PORT = 8765
+DEFAULT_MODELS = ["gpt-4o-mini", "o4-mini-high", "o3-mini", "gpt-4o"]
+SYSTEM_PROMPT = os.getenv("KIRITAN_SYSTEM_PROMPT") or "あなたは『東北きりたんEX』です。親しみやすい口調で、短めに返答してください。"
+HISTORY_WINDOW = 12
+DEFAULT_SESSION = "default"
+MAX_QUEUE = 256               # クライアントごとの未送信イベント上限
+MAX_MESSAGE = 1 << 20         # 受信メッセージの上限（バイト）
+MAX_HEADER = 16 * 1024
+PCM_CHUNK_SEC = 0.1
+MAX_SESSIONS = 64             # 同時に持つセッション（履歴 + ジョブの列 + worker）の上限
+SESSION_IDLE = 600.0          # これだけ使われていないセッションは片付ける（秒）
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OP_CONT, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+BUDGET = SpeechBudget.from_env()
+
+
+# ---------------- WebSocket フレーム ----------------
+def ws_frame(payload: bytes, opcode: int = OP_TEXT) -> bytes:
+    n = len(payload)
+    if n < 126:
+        head = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 65536:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return head + payload
+
+
+async def ws_read(reader: asyncio.StreamReader):
+    """(fin, opcode, payload) を 1 フレーム読む"""
+    b1, b2 = await reader.readexactly(2)
+    n = b2 & 0x7F
+    if n == 126:
+        n = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif n == 127:
+        n = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if n > MAX_MESSAGE:
+        raise ValueError("message too large")
+    mask = await reader.readexactly(4) if b2 & 0x80 else None
+    data = await reader.readexactly(n)
+    if mask and n:
+        key = (mask * (n // 4 + 1))[:n]
+        data = (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(n, "big")
+    return bool(b1 & 0x80), b1 & 0x0F, data
+
+
+# ---------------- イベント ----------------
+class Event:
+    """配信する 1 イベント。フレームはクライアント種別ごとに 1 回だけ作る"""
+    __slots__ = ("kind", "data", "binary", "_ws", "_sse")
+
+    def __init__(self, kind: str, data: bytes, binary: bool = False):
+        self.kind = kind
+        self.data = data
+        self.binary = binary
+        self._ws = None
+        self._sse = None
+
+    @classmethod
+    def json(cls, etype: str, **fields) -> "Event":
+        fields = dict(type=etype, t=round(time.time(), 4), **fields)
+        return cls(etype, json.dumps(fields, ensure_ascii=False).encode("utf-8"))
+
+    @property
+    def droppable(self) -> bool:
+        return self.binary
+
+    def ws(self) -> bytes:
+        if self._ws is None:
+            self._ws = ws_frame(self.data, OP_BINARY if self.binary else OP_TEXT)
+        return self._ws
+
+    def sse(self) -> bytes:
+        if self._sse is None:
+            self._sse = b"event: " + self.kind.encode() + b"\ndata: " + self.data + b"\n\n"
+        return self._sse
+
+
+class Client:
+    def __init__(self, writer: asyncio.StreamWriter, kind: str, pcm: bool = False, max_items: int = MAX_QUEUE):
+        self.writer = writer
+        self.kind = kind              # "ws" / "sse"
+        self.pcm = pcm and kind == "ws"
+        self.max_items = max_items
+        self.q: deque = deque()
+        self.wake = asyncio.Event()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        peer = writer.get_extra_info("peername")
+        self.name = f"{kind}:{peer[0]}:{peer[1]}" if peer else kind
+
+    def offer(self, ev: Event) -> bool:
+        """キューに積む。詰まりすぎて積めなければ False（呼び出し側で切断）"""
+        if self.closed:
+            return True
+        if ev.binary and not self.pcm:
+            return True
+        if len(self.q) >= self.max_items:
+            if ev.droppable:
+                self.dropped += 1
+                return True
+            for i, old in enumerate(self.q):
+                if old.droppable:
+                    del self.q[i]
+                    self.dropped += 1
+                    break
+            else:
+                return False
+        self.q.append(ev)
+        self.wake.set()
+        return True
+
+    async def pump(self):
+        try:
+            while not self.closed:
+                if not self.q:
+                    self.wake.clear()
+                    await self.wake.wait()
+                    continue
+                ev = self.q.popleft()
+                self.writer.write(ev.ws() if self.kind == "ws" else ev.sse())
+                await self.writer.drain()
+                self.sent += 1
+        except ConnectionError:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class Hub:
+    """全クライアントへの配信。emit はどのスレッドから呼んでもよい"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.clients: List[Client] = []
+        self.slow_disconnects = 0
+
+    def emit(self, etype: str, **fields):
+        self.publish(Event.json(etype, **fields))
+
+    def publish(self, ev: Event):
+        self.loop.call_soon_threadsafe(self._broadcast, ev)
+
+    def _broadcast(self, ev: Event):
+        for c in list(self.clients):
+            if not c.offer(ev):
+                self.slow_disconnects += 1
+                print(f"[server] {c.name} が追いつかないので切断（未送信 {len(c.q)} 件）", file=sys.stderr)
+                self.remove(c)
+
+    def wants_pcm(self) -> bool:
+        return any(c.pcm for c in self.clients)
+
+    def add(self, c: Client):
+        self.clients.append(c)
+
+    def remove(self, c: Client):
+        c.close()
+        if c in self.clients:
+            self.clients.remove(c)
+
+
+# ---------------- 生成・読み上げ ----------------
+def _choose_models() -> List[str]:
+    env = (os.environ.get("OPENAI_MODEL") or "").strip()
+    return [env] if env else DEFAULT_MODELS[:]
+
+
+class Voice:
+    """共有の読み上げ（エンジン 1 つ + セッション間の公平スケジューラ）。再生イベントを Hub へ流す"""
+
+    def __init__(self, hub: Hub):
+        from kiritan_engine_pool import pool_from_env
+        self.hub = hub
+        pool = pool_from_env()
+        self.engine = (PlaybackEngine(pool.render, lookahead=max(DEFAULT_LOOKAHEAD, pool.size))
+                       if pool else PlaybackEngine(backend_from_env()))
+        self.sched = FairScheduler(self.engine)
+        self.sched.on_start.append(self._on_start)
+        self.sched.on_finish.append(self._on_finish)
+        # 話速の倍率だけを決める（基準 1.0。ジョブごとの speed に掛ける）
+        self.speedctl = open_speedctl(1.0, tag="server")
+
+    def boost(self) -> float:
+        """いまの読み上げ待ちに応じた話速の倍率（適応話速が無効なら 1.0）"""
+        if self.speedctl is None:
+            return 1.0
+        return self.speedctl.update(self.sched.backlog_seconds())
+
+    def _on_start(self, item: SpeechItem):
+        seg: Segment = item.segment
+        self.hub.emit("play_start", id=item.tag, session=item.session.name, seg=seg.id, text=seg.text,
+                      duration=round(seg.duration, 3), waited=round(item.started_at - item.enqueued_at, 3))
+        if seg.pcm is not None and np is not None and self.hub.wants_pcm():
+            head = struct.pack("<II", seg.id, seg.fs)
+            pcm = (np.clip(seg.pcm, -1.0, 1.0) * 32767).astype("<i2")
+            step = max(1, int(seg.fs * PCM_CHUNK_SEC))
+            for i in range(0, len(pcm), step):
+                self.hub.publish(Event("pcm", head + pcm[i:i + step].tobytes(), binary=True))
+
+    def _on_finish(self, item: SpeechItem):
+        self.hub.emit("play_end", id=item.tag, session=item.session.name,
+                      seg=item.segment.id if item.segment else None, error=item.error)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def openai_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            if OpenAI is None:
+                raise RuntimeError("openai ライブラリが未インストールです。`pip install openai`")
+            _client = limit_client(OpenAI(api_key=os.environ.get("OPENAI_API_KEY")))
+        return _client
+
+
+class Speaker:
+    """1 セッション分の chat / say ジョブを 1 本ずつ処理し、途中経過を Hub へ流す"""
+
+    def __init__(self, hub: Hub, voice: Optional[Voice], session: str = DEFAULT_SESSION, speed: float = 1.0):
+        self.hub = hub
+        self.voice = voice
+        self.session = session
+        self.speed = speed
+        self.history: List[Dict[str, str]] = [{"role": "system", "content": SYSTEM_PROMPT}]
+        self.cancelled = threading.Event()
+        self.urgent = False
+        self.busy = False
+        self.last_used = time.time()
+
+    def _sentence(self, job_id: int, index: int, text: str, cid: int, speed: float):
+        self.hub.emit("sentence", id=job_id, session=self.session, index=index, text=text)
+        if self.voice is not None:
+            speed = min(4.0, speed * self.voice.boost())
+            item = self.voice.sched.submit(self.session, text, cid, speed, priority=URGENT if self.urgent else NORMAL,
+                                           preempt=self.urgent, tag=job_id)
+            if item is None:
+                self.hub.emit("dropped", id=job_id, session=self.session, index=index,
+                              reason="セッションの読み上げキューが上限")
+
+    # ---- ジョブ ----
+    def cancel(self):
+        self.cancelled.set()
+        if self.voice is not None:
+            self.voice.sched.cancel(self.session)
+
+    def run(self, job: Dict):
+        self.cancelled.clear()
+        job_id, kind, text = job["id"], job["type"], job["text"]
+        cid = int(job.get("cid") or CID_KIRITAN)
+        speed = float(job.get("speed") or self.speed)
+        self.urgent = bool(job.get("urgent"))
+        try:
+            if kind == "say":
+                for i, s in enumerate(split_sentences(text)):
+                    self._sentence(job_id, i, s, cid, speed)
+                self.hub.emit("reply", id=job_id, session=self.session, text=text)
+            else:
+                self._chat(job_id, text, cid, speed)
+        except Exception as e:
+            print(f"[server] job {job_id} 失敗: {e}", file=sys.stderr)
+            self.hub.emit("error", id=job_id, message=str(e))
+
+    def _chat(self, job_id: int, text: str, cid: int, speed: float):
+        self.history.append({"role": "user", "content": text})
+        messages = self.history[:1] + self.history[1:][-HISTORY_WINDOW:]
+        cutter = BUDGET.cutter("text", speed)
+        splitter = SentenceStream()
+        deltas = stream_chat(openai_client(), _choose_models(), messages, BUDGET.max_tokens("text", speed))
+        buf: List[str] = []
+        n = 0
+        try:
+            for delta in deltas:
+                if self.cancelled.is_set() or (cutter and cutter.feed(delta)):
+                    break
+                buf.append(delta)
+                self.hub.emit("delta", id=job_id, session=self.session, text=delta)
+                for s in splitter.feed(delta):
+                    self._sentence(job_id, n, s, cid, speed)
+                    n += 1
+        finally:
+            deltas.close()
+        if cutter is not None and cutter.exceeded:
+            reply = cutter.text()
+            # 読み上げ済みの所より後ろ（SentenceStream が次の文字待ちで抱えていた最後の文や、
+            # 1 文目から予算を超えて読点で切った文）を、同じ SentenceStream の区切りで読み上げる
+            rest = splitter.rest(reply)
+        else:
+            reply = cutter.text() if cutter else "".join(buf).strip()
+            rest = splitter.flush()
+        if not self.cancelled.is_set():
+            for s in rest:
+                self._sentence(job_id, n, s, cid, speed)
+                n += 1
+        self.history.append({"role": "assistant", "content": reply})
+        self.hub.emit("reply", id=job_id, session=self.session, text=reply, cancelled=self.cancelled.is_set())
+
+
+# ---------------- サーバ ----------------
+class Server:
+    def __init__(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT, speak: bool = True,
+                 speed: float = 1.0, max_queue: int = MAX_QUEUE):
+        self.host = host
+        self.port = port
+        self.speak = speak
+        self.speed = speed
+        self.max_queue = max_queue
+        self.hub: Optional[Hub] = None
+        self.voice: Optional[Voice] = None
+        self.speakers: Dict[str, Speaker] = {}
+        self.jobs: Dict[str, asyncio.Queue] = {}
+        self.workers: Dict[str, asyncio.Future] = {}
+        self.evicted = 0
+        self._next_id = 1
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.hub = Hub(loop)
+        self.voice = Voice(self.hub) if self.speak else None
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"[server] ws://{self.host}:{self.port}/ws  http://{self.host}:{self.port}/events")
+        async with server:
+            await server.serve_forever()
+
+    def speaker(self, session: str) -> Speaker:
+        """セッションごとの Speaker とジョブキュー（初回だけ作成）。生成はセッション間で並行、読み上げは公平に共有"""
+        sp = self.speakers.get(session)
+        if sp is None:
+            sp = self.speakers[session] = Speaker(self.hub, self.voice, session, self.speed)
+            self.jobs[session] = asyncio.Queue()
+            self.workers[session] = asyncio.ensure_future(self._worker(sp, self.jobs[session]))
+        sp.last_used = time.time()
+        return sp
+
+    def _idle(self, name: str) -> bool:
+        return not self.speakers[name].busy and self.jobs[name].empty()
+
+    def _evict(self, name: str):
+        self.speakers.pop(name, None)
+        self.jobs.pop(name, None)
+        worker = self.workers.pop(name, None)
+        if worker is not None:
+            worker.cancel()
+        if self.voice is not None:
+            self.voice.sched.remove(name)
+        self.evicted += 1
+
+    def _make_room(self, session: str) -> bool:
+        """新しいセッションの前に、放置されたセッションを片付ける。満杯で空きも無ければ False"""
+        if session in self.speakers:
+            return True
+        now = time.time()
+        for name in [n for n, sp in self.speakers.items() if now - sp.last_used >= SESSION_IDLE and self._idle(n)]:
+            self._evict(name)
+        if len(self.speakers) < MAX_SESSIONS:
+            return True
+        idle = [n for n in self.speakers if self._idle(n)]
+        if not idle:
+            return False
+        self._evict(min(idle, key=lambda n: self.speakers[n].last_used))
+        return True
+
+    async def _worker(self, sp: Speaker, jobs: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await jobs.get()
+            sp.busy = True
+            try:
+                await loop.run_in_executor(None, sp.run, job)
+            finally:
+                sp.busy = False
+                sp.last_used = time.time()
+
+    def submit(self, kind: str, text: str, session: str = DEFAULT_SESSION, **extra) -> int:
+        job_id = self._next_id
+        self._next_id += 1
+        self.speaker(session)
+        self.jobs[session].put_nowait(dict(extra, id=job_id, type=kind, text=text))
+        self.hub.emit("accepted", id=job_id, session=session, request=kind, text=text)
+        return job_id
+
+    def handle_message(self, msg: Dict) -> Dict:
+        kind = msg.get("type")
+        session = str(msg.get("session") or DEFAULT_SESSION)
+        if kind in ("chat", "say"):
+            text = str(msg.get("text") or "").strip()
+            if not text:
+                return {"error": "text が空です"}
+            weight = None
+            if msg.get("weight") is not None:
+                try:
+                    weight = float(msg["weight"])
+                except (TypeError, ValueError):
+                    weight = None
+                if weight is None or not math.isfinite(weight) or weight <= 0:
+                    return {"error": "weight が不正です（正の数）"}
+            if not self._make_room(session):
+                return {"error": f"セッション数が上限（{MAX_SESSIONS}）です"}
+            if self.voice is not None and weight is not None:
+                self.voice.sched.session(session, weight=weight)
+            return {"id": self.submit(kind, text, session, cid=msg.get("cid"), speed=msg.get("speed"),
+                                      urgent=bool(msg.get("urgent")))}
+        if kind == "cancel":
+            # session 指定ならそのセッションだけ、無ければ全部
+            name = msg.get("session")
+            for sp in ([self.speakers[name]] if name in self.speakers else []) if name else list(self.speakers.values()):
+                sp.cancel()
+            return {"ok": True}
+        return {"error": f"unknown type: {kind}"}
+
+    def status(self) -> Dict:
+        return {
+            "clients": [{"name": c.name, "queued": len(c.q), "sent": c.sent, "dropped": c.dropped}
+                        for c in self.hub.clients],
+            "jobs": {n: q.qsize() for n, q in self.jobs.items()},
+            "sessions_evicted": self.evicted,
+            "slow_disconnects": self.hub.slow_disconnects,
+            "backlog_s": round(self.voice.engine.backlog_seconds(), 2) if self.voice else 0.0,
+            "speech": self.voice.sched.status() if self.voice else None,
+            "speed_boost": round(self.voice.speedctl.current, 2) if self.voice and self.voice.speedctl else 1.0,
+            "ratelimit": get_limiter().stats.as_dict() if get_limiter() is not None else None,
+        }
+
+    # ---- HTTP ----
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        if len(head) > MAX_HEADER:
+            writer.close()
+            return
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            writer.close()
+            return
+        headers = {}
+        for ln in lines[1:]:
+            if ":" in ln:
+                k, v = ln.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        try:
+            if method == "GET" and url.path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self._websocket(reader, writer, headers, pcm=query.get("pcm", ["0"])[0] == "1")
+            elif method == "GET" and url.path == "/events":
+                await self._sse(writer)
+            elif method == "OPTIONS":
+                await self._respond(writer, 204, None)
+            elif method == "POST" and url.path in ("/chat", "/say", "/cancel"):
+                n = int(headers.get("content-length") or 0)
+                if n > MAX_MESSAGE:
+                    await self._respond(writer, 413, {"error": "too large"})
+                    return
+                body = await reader.readexactly(n) if n else b"{}"
+                try:
+                    msg = json.loads(body.decode("utf-8") or "{}")
+                except ValueError:
+                    await self._respond(writer, 400, {"error": "invalid json"})
+                    return
+                msg["type"] = url.path[1:]
+                res = self.handle_message(msg)
+                await self._respond(writer, 400 if "error" in res else 202, res)
+            elif method == "GET" and url.path == "/status":
+                await self._respond(writer, 200, self.status())
+            else:
+                await self._respond(writer, 404, {"error": "not found"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if not writer.is_closing():
+                writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, body: Optional[Dict]):
+        reason = {200: "OK", 202: "Accepted", 204: "No Content", 400: "Bad Request",
+                  404: "Not Found", 413: "Payload Too Large"}.get(status, "")
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else b""
+        writer.write((f"HTTP/1.1 {status} {reason}\r\n"
+                      "Content-Type: application/json; charset=utf-8\r\n"
+                      f"Content-Length: {len(data)}\r\n"
+                      "Access-Control-Allow-Origin: *\r\n"
+                      "Access-Control-Allow-Headers: Content-Type\r\n"
+                      "Connection: close\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+    async def _sse(self, writer: asyncio.StreamWriter):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n"
+                     b"Cache-Control: no-cache\r\nAccess-Control-Allow-Origin: *\r\n\r\n")
+        await writer.drain()
+        c = Client(writer, "sse", max_items=self.max_queue)
+        self.hub.add(c)
+        try:
+            await c.pump()
+        finally:
+            self.hub.remove(c)
+
+    # ---- WebSocket ----
+    async def _websocket(self, reader, writer, headers: Dict[str, str], pcm: bool):
+        key = headers.get("sec-websocket-key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        c = Client(writer, "ws", pcm=pcm, max_items=self.max_queue)
+        self.hub.add(c)
+        print(f"[server] 接続: {c.name}{' (pcm)' if pcm else ''}")
+        pump = asyncio.ensure_future(c.pump())
+        try:
+            await self._ws_receive(reader, c)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            pump.cancel()
+            self.hub.remove(c)
+            print(f"[server] 切断: {c.name}（送信 {c.sent} / 破棄 {c.dropped}）")
+
+    async def _ws_receive(self, reader: asyncio.StreamReader, c: Client):
+        parts: List[bytes] = []
+        while not c.closed:
+            fin, op, data = await ws_read(reader)
+            if op == OP_CLOSE:
+                c.writer.write(ws_frame(data[:2], OP_CLOSE))
+                return
+            if op == OP_PING:
+                c.writer.write(ws_frame(data, OP_PONG))
+                continue
+            if op == OP_PONG:
+                continue
+            parts.append(data)
+            if sum(len(p) for p in parts) > MAX_MESSAGE:
+                raise ValueError("message too large")
+            if not fin:
+                continue
+            raw, parts = b"".join(parts), []
+            try:
+                msg = json.loads(raw.decode("utf-8"))
+            except ValueError:
+                c.offer(Event.json("error", message="invalid json"))
+                continue
+            res = self.handle_message(msg if isinstance(msg, dict) else {})
+            c.offer(Event.json("error" if "error" in res else "ack", **res))
+
+
+def main():
+    p = argparse.ArgumentParser(prog="kiritan_server")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=DEFAULT_PORT)
+    p.add_argument("--speed", type=float, default=1.0)
+    p.add_argument("--queue", type=int, default=MAX_QUEUE, help="クライアントごとの未送信イベント上限")
+    p.add_argument("--no-speak", action="store_true", help="読み上げずにテキストのイベントだけ流す")
+    args = p.parse_args()
+    server = Server(args.host, args.port, speak=not args.no_speak,
+                    speed=max(0.5, min(4.0, args.speed)), max_queue=args.queue)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        print("\n(CTRL+C) 終了します。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+会話セッションの永続化（SQLite）
+- WAL モード / ターンは追記のみ / (session_id, id) と ts にインデックス
+- 再開時はトークン予算に収まる末尾だけを新しい順に読む（全件は読まない）
+- fork は親セッションへのポインタ（親 id + 分岐時点のターン id）だけを作るので一瞬で終わる
+- 既存のプレーンテキストログ（logs/YYYY-MM-DD.txt）の取り込みにも対応
+
+GUI 版のコマンド:
+  /session list               … 最近のセッション一覧
+  /session resume [id]        … 指定（省略時は直前）のセッションを再開
+  /session fork [名前]         … 現在のセッションを分岐して続ける
+  /session import <log.txt>   … テキストログを新しいセッションとして取り込む
+"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Tuple
+
+DB_PATH = os.getenv("KIRITAN_SESSION_DB") or os.path.join("logs", "sessions.db")
+DEFAULT_TAIL_TOKENS = 2000    # 再開時に読み込む末尾のトークン予算
+PAGE = 64                     # 末尾読み込み 1 回あたりの行数
+HISTORY_KEEP = 64             # メモリ上の history に残す件数（全件は SQLite にあるので、古い分は捨ててよい）
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id            INTEGER PRIMARY KEY,
+    name          TEXT,
+    system_prompt TEXT NOT NULL DEFAULT '',
+    parent_id     INTEGER,
+    fork_turn_id  INTEGER,
+    created_at    REAL NOT NULL,
+    updated_at    REAL NOT NULL,
+    turn_count    INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS turns (
+    id         INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL,
+    ts         REAL NOT NULL,
+    role       TEXT NOT NULL,
+    content    TEXT NOT NULL,
+    tokens     INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_session ON turns(session_id, id);
+CREATE INDEX IF NOT EXISTS turns_ts ON turns(ts);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated_at);
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """ざっくりトークン数（日本語は 1 文字 ≒ 1 トークン、ASCII は 4 文字 ≒ 1 トークン）"""
+    if not text:
+        return 1
+    ascii_n = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_n) + (ascii_n + 3) // 4 + 4
+
+
+def trim_history(history: List[Dict[str, str]], keep: int = HISTORY_KEEP) -> List[Dict[str, str]]:
+    """先頭の system と末尾 keep 件だけを残す（その場で詰める。長時間運転で history が伸び続けないように）"""
+    if len(history) > keep + 1:
+        del history[1:len(history) - keep]
+    return history
+
+
+@dataclass
+class SessionInfo:
+    id: int
+    name: Optional[str]
+    system_prompt: str
+    parent_id: Optional[int]
+    fork_turn_id: Optional[int]
+    created_at: float
+    updated_at: float
+    turn_count: int
+
+
+class SessionStore:
+    def __init__(self, path: str = DB_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # ---- セッション ----
+    def create(self, name: Optional[str] = None, system_prompt: str = "",
+               parent_id: Optional[int] = None, fork_turn_id: Optional[int] = None) -> int:
+        now = time.time()
+        with self.lock:
+            cur = self.db.execute(
+                "INSERT INTO sessions(name, system_prompt, parent_id, fork_turn_id, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (name, system_prompt or "", parent_id, fork_turn_id, now, now))
+            return cur.lastrowid
+
+    def get(self, session_id: int) -> Optional[SessionInfo]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, name, system_prompt, parent_id, fork_turn_id, created_at, updated_at, turn_count"
+                " FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return SessionInfo(*row) if row else None
+
+    def list(self, limit: int = 20) -> List[SessionInfo]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, name, system_prompt, parent_id, fork_turn_id, created_at, updated_at, turn_count"
+                " FROM sessions ORDER BY updated_at DESC LIMIT ?", (limit,)).fetchall()
+        return [SessionInfo(*r) for r in rows]
+
+    def latest(self, exclude: Optional[int] = None) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id FROM sessions WHERE id IS NOT ? AND turn_count > 0"
+                " ORDER BY updated_at DESC LIMIT 1", (exclude,)).fetchone()
+        return row[0] if row else None
+
+    def fork(self, session_id: int, name: Optional[str] = None) -> int:
+        """分岐時点の末尾ターン id を覚えるだけ（ターンはコピーしない）"""
+        info = self.get(session_id)
+        if info is None:
+            raise KeyError(session_id)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MAX(id) FROM turns WHERE session_id = ?", (session_id,)).fetchone()
+        return self.create(name or f"{info.name or session_id} fork", info.system_prompt,
+                           parent_id=session_id, fork_turn_id=row[0] or 0)
+
+    # ---- ターン ----
+    def append(self, session_id: int, role: str, content: str, ts: Optional[float] = None) -> int:
+        ts = ts or time.time()
+        with self.lock:
+            # autocommit 接続なので BEGIN は手で。失敗したら ROLLBACK しないと以後の BEGIN が全部失敗する
+            self.db.execute("BEGIN")
+            try:
+                cur = self.db.execute(
+                    "INSERT INTO turns(session_id, ts, role, content, tokens) VALUES (?, ?, ?, ?, ?)",
+                    (session_id, ts, role, content, estimate_tokens(content)))
+                self.db.execute(
+                    "UPDATE sessions SET updated_at = ?, turn_count = turn_count + 1 WHERE id = ?",
+                    (ts, session_id))
+                self.db.execute("COMMIT")
+            except BaseException:
+                if self.db.in_transaction:
+                    self.db.execute("ROLLBACK")
+                raise
+            return cur.lastrowid
+
+    def tail(self, session_id: int, token_budget: int = DEFAULT_TAIL_TOKENS) -> List[Dict[str, str]]:
+        """トークン予算に収まる末尾ターンを古い順で返す。fork 元のセッションもさかのぼる"""
+        picked: List[Tuple[str, str]] = []
+        used = 0
+        sid: Optional[int] = session_id
+        upto: Optional[int] = None
+        with self.lock:
+            while sid is not None and used < token_budget:
+                cursor_id = upto if upto is not None else (1 << 62)
+                while used < token_budget:
+                    rows = self.db.execute(
+                        "SELECT id, role, content, tokens FROM turns"
+                        " WHERE session_id = ? AND id <= ? ORDER BY id DESC LIMIT ?",
+                        (sid, cursor_id, PAGE)).fetchall()
+                    if not rows:
+                        break
+                    for tid, role, content, tokens in rows:
+                        if used + tokens > token_budget and picked:
+                            used = token_budget
+                            break
+                        picked.append((role, content))
+                        used += tokens
+                    cursor_id = rows[-1][0] - 1
+                    if len(rows) < PAGE:
+                        break
+                parent = self.db.execute(
+                    "SELECT parent_id, fork_turn_id FROM sessions WHERE id = ?", (sid,)).fetchone()
+                sid, upto = (parent if parent else (None, None))
+        picked.reverse()
+        return [{"role": r, "content": c} for r, c in picked]
+
+    def turns_after(self, turn_id: int, limit: int = 2000) -> List[Tuple[int, int, str, str]]:
+        """turns.id > turn_id のターンを (id, session_id, role, content) で古い順に返す"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT id, session_id, role, content FROM turns WHERE id > ? ORDER BY id LIMIT ?",
+                (turn_id, limit)).fetchall()
+
+    def get_turns(self, turn_ids: List[int]) -> List[Tuple[int, str, str]]:
+        if not turn_ids:
+            return []
+        marks = ",".join("?" * len(turn_ids))
+        with self.lock:
+            return self.db.execute(
+                f"SELECT id, role, content FROM turns WHERE id IN ({marks})", list(turn_ids)).fetchall()
+
+    # ---- 取り込み ----
+    def import_text_log(self, path: str) -> Tuple[int, int]:
+        """`[user] ...\\n[assistant] ...\\n---` 形式のログを 1 セッションとして取り込む"""
+        with open(path, "r", encoding="utf-8") as f:
+            raw = f.read()
+        base = os.path.getmtime(path)
+        sid = self.create(name=os.path.basename(path))
+        n = 0
+        for m in re.finditer(r"^\[(user|assistant)\] (.*?)(?=^\[(?:user|assistant)\] |^---$|\Z)",
+                             raw, flags=re.M | re.S):
+            self.append(sid, m.group(1), m.group(2).strip(), ts=base + n * 1e-3)
+            n += 1
+        return sid, n
+
+
+# ---------------- コマンド ----------------
+def handle_command(store: SessionStore, arg: str, current: Optional[int],
+                   system_prompt: str) -> Tuple[Optional[int], Optional[List[Dict[str, str]]]]:
+    """
+    `/session ...` を処理する。
+    戻り値: (以後のセッション id, 置き換える history（変更なしなら None）)
+    """
+    sub, *rest = (arg or "list").split(" ", 1)
+    rest = rest[0].strip() if rest else ""
+
+    if sub == "list":
+        for s in store.list():
+            mark = "*" if s.id == current else " "
+            fork = f" ← #{s.parent_id}" if s.parent_id else ""
+            print(f"{mark} #{s.id:<4} {time.strftime('%m-%d %H:%M', time.localtime(s.updated_at))}"
+                  f"  {s.turn_count:>5} turns  {s.name or ''}{fork}")
+        return current, None
+
+    if sub == "resume":
+        sid = int(rest) if rest.isdigit() else store.latest(exclude=current)
+        info = store.get(sid) if sid is not None else None
+        if info is None:
+            print("[session] 再開できるセッションがありません。")
+            return current, None
+        t0 = time.perf_counter()
+        tail = store.tail(sid)
+        ms = (time.perf_counter() - t0) * 1000
+        sp = info.system_prompt or system_prompt
+        print(f"[session] #{sid} を再開（末尾 {len(tail)} 件 / {ms:.1f}ms）")
+        return sid, [{"role": "system", "content": sp}] + tail
+
+    if sub == "fork":
+        if current is None:
+            print("[session] まだ記録されたターンがありません。")
+            return current, None
+        sid = store.fork(current, rest or None)
+        print(f"[session] #{current} から #{sid} へ分岐しました。")
+        return sid, None
+
+    if sub == "import":
+        if not rest or not os.path.exists(rest):
+            print("使い方: /session import logs/2025-01-01.txt")
+            return current, None
+        sid, n = store.import_text_log(rest)
+        print(f"[session] {rest} を #{sid} として取り込みました（{n} 件）。/session resume {sid} で再開できます。")
+        return current, None
+
+    print("使い方: /session list | resume [id] | fork [名前] | import <log.txt>")
+    return current, None
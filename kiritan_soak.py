@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+長時間運転の耐久テスト（メモリ・ハンドルの増え方を測る）
+- フェイクの LLM / 合成 / 再生（kiritan_fake）で、音声版 GUI と同じ流れのターンを何千回も回す:
+  文字起こしの判定（kiritan_asr_filter）→ 投機実行（kiritan_speculate）→ 履歴の窓 → stream_chat →
+  読み上げ予算 → 再生エンジン → セッションの記録（SQLite、一時ファイル）→ 履歴の切り詰め
+- 一定ターンごとに gc してから tracemalloc のスナップショット・RSS・ハンドル数（fd）・スレッド数を記録
+- ウォームアップ後の増え方を最小二乗の傾きで出し、「実運転 1 時間あたり」（既定 360 ターン/時 = 10 秒に 1 ターン）に
+  換算して予算と比べる。予算超え / ハンドル・スレッドの増加はリークとみなして終了コード 1
+- 終了時に、ウォームアップ時点から増えた確保元の上位を表示
+
+使い方:
+  python kiritan_soak.py --turns 5000 [--every 250] [--budget 2.0] [--json soak.json]
+
+設定（環境変数）:
+  KIRITAN_SOAK_BUDGET=2.0   … 1 時間あたりの増加の上限（MB、--budget が優先）
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+import tracemalloc
+from typing import Optional, List, Dict
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+from kiritan_fake import FakeLLM, FakeSpeech, FakePlaybackEngine
+from kiritan_hedge import stream_chat
+from kiritan_budget import SpeechBudget, GUI_SPEED, collect
+from kiritan_session import SessionStore, trim_history
+from kiritan_speculate import Speculator
+from kiritan_asr_filter import AsrFilter
+
+DEFAULT_TURNS = 2000
+DEFAULT_EVERY = 200
+DEFAULT_BUDGET_MB = 2.0       # 1 時間あたりの増加の上限
+TURNS_PER_HOUR = 360          # 実運転の想定（10 秒に 1 ターン）
+HANDLE_SLACK = 8              # ウォームアップ後に増えてもよいハンドル / スレッド数
+TOP_SITES = 10
+WINDOW = 12
+CID = 1707
+MB = 1024.0 * 1024.0
+
+_IGNORE = [tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+           tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+           tracemalloc.Filter(False, tracemalloc.__file__),
+           tracemalloc.Filter(False, "<unknown>")]
+
+
+# ---------------- プロセスの計測 ----------------
+def rss_bytes() -> Optional[int]:
+    """常駐メモリ（psutil → /proc の順。どちらも無ければ None）"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def handle_count() -> Optional[int]:
+    """開いているハンドル数（Windows はハンドル、それ以外は fd）"""
+    if psutil is not None:
+        p = psutil.Process()
+        return p.num_handles() if hasattr(p, "num_handles") else p.num_fds()
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def slope(xs: List[float], ys: List[float]) -> float:
+    """最小二乗の傾き（点が 2 つ未満なら 0）"""
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mx, my = sum(xs) / n, sum(ys) / n
+    den = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / den if den else 0.0
+
+
+# ---------------- 1 ターン ----------------
+class SoakRig:
+    """GUI と同じ部品を、フェイクの LLM / 合成 / 再生につないだもの"""
+
+    def __init__(self, scale: float = 0.0, db_path: Optional[str] = None):
+        self.llm = FakeLLM(scale=scale)
+        self.speech = FakeSpeech(scale=scale, render_sec=0.0)
+        self.engine = FakePlaybackEngine(self.speech, scale=scale)
+        self.budget = SpeechBudget.from_env()
+        self.asr_filter = AsrFilter()
+        self.store = SessionStore(db_path or os.path.join(tempfile.mkdtemp(prefix="kiritan-soak-"), "soak.db"))
+        self.session_id = self.store.create(name="soak", system_prompt="soak")
+        self.history: List[Dict[str, str]] = [{"role": "system", "content": "soak"}]
+        self.spec = Speculator(lambda text, cancel: self._chat(self._window(text)))
+        self.spoken = 0
+        self.dropped = 0
+
+    def _window(self, text: str) -> List[Dict[str, str]]:
+        return (self.history + [{"role": "user", "content": text}])[-WINDOW:]
+
+    def _chat(self, messages: List[Dict[str, str]]) -> str:
+        deltas = stream_chat(self.llm, ["gpt-4o-mini"], messages, self.budget.max_tokens("text", GUI_SPEED))
+        try:
+            return collect(deltas, self.budget.cutter("text", GUI_SPEED))
+        finally:
+            deltas.close()
+
+    def turn(self, i: int):
+        user = f"テスト {i}: 今日は{('晴れ', '雨', '曇り')[i % 3]}なので、{i % 7} 時ごろに出かけようと思います"
+        pcm = (np.random.default_rng(i).normal(0.0, 0.1, 16000).astype(np.float32)
+               if np is not None else None)
+        if self.asr_filter.check(user, pcm, 16000):
+            self.dropped += 1
+            return
+        # 途中の文字起こし → 最終結果（半分は同じ文 = 的中、残りは外れ）
+        self.spec.offer(user if i % 2 else user[:-4])
+        reply = self.spec.resolve(user, lambda: self._chat(self._window(user)))
+        self.history.append({"role": "user", "content": user})
+        self.history.append({"role": "assistant", "content": reply})
+        trim_history(self.history)
+        self.store.append(self.session_id, "user", user)
+        self.store.append(self.session_id, "assistant", reply)
+        segs = self.engine.speak(reply, CID, GUI_SPEED)
+        if segs:
+            self.engine.wait(segs[-1], timeout=30.0)
+        self.spoken += 1
+
+    def close(self):
+        self.engine.close()
+        self.store.close()
+
+
+# ---------------- 計測ループ ----------------
+def sample(turn: int, t0: float) -> Dict:
+    gc.collect()
+    traced, _ = tracemalloc.get_traced_memory()
+    return {"turn": turn, "t": round(time.time() - t0, 2), "traced": traced, "rss": rss_bytes(),
+            "handles": handle_count(), "threads": threading.active_count()}
+
+
+def line(s: Dict, base: Optional[Dict]) -> str:
+    d = lambda k: f"（{(s[k] - base[k]) / MB:+.2f}）" if base and s.get(k) is not None and base.get(k) is not None else ""
+    rss = f"RSS {s['rss'] / MB:.1f}MB{d('rss')}" if s["rss"] is not None else "RSS -"
+    return (f"turn {s['turn']:6d} / {s['t']:7.1f}s | traced {s['traced'] / MB:.2f}MB{d('traced')} | {rss}"
+            f" | handles {s['handles'] if s['handles'] is not None else '-'} | threads {s['threads']}")
+
+
+def analyze(samples: List[Dict], warmup: int, budget_mb: float, turns_per_hour: float) -> Dict:
+    """ウォームアップ後の増え方（MB/時）と、予算・ハンドルの判定"""
+    after = [s for s in samples if s["turn"] >= warmup]
+    xs = [float(s["turn"]) for s in after]
+    per_hour = lambda key: slope(xs, [s[key] / MB for s in after]) * turns_per_hour
+    res = {"traced_mb_per_hour": round(per_hour("traced"), 3), "failures": []}
+    if all(s["rss"] is not None for s in after):
+        res["rss_mb_per_hour"] = round(per_hour("rss"), 3)
+    for key in ("traced_mb_per_hour", "rss_mb_per_hour"):
+        if res.get(key) is not None and res[key] > budget_mb:
+            res["failures"].append(f"{key} {res[key]:.2f} > 予算 {budget_mb:.2f}MB/時")
+    if len(after) >= 2:
+        for key in ("handles", "threads"):
+            first, last = after[0][key], after[-1][key]
+            if first is not None and last is not None and last - first > HANDLE_SLACK:
+                res["failures"].append(f"{key} が {first} → {last} に増加")
+    return res
+
+
+def top_growth(base: tracemalloc.Snapshot, now: tracemalloc.Snapshot, n: int = TOP_SITES) -> List[str]:
+    diff = now.filter_traces(_IGNORE).compare_to(base.filter_traces(_IGNORE), "lineno")
+    return [str(d) for d in diff if d.size_diff > 0][:n]
+
+
+def run(turns: int, every: int, warmup: int, budget_mb: float, turns_per_hour: float,
+        scale: float = 0.0) -> Dict:
+    tracemalloc.start(10)
+    rig = SoakRig(scale=scale)
+    t0 = time.time()
+    samples: List[Dict] = []
+    base_snap: Optional[tracemalloc.Snapshot] = None
+    base_sample: Optional[Dict] = None
+    try:
+        for i in range(1, turns + 1):
+            try:
+                rig.turn(i)
+            except Exception as e:
+                print(f"[soak] turn {i} 失敗: {e}", file=sys.stderr)
+            if i % every == 0 or i == turns:
+                s = sample(i, t0)
+                samples.append(s)
+                if base_snap is None and i >= warmup:
+                    base_snap, base_sample = tracemalloc.take_snapshot(), s
+                print(f"[soak] {line(s, base_sample)}")
+        final = tracemalloc.take_snapshot()
+    finally:
+        rig.close()
+    res = analyze(samples, warmup, budget_mb, turns_per_hour)
+    res.update(turns=turns, spoken=rig.spoken, dropped=rig.dropped, wall_s=round(time.time() - t0, 1),
+               spec=rig.spec.stats.summary(), samples=samples,
+               growth=top_growth(base_snap, final) if base_snap is not None else [])
+    tracemalloc.stop()
+    return res
+
+
+def main():
+    p = argparse.ArgumentParser(prog="kiritan_soak")
+    p.add_argument("--turns", type=int, default=DEFAULT_TURNS)
+    p.add_argument("--every", type=int, default=DEFAULT_EVERY, help="計測の間隔（ターン）")
+    p.add_argument("--warmup", type=int, default=None, help="これ以降の増え方で判定（既定は全体の 1/5）")
+    p.add_argument("--budget", type=float, default=None, help="1 時間あたりの増加の上限（MB）")
+    p.add_argument("--turns-per-hour", type=float, default=TURNS_PER_HOUR, help="実運転の 1 時間あたりのターン数")
+    p.add_argument("--scale", type=float, default=0.0, help="フェイクの時間の伸縮（0 = 待たない）")
+    p.add_argument("--json", help="結果（計測点を含む）の書き出し先")
+    args = p.parse_args()
+
+    budget = args.budget
+    if budget is None:
+        try:
+            budget = float(os.getenv("KIRITAN_SOAK_BUDGET") or DEFAULT_BUDGET_MB)
+        except ValueError:
+            budget = DEFAULT_BUDGET_MB
+    warmup = args.warmup if args.warmup is not None else max(args.every, args.turns // 5)
+    every = max(1, args.every)
+    print(f"[soak] {args.turns} ターン（計測 {every} ごと、ウォームアップ {warmup}、予算 {budget:.2f}MB/時"
+          f" @ {args.turns_per_hour:.0f} ターン/時）")
+    res = run(args.turns, every, warmup, budget, args.turns_per_hour, args.scale)
+
+    print(f"\n[soak] {res['spoken']} ターン読み上げ / 判定で捨てた {res['dropped']} / {res['wall_s']}s")
+    print(f"[soak] 投機実行: {res['spec']}")
+    rss = f" / RSS {res['rss_mb_per_hour']:+.2f}MB/時" if "rss_mb_per_hour" in res else ""
+    print(f"[soak] 増え方: traced {res['traced_mb_per_hour']:+.2f}MB/時{rss}")
+    if res["growth"]:
+        print("[soak] ウォームアップ後に増えた確保元:")
+        for g in res["growth"]:
+            print(f"  {g}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=1)
+    if res["failures"]:
+        for msg in res["failures"]:
+            print(f"[soak] 失敗: {msg}", file=sys.stderr)
+        sys.exit(1)
+    print("[soak] OK（予算内）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+途中の文字起こしで返答の生成を先に始める（音声会話の投機実行）
+- ストリーミング ASR（kiritan_asr_stream.py）が間で区切ったところまでの途中結果を offer() で受け、
+  その文で chat を裏で走らせておく（発話終了の判定を待つ時間と、生成の時間を重ねる）
+- 最終の文字起こしが来たら resolve()。正規化（NFKC・大小文字・空白/句読点）して同じなら先行した結果を使う。
+  違えば先行分を取り消して、最終の文でやり直す
+- 途中結果が変われば、古い先行分は取り消して新しい文で投げ直す
+- ターンごとの 的中 / 外れ / 取り消した呼び出し と、的中したときの短縮秒数を集計
+
+使い方:
+  spec = Speculator(lambda text, cancel: chat_once(window(text), cancel=cancel, quiet=True))
+  st = StreamingTranscriber(..., on_partial=spec.offer)
+  reply = spec.resolve(final_text, lambda: chat_once(window(final_text)))
+
+設定（環境変数）:
+  KIRITAN_SPECULATE=1   … 有効（既定は無効。外れると LLM の呼び出しが 1 回ぶん無駄になる）
+"""
+
+import os
+import re
+import sys
+import time
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Dict
+
+MIN_CHARS = 4                 # これより短い途中結果では先行しない（相槌や言い淀み）
+
+
+class Cancelled(Exception):
+    """先行した生成が取り消された（run の中で cancel が立ったら投げる）"""
+
+
+def normalize(text: str) -> str:
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"[\s\W_]+", "", t)
+
+
+def enabled() -> bool:
+    return (os.getenv("KIRITAN_SPECULATE") or "").strip().lower() in ("1", "on", "true")
+
+
+# ---------------- 統計 ----------------
+class SpecStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.speculated = 0       # 先行した生成があったターン
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0            # 先行で投げた生成
+        self.wasted = 0           # 取り消した / 使わなかった先行分
+        self.saved: deque = deque(maxlen=500)     # 的中したターンの短縮秒数
+
+    def summary(self) -> str:
+        with self.lock:
+            rate = self.hits / self.speculated if self.speculated else 0.0
+            s = sorted(self.saved)
+            p50 = s[len(s) // 2] if s else 0.0
+            avg = sum(s) / len(s) if s else 0.0
+            return (f"ターン {self.turns}: 先行 {self.speculated} / 的中 {self.hits}（{rate:.0%}）/ 外れ {self.misses}"
+                    f" | 先行の呼び出し {self.calls}（無駄 {self.wasted}）| 短縮 平均 {avg:.2f}s p50 {p50:.2f}s")
+
+
+class _Attempt:
+    def __init__(self, text: str):
+        self.text = text
+        self.norm = normalize(text)
+        self.cancel = threading.Event()
+        self.started = time.time()
+        self.done_at: Optional[float] = None
+        self.future = None
+
+
+# ---------------- 本体 ----------------
+class Speculator:
+    """run(text, cancel) … 返答の生成。cancel（threading.Event）が立ったら Cancelled を投げて抜ける"""
+
+    def __init__(self, run: Callable[[str, threading.Event], object], min_chars: int = MIN_CHARS):
+        self.run = run
+        self.min_chars = min_chars
+        self.stats = SpecStats()
+        self.last: Dict = {}      # 直近のターンの結果（{"spec": "hit"|"miss"|None, "saved": 秒}）
+        self._current: Optional[_Attempt] = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="spec")
+
+    def offer(self, partial: str):
+        """途中の文字起こし。前回と（正規化して）違えば先行分を差し替える"""
+        attempt = _Attempt(partial)
+        if len(attempt.norm) < self.min_chars:
+            return
+        # future を持たない attempt を resolve() に見せないよう、投入してから lock の中で差し替える
+        with self._lock:
+            old = self._current
+            if old is not None and old.norm == attempt.norm:
+                return
+            attempt.future = self._pool.submit(self._run, attempt)
+            self._current = attempt
+        self._drop(old)
+        with self.stats.lock:
+            self.stats.calls += 1
+
+    def _run(self, attempt: _Attempt):
+        try:
+            return self.run(attempt.text, attempt.cancel)
+        finally:
+            attempt.done_at = time.time()
+
+    def _drop(self, attempt: Optional[_Attempt]):
+        if attempt is None:
+            return
+        attempt.cancel.set()
+        with self.stats.lock:
+            self.stats.wasted += 1
+
+    def discard(self):
+        """このターンは返答しない（コマンドだった / 自分の声だった等）。先行分は取り消す"""
+        with self._lock:
+            old, self._current = self._current, None
+        self._drop(old)
+
+    def resolve(self, final: str, fallback: Optional[Callable[[], object]] = None):
+        """最終の文字起こしで返答を得る（先行分が同じ文なら、その結果を待って使う。違えば fallback()）"""
+        t_final = time.time()
+        with self._lock:
+            attempt, self._current = self._current, None
+        with self.stats.lock:
+            self.stats.turns += 1
+            if attempt is not None:
+                self.stats.speculated += 1
+        if attempt is not None and attempt.norm == normalize(final):
+            try:
+                result = attempt.future.result()
+            except Exception as e:
+                # 先行分が失敗しただけなら、普通にやり直す
+                print(f"[spec] 先行した生成が失敗: {e}", file=sys.stderr)
+            else:
+                # 先行なしなら t_final から生成時間ぶんかかっていた
+                saved = max(0.0, min(attempt.done_at - attempt.started, t_final - attempt.started))
+                with self.stats.lock:
+                    self.stats.hits += 1
+                    self.stats.saved.append(saved)
+                self.last = {"spec": "hit", "saved": round(saved, 3)}
+                return result
+        if attempt is not None:
+            self._drop(attempt)
+            with self.stats.lock:
+                self.stats.misses += 1
+        self.last = {"spec": "miss" if attempt is not None else None, "saved": 0.0}
+        return fallback() if fallback is not None else self.run(final, threading.Event())
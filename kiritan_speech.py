@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+読み上げの出口（SpeechBackend）を 1 つの形にそろえる
+- speak（その場で再生）/ render_to_file（WAV に書き出し）/ render_to_buffer（PCM で受け取る）/ cancel / capabilities
+- 呼び出すと render_to_file と同じ（RenderFn 互換）なので、PlaybackEngine・EnginePool・FairScheduler にそのまま渡せる
+- 実装:
+    SeikaCliBackend     … SeikaSay2.exe（-play / -save）
+    SeikaHttpBackend    … AssistantSeika の HTTP 機能（/PLAY2 /SAVE2。別マシンの Windows で合成）
+    VoiceroidUiaBackend … 起動中の VOICEROID を UIA で操作（貼り付け → 再生 / 音声保存）
+    HeadlessBackend     … Windows なし。合成音（無音 / トーン）か、録り置きの WAV を返す
+  → 会話・キャッシュ・スケジューリングは Linux でも動かし、最後の合成だけ Windows に任せられる
+- 録り置きは cache/render と同じファイル名（cache_key(text, cid, speed).wav）で探すので、
+  Windows 側のレンダリングキャッシュをコピーすれば同じ声で再生できる
+
+設定（環境変数 KIRITAN_SPEECH。KIRITAN_ENGINES の 1 項目と同じ書式）:
+  seika / seika:1707          … SeikaSay2（既定）
+  http://host:7180/1707       … AssistantSeika HTTP（SEIKA_HTTP_USER / SEIKA_HTTP_PASS）
+  voiceroid                   … 起動中の VOICEROID（最初の 1 枚）
+  null / tone                 … 無音 / トーン（話速の見積もりどおりの長さ）
+  file:cache/render           … 録り置きの WAV（無い文は無音）
+
+  python kiritan_speech.py --backend null --say "こんにちは。"
+  python kiritan_speech.py --backend seika --out hello.wav --say "こんにちは。"
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import wave
+import base64
+import shutil
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from typing import Optional, List, Dict, Tuple, Iterable
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+try:
+    import sounddevice as sd
+except Exception:
+    sd = None
+
+from kiritan_playback import seika_exe_path, seika_save, decode_wav, cache_key
+from kiritan_budget import estimate_seconds
+
+CID_KIRITAN = 1707
+SAVE_TIMEOUT = 30.0           # VOICEROID / HTTP の書き出し待ち
+HEADLESS_FS = 16000
+TONE_HZ = 220.0
+TONE_LEVEL = 0.05
+
+# 能力（capabilities の caps）
+SPEAK = "speak"               # 自分で再生できる
+RENDER = "render"             # WAV / PCM に書き出せる
+CANCEL = "cancel"             # 再生中に止められる
+SPEED = "speed"               # 話速の指定が効く
+HEADLESS = "headless"         # この機械に Windows デスクトップが要らない
+
+# VOICEROID の UI 操作（貼り付け → 保存ダイアログ）は前面ウィンドウとキーボードを取り合うので全体で 1 本ずつ
+_UI_LOCK = threading.Lock()
+
+
+def wait_file(path: str, timeout: float) -> bool:
+    """ファイルが現れてサイズが落ち着くまで待つ"""
+    end = time.time() + timeout
+    last = -1
+    while time.time() < end:
+        size = os.path.getsize(path) if os.path.exists(path) else -1
+        if size > 44 and size == last:
+            return True
+        last = size
+        time.sleep(0.2)
+    return False
+
+
+def wav_seconds(path: str) -> float:
+    try:
+        with wave.open(path, "rb") as w:
+            return w.getnframes() / float(w.getframerate())
+    except Exception:
+        return 0.0
+
+
+def play_wav(path: str, cancel: Optional[threading.Event] = None) -> bool:
+    """WAV を手元で鳴らして終わるまで待つ（cancel が立てば止めて False）。音が出せない環境では長さだけ待つ"""
+    cancel = cancel or threading.Event()
+    if sd is not None and np is not None:
+        pcm, fs = decode_wav(path)
+        sd.play(pcm, fs)
+        end = time.time() + len(pcm) / float(fs)
+        while time.time() < end:
+            if cancel.wait(0.05):
+                sd.stop()
+                return False
+        sd.wait()
+        return True
+    end = time.time() + wav_seconds(path)
+    try:
+        import winsound
+        winsound.PlaySound(path, winsound.SND_FILENAME | winsound.SND_ASYNC)
+    except Exception:
+        winsound = None
+    while time.time() < end:
+        if cancel.wait(0.05):
+            if winsound is not None:
+                winsound.PlaySound(None, 0)
+            return False
+    return True
+
+
+def _temp_wav() -> str:
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
+    tmp.close()
+    return tmp.name
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except Exception:
+        pass
+
+
+# ---------------- 共通 ----------------
+class SpeechBackend:
+    """読み上げの出口 1 つ。少なくとも render_to_file か speak のどちらかを実装する"""
+    kind = "base"
+    caps = frozenset()
+
+    def __init__(self, name: Optional[str] = None, voices: Iterable[int] = ()):
+        self.name = name or self.kind
+        self.voices = set(voices)         # 出せる cid（空 = 指定された cid をそのまま使う）
+        self._cancel = threading.Event()
+
+    def render_to_file(self, text: str, cid: int, speed: float, path: str) -> bool:
+        raise NotImplementedError(f"{self.kind} は書き出しに対応していません")
+
+    def render_to_buffer(self, text: str, cid: int, speed: float) -> Optional[Tuple["np.ndarray", int]]:
+        """mono float32 の PCM とサンプルレート（失敗時 None）"""
+        path = _temp_wav()
+        try:
+            if not self.render_to_file(text, cid, speed, path):
+                return None
+            return decode_wav(path)
+        finally:
+            _remove(path)
+
+    def speak(self, text: str, cid: int, speed: float = 1.0) -> bool:
+        """再生し終わるまで待つ。既定は書き出してから手元で鳴らす"""
+        self._cancel.clear()
+        path = _temp_wav()
+        try:
+            if not self.render_to_file(text, cid, speed, path):
+                return False
+            return play_wav(path, self._cancel)
+        finally:
+            _remove(path)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def health(self) -> bool:
+        return True
+
+    def capabilities(self) -> Dict:
+        return {"name": self.name, "kind": self.kind, "caps": sorted(self.caps), "voices": sorted(self.voices)}
+
+    def __call__(self, text: str, cid: int, speed: float, path: str) -> bool:
+        # RenderFn 互換
+        return self.render_to_file(text, cid, speed, path)
+
+    def __repr__(self):
+        return f"<{self.kind} {self.name}>"
+
+
+# ---------------- SeikaSay2 ----------------
+class SeikaCliBackend(SpeechBackend):
+    """SeikaSay2.exe。cid を固定すると別インスタンスを「同じ声」として使える"""
+    kind = "seika"
+    caps = frozenset({SPEAK, RENDER, CANCEL, SPEED})
+
+    def __init__(self, cid: Optional[int] = None, voice: Optional[int] = None):
+        super().__init__(f"seika:{cid}" if cid else "seika", [voice or cid] if (voice or cid) else ())
+        self.cid = cid
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    def render_to_file(self, text: str, cid: int, speed: float, path: str) -> bool:
+        return seika_save(text, self.cid or cid, speed, path)
+
+    def speak(self, text: str, cid: int, speed: float = 1.0) -> bool:
+        cmd = [seika_exe_path(), "-cid", str(self.cid or cid), "-speed", f"{float(speed):.2f}",
+               "-play", "-nc", "-t", text]
+        with self._lock:
+            self._proc = subprocess.Popen(cmd, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+            proc = self._proc
+        try:
+            return proc.wait() == 0
+        finally:
+            with self._lock:
+                if self._proc is proc:
+                    self._proc = None
+
+    def cancel(self):
+        with self._lock:
+            proc = self._proc
+        if proc is not None:
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+
+    def health(self) -> bool:
+        try:
+            out = subprocess.run([seika_exe_path(), "-list"], capture_output=True, timeout=10,
+                                 creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)).stdout
+        except Exception:
+            return False
+        if not self.cid:
+            return bool(out)
+        return re.search(rf"\b{self.cid}\b", out.decode("utf-8", "ignore")) is not None
+
+
+# ---------------- AssistantSeika HTTP ----------------
+class SeikaHttpBackend(SpeechBackend):
+    """AssistantSeika の HTTP 機能（POST /SAVE2/{cid} で WAV、/PLAY2/{cid} で向こうのマシンで再生）"""
+    kind = "http"
+    caps = frozenset({SPEAK, RENDER, SPEED, HEADLESS})
+
+    def __init__(self, base_url: str, cid: int, voice: Optional[int] = None,
+                 user: Optional[str] = None, password: Optional[str] = None, timeout: float = SAVE_TIMEOUT):
+        super().__init__(f"{base_url.rstrip('/')}/{cid}", [voice or cid])
+        self.base_url = base_url.rstrip("/")
+        self.cid = cid
+        self.timeout = timeout
+        user = user or os.getenv("SEIKA_HTTP_USER") or "SeikaServerUser"
+        password = password or os.getenv("SEIKA_HTTP_PASS") or "SeikaServerPassword"
+        self._auth = "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()
+
+    def _request(self, path: str, body: Optional[Dict] = None, timeout: Optional[float] = None) -> bytes:
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data,
+                                     headers={"Authorization": self._auth,
+                                              "Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=timeout or self.timeout) as r:
+            return r.read()
+
+    def render_to_file(self, text: str, cid: int, speed: float, path: str) -> bool:
+        wav = self._request(f"/SAVE2/{self.cid}",
+                            {"talktext": text, "effects": {"speed": float(speed)}})
+        if len(wav) <= 44:
+            return False
+        with open(path, "wb") as f:
+            f.write(wav)
+        return True
+
+    def speak(self, text: str, cid: int, speed: float = 1.0) -> bool:
+        # 再生は AssistantSeika 側のマシンで、終わるまで応答が返らない
+        self._request(f"/PLAY2/{self.cid}", {"talktext": text, "effects": {"speed": float(speed)}},
+                      timeout=max(self.timeout, estimate_seconds(text, speed) * 2 + 10))
+        return True
+
+    def health(self) -> bool:
+        try:
+            avators = json.loads(self._request("/AVATOR2", timeout=5.0))
+        except Exception:
+            return False
+        return any(int(a.get("cid", -1)) == self.cid for a in avators)
+
+
+# ---------------- VOICEROID（UIA） ----------------
+class VoiceroidUiaBackend(SpeechBackend):
+    """
+    起動中の VOICEROID ウィンドウ 1 つ（話速は VOICEROID 側の設定）
+    speak は貼り付け → 再生ボタンまで（再生は VOICEROID 側で非同期に進む）
+    uia に UiaWorker を渡すと UI 操作は子プロセスで（期限付き）
+    """
+    kind = "voiceroid"
+    caps = frozenset({SPEAK, RENDER})
+
+    def __init__(self, hwnd: Optional[int] = None, voice: int = CID_KIRITAN, registry=None, uia=None):
+        super().__init__(f"voiceroid:{hwnd}" if hwnd else "voiceroid", [voice])
+        self.hwnd = hwnd
+        self.registry = registry
+        self.uia = uia
+
+    def _window(self):
+        from kiritan_voiceroid_ui import WINDOWS
+        registry = self.registry or WINDOWS
+        return registry, registry.voiceroid_window(hwnd=self.hwnd)
+
+    def speak(self, text: str, cid: int, speed: float = 1.0) -> bool:
+        if self.uia is not None:
+            return self.uia.say(text, hwnd=self.hwnd)
+        from kiritan_voiceroid_ui import set_phrase_text, click_play
+        with _UI_LOCK:
+            _, win = self._window()
+            return win is not None and set_phrase_text(win, text) and click_play(win)
+
+    def render_to_file(self, text: str, cid: int, speed: float, path: str) -> bool:
+        path = os.path.abspath(path)
+        with _UI_LOCK:
+            if self.uia is not None:
+                if not (self.uia.set_text(text, hwnd=self.hwnd) and self.uia.save(path, hwnd=self.hwnd)):
+                    return False
+            else:
+                from kiritan_voiceroid_ui import set_phrase_text, click_save_and_type_path
+                registry, win = self._window()
+                if win is None or not set_phrase_text(win, text):
+                    return False
+                if not click_save_and_type_path(win, path):
+                    registry.invalidate(self.hwnd)
+                    return False
+        # 書き出し自体は VOICEROID 側で進むので、UI ロックを離してから完了を待つ
+        return wait_file(path, SAVE_TIMEOUT)
+
+    def health(self) -> bool:
+        if self.hwnd:
+            from kiritan_winreg import is_alive
+            return is_alive(self.hwnd)
+        try:
+            return self._window()[1] is not None
+        except Exception:
+            return False
+
+
+def voiceroid_backends(voice: int = CID_KIRITAN) -> List[VoiceroidUiaBackend]:
+    """起動中の VOICEROID ウィンドウ全部"""
+    from kiritan_winreg import WindowRegistry
+    from kiritan_voiceroid_ui import TITLE_RE
+    registry = WindowRegistry(TITLE_RE)
+    return [VoiceroidUiaBackend(h, voice, registry) for h in registry.voiceroid_hwnds()]
+
+
+# ---------------- ヘッドレス ----------------
+class HeadlessBackend(SpeechBackend):
+    """
+    Windows なしで動く出口。source（ディレクトリ）に録り置きがあればそれを、無ければ
+    話速の見積もりどおりの長さの合成音（tone=False なら無音）を書き出す
+    render_sec × scale だけ待ってレンダリング時間も真似る（scale=0 で待たない）
+    """
+    kind = "null"
+    caps = frozenset({SPEAK, RENDER, CANCEL, SPEED, HEADLESS})
+
+    def __init__(self, source: Optional[str] = None, tone: bool = False, fs: int = HEADLESS_FS,
+                 render_sec: float = 0.0, scale: float = 1.0, voices: Iterable[int] = ()):
+        kind = "file" if source else ("tone" if tone else "null")
+        super().__init__(f"{kind}:{source}" if source else kind, voices)
+        self.kind = kind
+        self.source = source
+        self.tone = tone
+        self.fs = fs
+        self.render_sec = render_sec
+        self.scale = max(0.0, float(scale))
+        self.renders = 0
+        self.hits = 0                     # 録り置きが見つかった数
+
+    def _recorded(self, text: str, cid: int, speed: float) -> Optional[str]:
+        if not self.source:
+            return None
+        path = os.path.join(self.source, cache_key(text, cid, speed) + ".wav")
+        return path if os.path.exists(path) else None
+
+    def synth(self, seconds: float, path: str):
+        """seconds 秒の合成音（無音 / 端をなだらかにしたトーン）を 16bit mono で書く"""
+        n = max(1, int(seconds * self.fs))
+        if self.tone and np is not None:
+            t = np.arange(n, dtype=np.float32) / self.fs
+            x = TONE_LEVEL * np.sin(2 * np.pi * TONE_HZ * t)
+            ramp = min(n // 2, int(0.02 * self.fs))
+            if ramp:
+                x[:ramp] *= np.linspace(0.0, 1.0, ramp)
+                x[-ramp:] *= np.linspace(1.0, 0.0, ramp)
+            frames = (x * 32767).astype("<i2").tobytes()
+        else:
+            frames = b"\x00\x00" * n
+        with wave.open(path, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(self.fs)
+            w.writeframes(frames)
+
+    def render_to_file(self, text: str, cid: int, speed: float, path: str) -> bool:
+        self.renders += 1
+        if self.render_sec * self.scale > 0:
+            time.sleep(self.render_sec * self.scale)
+        src = self._recorded(text, cid, speed)
+        if src is not None:
+            self.hits += 1
+            shutil.copyfile(src, path)
+        else:
+            self.synth(estimate_seconds(text, speed), path)
+        return True
+
+    def speak(self, text: str, cid: int, speed: float = 1.0) -> bool:
+        if self.scale == 1.0:
+            return super().speak(text, cid, speed)
+        # 時間を伸縮しているときは鳴らさず、長さ × scale だけ待つ
+        self._cancel.clear()
+        src = self._recorded(text, cid, speed)
+        sec = wav_seconds(src) if src else estimate_seconds(text, speed)
+        return not self._cancel.wait(sec * self.scale)
+
+
+# ---------------- 設定から作る ----------------
+def parse_backends(spec: str) -> List[SpeechBackend]:
+    """KIRITAN_ENGINES / KIRITAN_SPEECH の書式（カンマ区切り。`=1707` でその声として扱う）"""
+    out: List[SpeechBackend] = []
+    for item in (x.strip() for x in (spec or "").split(",")):
+        if not item:
+            continue
+        item, _, voice = item.partition("=")
+        v = int(voice) if voice.strip().isdigit() else None
+        m = re.match(r"^(https?://.+)/(\d+)$", item)
+        if m:
+            out.append(SeikaHttpBackend(m.group(1), int(m.group(2)), v))
+        elif item.startswith("seika:") and item[6:].isdigit():
+            out.append(SeikaCliBackend(int(item[6:]), v))
+        elif item == "seika":
+            out.append(SeikaCliBackend(voice=v))
+        elif item == "voiceroid":
+            found = voiceroid_backends(v or CID_KIRITAN)
+            if not found:
+                print("[speech] VOICEROID ウィンドウが見つかりません", file=sys.stderr)
+            out.extend(found)
+        elif item in ("null", "tone"):
+            out.append(HeadlessBackend(tone=item == "tone", voices=[v] if v else ()))
+        elif item.startswith("file:"):
+            out.append(HeadlessBackend(source=item[5:], voices=[v] if v else ()))
+        else:
+            print(f"[speech] 不明な指定: {item}", file=sys.stderr)
+    return out
+
+
+def backend_from_env(default: str = "seika") -> SpeechBackend:
+    """KIRITAN_SPEECH（未設定なら default）の最初の 1 つ"""
+    spec = (os.getenv("KIRITAN_SPEECH") or "").strip() or default
+    found = parse_backends(spec)
+    if not found:
+        print(f"[speech] KIRITAN_SPEECH={spec} が使えないので {default} を使います", file=sys.stderr)
+        found = parse_backends(default)
+    return found[0]
+
+
+# ---------------- CLI ----------------
+def main():
+    import argparse
+    p = argparse.ArgumentParser(prog="kiritan_speech")
+    p.add_argument("--backend", default=os.getenv("KIRITAN_SPEECH") or "seika")
+    p.add_argument("--say", required=True)
+    p.add_argument("--out", help="再生せずに WAV へ書き出す")
+    p.add_argument("--cid", type=int, default=CID_KIRITAN)
+    p.add_argument("--speed", type=float, default=1.0)
+    args = p.parse_args()
+
+    found = parse_backends(args.backend)
+    if not found:
+        sys.exit(1)
+    b = found[0]
+    print(f"[speech] {json.dumps(b.capabilities(), ensure_ascii=False)}")
+    t0 = time.time()
+    ok = b.render_to_file(args.say, args.cid, args.speed, args.out) if args.out else b.speak(args.say, args.cid, args.speed)
+    print(f"[speech] {'OK' if ok else '失敗'} {time.time() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
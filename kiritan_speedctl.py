@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+読み上げ待ちの量に応じて話速を自動で上げ下げする（適応話速）
+- 待っている音声の秒数（再生バックログ + 未レンダリング分の見積もり）を見て、
+  次に話す文が目標の遅れ（既定 8 秒）以内に始まるよう、必要な話速を base × 残り ÷ 目標 で求める
+- 実際の話速は上限（既定 2.0x）と基準（--speed / `speed X`）の間に収め、急に変わらないよう
+  1 秒あたりの変化量を制限（上げは速め、戻しはゆっくり）。バックログが捌ければ基準へなだらかに戻る
+- 話速が 0.05 以上動いたら `[speed]` で記録。上げていた時間・最高話速・変更回数を集計
+
+すでにレンダリング済みの文の速さは変わらない（次に投入する文から効く）
+
+使い方:
+  ctl = open_speedctl(base=1.0)          # 無効なら None
+  speed = ctl.update(engine.backlog_seconds() + unstarted_seconds(segments)) if ctl else base
+
+設定（環境変数）:
+  KIRITAN_ADAPTIVE_SPEED=2.0@8   … 上限 2.0x、目標の遅れ 8 秒（`1` / `on` なら既定値）
+  KIRITAN_ADAPTIVE_SPEED=0       … 無効（既定）
+"""
+
+import os
+import sys
+import time
+import threading
+from typing import Optional, Iterable
+
+from kiritan_budget import estimate_seconds
+
+DEFAULT_MAX = 2.0             # 話速の上限（倍率）
+DEFAULT_TARGET = 8.0          # 待ちがこれを超えそうなら上げる（秒）
+SPEED_LIMIT = 4.0             # `speed X` と同じ安全範囲の上端
+RISE_PER_SEC = 0.25           # 上げるときの 1 秒あたりの最大変化
+FALL_PER_SEC = 0.08           # 戻すときの 1 秒あたりの最大変化
+LOG_STEP = 0.05               # これ以上動いたら記録
+
+
+def unstarted_seconds(segments: Iterable) -> float:
+    """投入済みでまだレンダリング / 再生の始まっていない文の見積もり秒数"""
+    return sum(estimate_seconds(s.text, s.speed) for s in segments
+               if not s.started.is_set() and s.pcm is None and not s.finished.is_set())
+
+
+# ---------------- 統計 ----------------
+class SpeedStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.changes = 0          # 記録した話速の変更
+        self.peak = 0.0           # 最高話速
+        self.peak_backlog = 0.0
+        self.boosted_s = 0.0      # 基準より上げていた時間
+
+    def summary(self) -> str:
+        with self.lock:
+            return (f"更新 {self.updates} / 変更 {self.changes} / 最高 {self.peak:.2f}x"
+                    f"（待ち最大 {self.peak_backlog:.1f}s）/ 上げていた時間 {self.boosted_s:.0f}s")
+
+
+# ---------------- 本体 ----------------
+class SpeedController:
+    def __init__(self, base: float = 1.0, hi: float = DEFAULT_MAX, target: float = DEFAULT_TARGET,
+                 rise: float = RISE_PER_SEC, fall: float = FALL_PER_SEC, tag: str = "speed"):
+        self.hi = min(SPEED_LIMIT, hi)
+        self.target = max(0.5, target)
+        self.rise = rise
+        self.fall = fall
+        self.tag = tag
+        self.stats = SpeedStats()
+        self.base = base
+        self.current = base
+        self._logged = base
+        self._last_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def set_base(self, base: float):
+        """基準の話速（`speed X` 等）。上げている最中なら、その分はなだらかに追従する"""
+        with self._lock:
+            self.base = base
+            self.current = max(self.current, base)
+            self._logged = self.current
+
+    def desired(self, backlog: float) -> float:
+        """待ち backlog 秒を目標以内で捌ける話速（基準〜上限）"""
+        want = self.base * backlog / self.target if backlog > self.target else self.base
+        return max(self.base, min(max(self.base, self.hi), want))
+
+    def update(self, backlog: float, now: Optional[float] = None) -> float:
+        """いまの待ち（秒）を渡して、次の文に使う話速を返す"""
+        now = time.time() if now is None else now
+        want = self.desired(backlog)
+        with self._lock:
+            dt = 0.0 if self._last_at is None else max(0.0, now - self._last_at)
+            self._last_at = now
+            prev = self.current
+            # 呼ばれる間隔が空いても 1 回で跳ねすぎないよう、経過は 2 秒で頭打ち
+            step = (self.rise if want > prev else self.fall) * max(0.5, min(2.0, dt))
+            self.current = min(want, prev + step) if want > prev else max(want, prev - step)
+            cur = self.current
+            moved = abs(cur - self._logged) >= LOG_STEP or (cur == self.base and self._logged != self.base)
+            if moved:
+                self._logged = cur
+        with self.stats.lock:
+            self.stats.updates += 1
+            self.stats.peak = max(self.stats.peak, cur)
+            self.stats.peak_backlog = max(self.stats.peak_backlog, backlog)
+            if prev > self.base:
+                self.stats.boosted_s += dt
+            if moved:
+                self.stats.changes += 1
+        if moved:
+            print(f"[{self.tag}] 話速 {prev:.2f}x → {cur:.2f}x（待ち {backlog:.1f}s / 目標 {self.target:.0f}s）")
+        return cur
+
+
+def open_speedctl(base: float = 1.0, tag: str = "speed") -> Optional[SpeedController]:
+    """KIRITAN_ADAPTIVE_SPEED から作る（未設定 / 0 なら None）"""
+    raw = (os.getenv("KIRITAN_ADAPTIVE_SPEED") or "").strip().lower()
+    if raw in ("", "0", "off", "false"):
+        return None
+    hi, target = DEFAULT_MAX, DEFAULT_TARGET
+    if raw not in ("1", "on", "true"):
+        try:
+            top, _, tgt = raw.partition("@")
+            hi = float(top) if top else DEFAULT_MAX
+            target = float(tgt) if tgt else DEFAULT_TARGET
+        except ValueError:
+            print(f"[speed] KIRITAN_ADAPTIVE_SPEED の値が不正です: {raw}（{DEFAULT_MAX}@{DEFAULT_TARGET:g} を使用）",
+                  file=sys.stderr)
+            hi, target = DEFAULT_MAX, DEFAULT_TARGET
+    if hi <= base:
+        print(f"[speed] 上限 {hi}x が基準 {base}x 以下なので話速は変わりません", file=sys.stderr)
+    return SpeedController(base, hi=hi, target=target, tag=tag)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+「フレーズ編集」タブの見張り（タブ復帰を会話のクリティカルパスから外す）
+- バックグラウンドのスレッドが、選択中のタブを軽く確認（キャッシュした TabItem の IsSelected を 1 回読むだけ）
+- 「フレーズ編集」から外れていたときだけ復帰操作をする（ウィンドウ再探索・TabItem 全列挙は毎回しない）
+- 再生の終了など、タブが動きそうなタイミングでは poke() ですぐ確認（待たない）。普段は一定間隔のポーリング
+- 他の UI 操作（テキスト投入・再生）の実行中は確認を見送るので、生成→再生の間に割り込まない
+- 入力欄を触る直前は ensure() で、直近の確認が新しければ何もしない / 古ければその場で確認
+
+UI 操作は kiritan_uia_worker の子プロセス経由（ワーカーが無効なら見張りも無効で、従来どおり毎回復帰）
+
+設定（環境変数）:
+  KIRITAN_TABWATCH=1.0   … ポーリング間隔（秒、既定 1.0）
+  KIRITAN_TABWATCH=0     … 無効
+"""
+
+import os
+import sys
+import time
+import threading
+from typing import Optional, Callable
+
+POLL_INTERVAL = 1.0           # 何も起きていないときの確認間隔
+FRESH_SECONDS = 2.0           # ensure() で「確認済み」とみなす新しさ
+BUSY_RETRY = 0.1              # 他の UI 操作の実行中だったときの再試行間隔
+
+
+# ---------------- 統計 ----------------
+class TabStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checks = 0
+        self.skipped = 0          # 他の UI 操作の実行中で見送り
+        self.moved = 0            # フレーズ編集から外れていた
+        self.restored = 0
+        self.failed = 0
+        self.sync = 0             # ensure() がその場で確認した回数（クリティカルパス上）
+
+    def summary(self) -> str:
+        with self.lock:
+            return (f"確認 {self.checks} / 見送り {self.skipped} / 外れていた {self.moved}"
+                    f" / 復帰 {self.restored} / 失敗 {self.failed} / 同期確認 {self.sync}")
+
+
+class TabWatcher:
+    """
+    check() … 選択中なら True、外れていれば False、わからなければ None
+    check_nowait() … バックグラウンド用。他の UI 操作の実行中なら待たずに None（省略時は check）
+    restore() … フレーズ編集へ戻す。成功で True
+    """
+
+    def __init__(self, check: Callable[[], Optional[bool]], restore: Callable[[], bool],
+                 check_nowait: Optional[Callable[[], Optional[bool]]] = None,
+                 interval: float = POLL_INTERVAL):
+        self.check = check
+        self.check_nowait = check_nowait or check
+        self.restore = restore
+        self.interval = interval
+        self.stats = TabStats()
+        self.ok_at = 0.0              # 最後に「フレーズ編集が選択中」を確認した時刻
+        self._wake = threading.Event()
+        self._stop = False
+        self._lock = threading.Lock()
+        threading.Thread(target=self._loop, daemon=True, name="tabwatch").start()
+
+    def poke(self):
+        """すぐ確認してほしい（再生の後など）。呼び出し側は待たない"""
+        self.ok_at = 0.0
+        self._wake.set()
+
+    def ensure(self, fresh: float = FRESH_SECONDS) -> bool:
+        """入力欄を触る直前用。直近に確認済みなら何もしない"""
+        if time.time() - self.ok_at < fresh:
+            return True
+        with self.stats.lock:
+            self.stats.sync += 1
+        return bool(self._step(wait=True))
+
+    def _step(self, wait: bool = False) -> Optional[bool]:
+        """確認して、外れていれば戻す。見送ったら None"""
+        with self._lock:
+            state = self.check() if wait else self.check_nowait()
+            if state is None:
+                with self.stats.lock:
+                    self.stats.skipped += 1
+                return None
+            with self.stats.lock:
+                self.stats.checks += 1
+            if state:
+                self.ok_at = time.time()
+                return True
+            with self.stats.lock:
+                self.stats.moved += 1
+            ok = self.restore()
+            with self.stats.lock:
+                if ok:
+                    self.stats.restored += 1
+                else:
+                    self.stats.failed += 1
+            if ok:
+                self.ok_at = time.time()
+            return ok
+
+    def _loop(self):
+        while not self._stop:
+            woke = self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop:
+                return
+            try:
+                done = self._step()
+            except Exception as e:
+                print(f"[tab] 確認失敗: {e}", file=sys.stderr)
+                done = False
+            if woke and done is None:
+                # 他の UI 操作と重なっただけなら少し後にもう一度
+                time.sleep(BUSY_RETRY)
+                self._wake.set()
+
+    def close(self):
+        self._stop = True
+        self._wake.set()
+
+
+def open_tabwatch(uia) -> Optional[TabWatcher]:
+    """UIA ワーカーがあるときだけ見張りを立てる（KIRITAN_TABWATCH=0 / ワーカー無効なら None）"""
+    raw = (os.getenv("KIRITAN_TABWATCH") or "").strip().lower()
+    if uia is None or raw in ("0", "off", "false"):
+        return None
+    try:
+        interval = float(raw) if raw else POLL_INTERVAL
+    except ValueError:
+        print(f"[tab] KIRITAN_TABWATCH の値が不正です: {raw}（{POLL_INTERVAL}s を使用）", file=sys.stderr)
+        interval = POLL_INTERVAL
+    # バックグラウンドの確認は、他の UI 操作の実行中なら待たずに見送る
+    return TabWatcher(check=lambda: uia.tab_selected(), restore=uia.phrase_tab,
+                      check_nowait=lambda: uia.tab_selected(wait=False), interval=max(0.2, interval))
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+ターン内の区間（span）を記録して Chrome のトレース形式（JSON）で書き出す
+- 録音 / 文字起こし / LLM（最初の delta まで = llm.ttft、以降 = llm.stream）/ 入力の判定 / レンダリング /
+  貼り付け / 再生 / タブ復帰 / フォーカス復帰 などを with span("asr"): で囲む。同じターンの区間が
+  重なっているか（並行）、一列に並んでいるか（直列）がトレースビューアでそのまま見える
+- ターン ID は contextvars で持ち回る。スレッドプールへ渡す関数は bind(fn) で包む。
+  文脈を持たないスレッド（再生エンジンのイベント等）の区間は、いま開いているターンに付ける
+- UIA ワーカー（子プロセス）へは要求にターン ID を載せ、子が返した実行時刻を子の pid の行に置く
+- 終了時に traces/<日時>-<pid>.timeline.json へ書き出す（chrome://tracing / ui.perfetto.dev で開ける）
+- --profile [N]（または KIRITAN_PROFILE=N）: 各ターンを cProfile / tracemalloc で測り、いちばん遅い N ターンだけ
+  上位の関数と確保元をそのターンの args に添付する（.pstats も横に保存。cProfile は begin() を呼んだスレッドのみ）
+
+使い方:
+  TIMELINE = open_timeline()             # 無効なら None（span() / bind() はそのままでも何もしない）
+  TIMELINE.begin("mic")                  # 前のターンが開いていれば、その最後の区間で閉じる
+  with span("asr"): ...
+  TIMELINE.end()
+
+設定（環境変数 / 引数）:
+  KIRITAN_TIMELINE=1              … traces/ に書き出す（path.json ならそのファイル）
+  KIRITAN_PROFILE=5 / --profile 5 … 遅い 5 ターンにプロファイルを添付（タイムラインも有効になる）
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import heapq
+import atexit
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import nullcontext
+from contextvars import ContextVar
+from collections import deque
+from typing import Optional, List, Dict, Callable
+
+TRACE_DIR = "traces"
+MAX_EVENTS = 200000           # これを超えたら古い区間から捨てる
+DEFAULT_PROFILE_TURNS = 5
+PROFILE_TOP = 25              # 添付する関数の数
+MEMORY_TOP = 10               # 添付する確保元の数
+TURN_TRACK = "turns"
+
+_ACTIVE: Optional["Timeline"] = None
+_TURN: ContextVar[Optional[int]] = ContextVar("kiritan_turn", default=None)
+_NULL = nullcontext()
+
+
+# ---------------- どこからでも呼べる入口（無効なら何もしない） ----------------
+def current_turn() -> Optional[int]:
+    tl = _ACTIVE
+    if tl is None:
+        return None
+    turn = _TURN.get()
+    return turn if turn is not None else tl.current_id
+
+
+def span(name: str, **args):
+    """with span("render", text=...): …"""
+    tl = _ACTIVE
+    return _NULL if tl is None else _Span(tl, name, args)
+
+
+def add_span(name: str, start: float, end: float, turn: Optional[int] = None,
+             track: Optional[str] = None, pid: Optional[int] = None, **args):
+    """終わってから分かった区間（時刻は wall clock）。track を省くと呼んだスレッドの行"""
+    tl = _ACTIVE
+    if tl is not None:
+        tl.record(name, start, end, turn, track, pid, args)
+
+
+def mark(name: str, **args):
+    """瞬間のイベント（ヘッジの発火、打ち切り等）"""
+    tl = _ACTIVE
+    if tl is not None:
+        tl.instant(name, args)
+
+
+def bind(fn: Callable) -> Callable:
+    """今のターン ID を持たせて別スレッドで呼べるようにする"""
+    tl = _ACTIVE
+    if tl is None:
+        return fn
+    turn = current_turn()
+
+    def bound(*a, **kw):
+        token = _TURN.set(turn)
+        try:
+            return fn(*a, **kw)
+        finally:
+            _TURN.reset(token)
+    return bound
+
+
+def stream_span(name: str = "llm", **args):
+    """ストリーミング応答用。delta() の初回までを <name>.ttft、以降を <name>.stream として残す"""
+    tl = _ACTIVE
+    return _NullStream() if tl is None else _StreamSpan(tl, name, args)
+
+
+class _Span:
+    def __init__(self, tl: "Timeline", name: str, args: Dict):
+        self.tl = tl
+        self.name = name
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tl.record(self.name, self.start, time.time(), None, None, None, self.args)
+        return False
+
+
+class _StreamSpan:
+    def __init__(self, tl: "Timeline", name: str, args: Dict):
+        self.tl = tl
+        self.name = name
+        self.args = args
+        self.start = 0.0
+        self.first: Optional[float] = None
+        self.deltas = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def delta(self):
+        self.deltas += 1
+        if self.first is None:
+            self.first = time.time()
+            self.tl.record(f"{self.name}.ttft", self.start, self.first, None, None, None, dict(self.args))
+
+    def __exit__(self, exc_type, exc, tb):
+        now = time.time()
+        args = dict(self.args, deltas=self.deltas)
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        if self.first is None:
+            self.tl.record(f"{self.name}.ttft", self.start, now, None, None, None, args)
+        else:
+            self.tl.record(f"{self.name}.stream", self.first, now, None, None, None, args)
+        return False
+
+
+class _NullStream:
+    def __enter__(self):
+        return self
+
+    def delta(self):
+        pass
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+# ---------------- プロファイル ----------------
+class _TurnProfile:
+    def __init__(self):
+        self.prof: Optional[cProfile.Profile] = cProfile.Profile()
+        try:
+            self.prof.enable()
+        except ValueError:
+            # 他のプロファイラが動いている（デバッガ等）
+            self.prof = None
+        self.snap = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+
+    def stop(self) -> Dict:
+        """添付する内容（cProfile の上位と、ターン中に増えた確保元）"""
+        out: Dict = {}
+        if self.prof is not None:
+            self.prof.disable()
+            buf = io.StringIO()
+            pstats.Stats(self.prof, stream=buf).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            out["cprofile"] = buf.getvalue()
+        if self.snap is not None and tracemalloc.is_tracing():
+            diff = tracemalloc.take_snapshot().compare_to(self.snap, "lineno")
+            out["tracemalloc"] = [str(d) for d in diff[:MEMORY_TOP]]
+        return out
+
+
+# ---------------- 本体 ----------------
+class Timeline:
+    def __init__(self, path: str, profile_turns: int = 0):
+        self.path = path
+        self.profile_turns = profile_turns
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+        self.pid = os.getpid()
+        self.events: deque = deque(maxlen=MAX_EVENTS)
+        self.turns: Dict[int, Dict] = {}
+        self.current_id: Optional[int] = None
+        self._seq = 0
+        self._tids: Dict[tuple, int] = {}
+        self._profile: Optional[_TurnProfile] = None
+        self._slowest: List[tuple] = []       # (所要秒, ターン ID, 添付, cProfile) の最小ヒープ
+        self._exported = False
+        if profile_turns and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # ---- ターン ----
+    def begin(self, mode: str, label: str = "") -> int:
+        """ターンを開始。開いたままのターンは最後の区間の終わりで閉じる"""
+        if self.current_id is not None:
+            self.end(status="implicit")
+        with self.lock:
+            self._seq += 1
+            turn = self._seq
+            self.turns[turn] = {"mode": mode, "label": label, "start": time.time(), "last": None}
+            self.current_id = turn
+        _TURN.set(turn)
+        if self.profile_turns:
+            self._profile = _TurnProfile()
+        return turn
+
+    def label(self, text: str):
+        with self.lock:
+            if self.current_id is not None:
+                self.turns[self.current_id]["label"] = text
+
+    def end(self, status: Optional[str] = None):
+        with self.lock:
+            turn = self.current_id
+            if turn is None:
+                return
+            self.current_id = None
+            info = self.turns[turn]
+            # 明示的に閉じなかったターン（コマンド・スキップ等）は次の入力待ちを含めない
+            info["end"] = (info["last"] or info["start"]) if status == "implicit" else time.time()
+            info["status"] = status or "ok"
+        if _TURN.get() == turn:
+            _TURN.set(None)
+        prof, self._profile = self._profile, None
+        if prof is not None:
+            self._keep_profile(turn, info["end"] - info["start"], prof)
+
+    def _keep_profile(self, turn: int, dur: float, prof: _TurnProfile):
+        attached = prof.stop()
+        with self.lock:
+            item = (dur, turn, attached, prof.prof)
+            if len(self._slowest) < self.profile_turns:
+                heapq.heappush(self._slowest, item)
+            elif dur > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    # ---- 記録 ----
+    def _tid(self, pid: int, track: str) -> int:
+        key = (pid, track)
+        tid = self._tids.get(key)
+        if tid is None:
+            tid = self._tids[key] = len(self._tids) + 1
+        return tid
+
+    def _us(self, t: float) -> float:
+        return round((t - self.t0) * 1e6, 1)
+
+    def record(self, name: str, start: float, end: float, turn: Optional[int], track: Optional[str],
+               pid: Optional[int], args: Dict):
+        turn = current_turn() if turn is None else turn
+        pid = pid or self.pid
+        track = track or threading.current_thread().name
+        with self.lock:
+            ev = {"name": name, "cat": name.split(".", 1)[0], "ph": "X", "ts": self._us(start),
+                  "dur": round(max(0.0, end - start) * 1e6, 1), "pid": pid, "tid": self._tid(pid, track),
+                  "args": dict(args, turn=turn)}
+            self.events.append(ev)
+            info = self.turns.get(turn) if turn is not None else None
+            if info is not None and "end" not in info:
+                info["last"] = max(info["last"] or end, end)
+
+    def instant(self, name: str, args: Dict):
+        now = time.time()
+        with self.lock:
+            self.events.append({"name": name, "cat": "mark", "ph": "i", "s": "t", "ts": self._us(now),
+                                "pid": self.pid, "tid": self._tid(self.pid, threading.current_thread().name),
+                                "args": dict(args, turn=current_turn())})
+
+    def attach(self, engine):
+        """PlaybackEngine のセグメントごとに render（投入 → レンダリング完了）と play（再生）の区間を残す"""
+        def _on_finish(seg):
+            turn = current_turn()
+            args = {"text": seg.text[:40], "cid": seg.cid, "speed": seg.speed}
+            rendered = getattr(seg, "rendered_at", None)
+            if seg.queued_at and rendered:
+                self.record("render", seg.queued_at, rendered, turn, "render", None, dict(args))
+            if seg.started_at and seg.finished_at:
+                self.record("play", seg.started_at, seg.finished_at, turn, "play", None,
+                            dict(args, error=seg.error) if seg.error else args)
+        engine.on_finish.append(_on_finish)
+
+    # ---- 出力 ----
+    def export(self, path: Optional[str] = None) -> str:
+        if self.current_id is not None:
+            self.end(status="implicit")
+        path = path or self.path
+        with self.lock:
+            events = list(self.events)
+            attached = {turn: a for _, turn, a, _ in self._slowest}
+            for turn, info in self.turns.items():
+                if "end" not in info:
+                    continue
+                args = {"turn": turn, "mode": info["mode"], "label": info["label"][:80], "status": info["status"]}
+                args.update(attached.get(turn, {}))
+                events.append({"name": f"turn {turn}", "cat": "turn", "ph": "X", "ts": self._us(info["start"]),
+                               "dur": round((info["end"] - info["start"]) * 1e6, 1), "pid": self.pid,
+                               "tid": self._tid(self.pid, TURN_TRACK), "args": args})
+            names = dict(self._tids)
+        meta = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": os.path.basename(sys.argv[0])}}]
+        meta += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": track}}
+                 for (pid, track), tid in names.items()]
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms",
+                       "otherData": {"argv": sys.argv, "t0": self.t0}}, f, ensure_ascii=False, default=str)
+        self._dump_profiles(path)
+        self._exported = True
+        return path
+
+    def _dump_profiles(self, path: str):
+        """遅いターンの cProfile を <timeline>.turn<N>.pstats として保存（snakeviz 等で開ける）"""
+        base = path[:-5] if path.endswith(".json") else path
+        for _, turn, _, prof in self._slowest:
+            if prof is not None:
+                prof.dump_stats(f"{base}.turn{turn}.pstats")
+
+    def summary(self) -> str:
+        with self.lock:
+            done = [(info["end"] - info["start"], turn) for turn, info in self.turns.items() if "end" in info]
+            n_events = len(self.events)
+        if not done:
+            return f"ターン 0 / 区間 {n_events}"
+        slow, turn = max(done)
+        return (f"ターン {len(done)} / 区間 {n_events} / 最も遅いターン #{turn} {slow:.2f}s"
+                + (f" / プロファイル添付 {len(self._slowest)}" if self.profile_turns else ""))
+
+    def close(self):
+        if self._exported:
+            return
+        try:
+            print(f"[timeline] {self.summary()} → {self.export()}")
+        except OSError as e:
+            print(f"[timeline] 書き出し失敗: {e}", file=sys.stderr)
+
+
+def _profile_from_argv(argv: List[str]) -> int:
+    """--profile [N] / --profile=N（指定なしは 0）"""
+    for i, a in enumerate(argv):
+        if a == "--profile":
+            nxt = argv[i + 1] if i + 1 < len(argv) else ""
+            return int(nxt) if nxt.isdigit() else DEFAULT_PROFILE_TURNS
+        if a.startswith("--profile="):
+            v = a.split("=", 1)[1]
+            return int(v) if v.isdigit() else DEFAULT_PROFILE_TURNS
+    return 0
+
+
+def open_timeline(argv: Optional[List[str]] = None) -> Optional[Timeline]:
+    """KIRITAN_TIMELINE / KIRITAN_PROFILE / --profile が無ければ None。有効にしたら終了時に書き出す"""
+    global _ACTIVE
+    if _ACTIVE is not None:
+        return _ACTIVE
+    raw = (os.getenv("KIRITAN_TIMELINE") or "").strip()
+    env_prof = (os.getenv("KIRITAN_PROFILE") or "").strip()
+    profile = _profile_from_argv(sys.argv if argv is None else argv)
+    if not profile and env_prof.isdigit():
+        profile = int(env_prof)
+    if raw.lower() in ("", "0", "off", "false") and not profile:
+        return None
+    if raw.lower() in ("", "0", "off", "false", "1", "on", "true") or os.path.isdir(raw) or raw.endswith(("/", "\\")):
+        d = raw if os.path.isdir(raw) or raw.endswith(("/", "\\")) else TRACE_DIR
+        raw = os.path.join(d, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.timeline.json")
+    _ACTIVE = Timeline(raw, profile_turns=profile)
+    atexit.register(_ACTIVE.close)
+    print(f"[timeline] 書き出し先: {raw}" + (f"（遅い {profile} ターンにプロファイルを添付）" if profile else ""))
+    return _ACTIVE
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+話速の伸縮（WSOLA）。基準話速で 1 回だけ合成した音声を、どの話速でも再生できるようにする
+- これまでは話速を SeikaSay2 の -speed に渡していたので、話速が変わるたび（適応話速・`speed X`・
+  利用者ごとの話速）に合成し直しになり、レンダリングのキャッシュも話速ごとに別ファイルになっていた
+- WSOLA（波形の類似度で重ね位置を選ぶ重畳加算）: 30ms のハン窓を 50% 重ねで並べ、各フレームの
+  切り出し位置を「前のフレームの自然な続き」と最も似る位置へ ±TOLERANCE 秒の範囲でずらす。
+  ピッチは変わらず、位相のずれによるうなり（位相ボコーダのような響き）も出にくい
+- 候補位置ごとの相関はフレーム単位で 1 回の行列積（sliding_window_view @ テンプレート）にまとめて計算
+- 対応範囲は 0.5〜4.0x。1.0x はそのまま返す
+
+使い方:
+  y = time_stretch(pcm, fs, 1.5)          # 1.5 倍速（長さ 1/1.5）
+  python kiritan_timestretch.py --bench [--wav voice.wav] [--render "テキスト"]
+      … 音声 1 秒あたりの CPU 時間を話速ごとに測り、--render なら同じ話速で合成し直す時間と比べる
+
+設定（環境変数）:
+  KIRITAN_TIMESTRETCH=1   … PlaybackEngine が基準話速（1.0）で合成してキャッシュし、話速は伸縮で付ける
+  未設定 / 0              … 従来どおり話速ごとに合成（既定）
+  ※ 伸縮は PCM を手元で持つギャップレス再生のときだけ（winsound / フェイク再生は従来どおり）
+"""
+
+import os
+import sys
+import time
+import threading
+from typing import Optional, List
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+except Exception:
+    np = None
+
+STRETCH_BASE = 1.0            # キャッシュする合成の話速
+MIN_SPEED = 0.5
+MAX_SPEED = 4.0
+FRAME_SEC = 0.03              # 窓の長さ（声の基本周期の数倍）
+TOLERANCE_SEC = 0.012         # 切り出し位置をずらす最大幅（低い声の 1 周期ぶん）
+CORR_STEP = 2                 # 相関は 2 サンプルおきに見る（位置の精度は 1 サンプル単位のまま）
+
+
+def enabled() -> bool:
+    return np is not None and (os.getenv("KIRITAN_TIMESTRETCH") or "").strip().lower() in ("1", "on", "true")
+
+
+# ---------------- 統計 ----------------
+class StretchStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segments = 0
+        self.audio_s = 0.0        # 入力（基準話速）の音声の長さ
+        self.cpu_s = 0.0
+
+    def summary(self) -> str:
+        with self.lock:
+            per = self.cpu_s / self.audio_s * 1000 if self.audio_s else 0.0
+            return (f"伸縮 {self.segments} 文 / 音声 {self.audio_s:.1f}s / CPU {self.cpu_s * 1000:.0f}ms"
+                    f"（音声 1 秒あたり {per:.1f}ms）")
+
+
+STATS = StretchStats()
+
+
+# ---------------- 本体 ----------------
+def _window(n: int) -> "np.ndarray":
+    # 周期的なハン窓（50% 重ねで足すとちょうど 1 になる）
+    return (0.5 - 0.5 * np.cos(2.0 * np.pi * np.arange(n) / n)).astype(np.float32)
+
+
+def wsola(pcm: "np.ndarray", fs: int, speed: float) -> "np.ndarray":
+    """WSOLA で長さを 1/speed にする（ピッチはそのまま）"""
+    x = np.asarray(pcm, dtype=np.float32).reshape(-1)
+    n = max(16, int(fs * FRAME_SEC)) & ~1
+    hs = n // 2
+    tol = max(1, int(fs * TOLERANCE_SEC))
+    out_len = int(round(len(x) / speed))
+    if len(x) < n or out_len < n:
+        # 窓より短い断片は間引き / 補間で済ませる
+        idx = np.linspace(0.0, max(0, len(x) - 1), max(1, out_len))
+        return np.interp(idx, np.arange(len(x)), x).astype(np.float32) if len(x) else x
+    pad = tol + n
+    xp = np.concatenate([np.zeros(pad, np.float32), x, np.zeros(pad + int(2 * n * speed) + n, np.float32)])
+    # 候補ごとのエネルギー（正規化相関の分母）。累積和で全位置ぶんを先に作っておく
+    energy = np.concatenate([[0.0], np.cumsum(xp.astype(np.float64) ** 2)])
+    win = _window(n)
+    # フレーム k は出力の k*hs を中心に、入力の k*ha を中心として切り出す（先頭は半窓ぶん前から始めて捨てる）
+    frames = out_len // hs + 2
+    out = np.zeros(frames * hs + n, np.float32)
+    ha = hs * speed
+    offsets = np.arange(0, 2 * tol + 1, CORR_STEP)
+    prev = 0
+    for k in range(frames):
+        nominal = pad + int(round(k * ha)) - hs
+        if k:
+            # 前フレームの自然な続き（そのまま hs 進めた位置）に最も似る候補を選ぶ
+            template = xp[prev + hs:prev + hs + n]
+            lo = nominal - tol
+            view = sliding_window_view(xp[lo:lo + 2 * tol + n], n)
+            corr = view[offsets] @ template
+            e = energy[lo + offsets + n] - energy[lo + offsets]
+            best = int(offsets[np.argmax(corr / np.sqrt(e + 1e-9))])
+            # 間引いた相関の最良点の両隣だけ 1 サンプル単位で詰める
+            fine = np.arange(max(0, best - CORR_STEP + 1), min(2 * tol, best + CORR_STEP - 1) + 1)
+            fc = view[fine] @ template
+            fe = energy[lo + fine + n] - energy[lo + fine]
+            pos = lo + int(fine[np.argmax(fc / np.sqrt(fe + 1e-9))])
+        else:
+            pos = nominal
+        out[k * hs:k * hs + n] += win * xp[pos:pos + n]
+        prev = pos
+    return out[hs:hs + out_len]
+
+
+def time_stretch(pcm: "np.ndarray", fs: int, speed: float) -> "np.ndarray":
+    """speed 倍速にする（0.5〜4.0 に収める）。1.0 ならそのまま"""
+    speed = max(MIN_SPEED, min(MAX_SPEED, float(speed)))
+    if abs(speed - 1.0) < 1e-3 or pcm is None or len(pcm) == 0:
+        return pcm
+    t0 = time.process_time()
+    y = wsola(pcm, fs, speed)
+    with STATS.lock:
+        STATS.segments += 1
+        STATS.audio_s += len(pcm) / fs
+        STATS.cpu_s += time.process_time() - t0
+    return y
+
+
+# ---------------- ベンチマーク ----------------
+def _test_voice(fs: int, seconds: float) -> "np.ndarray":
+    """声らしい試験信号（抑揚のある基本周波数 + 倍音 + 音節ごとの振幅）"""
+    t = np.arange(int(fs * seconds)) / fs
+    f0 = 180.0 + 40.0 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / fs
+    x = sum(np.sin(h * phase) / h for h in range(1, 12))
+    env = np.clip(np.sin(2 * np.pi * 4.0 * t), 0.0, None) ** 0.5
+    return (0.2 * x * env).astype(np.float32)
+
+
+def bench(pcm: "np.ndarray", fs: int, speeds: List[float], repeat: int = 3, render_text: Optional[str] = None):
+    audio = len(pcm) / fs
+    backend = None
+    if render_text:
+        from kiritan_speech import backend_from_env, CID_KIRITAN
+        backend, cid = backend_from_env(), CID_KIRITAN
+        print(f"[bench] 合成し直しの比較: {type(backend).__name__} / {render_text!r}")
+    print(f"[bench] 入力 {audio:.1f}s @ {fs}Hz / 各 {repeat} 回の最小値")
+    print(" 話速   CPU(ms/音声1s)  実時間比   出力(s)" + ("   合成し直し(ms)" if backend else ""))
+    for sp in speeds:
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.process_time()
+            y = wsola(pcm, fs, sp) if abs(sp - 1.0) > 1e-3 else pcm
+            best = min(best, time.process_time() - t0)
+        line = f" {sp:4.2f}x  {best / audio * 1000:12.2f}  {best / audio:9.4f}  {len(y) / fs:8.2f}"
+        if backend is not None:
+            import tempfile
+            path = os.path.join(tempfile.gettempdir(), f"kiritan_bench_{os.getpid()}.wav")
+            t0 = time.perf_counter()
+            try:
+                ok = backend.render_to_file(render_text, cid, sp, path)
+            except Exception as e:
+                print(f"[bench] 合成に失敗: {e}", file=sys.stderr)
+                ok = False
+            line += f"  {(time.perf_counter() - t0) * 1000:14.0f}" + ("" if ok else "（失敗）")
+            if os.path.exists(path):
+                os.remove(path)
+        print(line)
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(prog="kiritan_timestretch", description="WSOLA による話速の伸縮")
+    p.add_argument("--bench", action="store_true", help="話速ごとの CPU 時間を測る")
+    p.add_argument("--wav", help="入力 WAV（省略時は試験信号）")
+    p.add_argument("--speed", type=float, default=1.5)
+    p.add_argument("--out", help="伸縮した WAV の出力先（--wav と一緒に）")
+    p.add_argument("--render", metavar="TEXT", help="同じ話速で合成し直す時間も測る（KIRITAN_SPEECH の backend）")
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.add_argument("--fs", type=int, default=48000)
+    args = p.parse_args()
+    if np is None:
+        sys.exit("numpy が必要です。")
+    if args.wav:
+        from kiritan_playback import decode_wav
+        pcm, fs = decode_wav(args.wav)
+    else:
+        pcm, fs = _test_voice(args.fs, args.seconds), args.fs
+    if args.bench:
+        bench(pcm, fs, [0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 3.0, 4.0], render_text=args.render)
+        return
+    y = time_stretch(pcm, fs, args.speed)
+    print(f"[stretch] {len(pcm) / fs:.2f}s → {len(y) / fs:.2f}s（{args.speed}x）/ {STATS.summary()}")
+    if args.out:
+        import wave
+        with wave.open(args.out, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(fs)
+            w.writeframes((np.clip(y, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+会話トレースの記録（オプトイン、JSONL）
+- 1 ターン 1 行: 入力（テキスト / 録音のハッシュと長さ / ASR の所要時間）、プロンプト、
+  LLM 呼び出しごとのモデル・パラメータ・delta（時刻付き）、再生セグメントの投入/レンダリング/再生時刻
+- 時刻はすべてターン開始からの相対秒（LLM の delta だけは呼び出し開始からの相対秒）
+- OpenAI クライアントを wrap() で包むだけで LLM / Whisper の呼び出しを拾う（ヘッジの並行呼び出しも別々に残る）
+- 再生は PlaybackEngine に attach() するか、speech() で開始/終了を直接渡す
+- 記録したトレースは kiritan_replay.py でフェイクの LLM / 合成に流して再現できる
+
+有効化（環境変数）:
+  KIRITAN_TRACE=1                 … traces/<日時>-<pid>.jsonl に記録
+  KIRITAN_TRACE=path/to/file.jsonl … 指定ファイルに追記
+  未設定 / 0                      … 無効
+※ プロンプトと返答の本文がそのまま残るので、共有するときは中身に注意
+"""
+
+import os
+import sys
+import json
+import time
+import wave
+import hashlib
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Optional, Dict, List, Iterator
+
+TRACE_DIR = "traces"
+TRACE_VERSION = 1
+ENV_KEYS = ("OPENAI_MODEL", "KIRITAN_HEDGE", "KIRITAN_SPEECH_BUDGET", "KIRITAN_PLAYBACK",
+            "KIRITAN_ENGINES", "KIRITAN_GUI_SPEED")
+PARAM_KEYS = ("temperature", "max_tokens", "stream")
+
+
+def _r(x: float) -> float:
+    return round(x, 4)
+
+
+# ---------------- ターン ----------------
+class Turn:
+    """1 往復分の記録。Tracer.begin() で作って Tracer.end() で書き出す"""
+
+    def __init__(self, seq: int, mode: str, text: str, meta: Dict):
+        self.t0 = time.time()
+        self.reply: Optional[str] = None
+        self.rec = {"type": "turn", "seq": seq, "t": round(self.t0, 3), "mode": mode,
+                    "input": {"text": text}, "prompt": None, "calls": [], "speech": []}
+        self.rec.update(meta)
+
+    def rel(self, at: Optional[float] = None) -> Optional[float]:
+        return _r((time.time() if at is None else at) - self.t0)
+
+
+class _TracedStream:
+    """ストリーミング応答を包み、delta を時刻付きで記録する（close は上流へ転送）"""
+
+    def __init__(self, stream, call: Dict, started: float):
+        self._stream = stream
+        self._call = call
+        self._started = started
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content or ""
+                    if delta:
+                        self._call["deltas"].append([_r(time.time() - self._started), delta])
+                yield chunk
+        except Exception as e:
+            self._call["error"] = str(e)
+            raise
+        finally:
+            self._call["end"] = _r(time.time() - self._started)
+
+    def close(self):
+        if "end" not in self._call:     # 読み切る前に閉じた（ヘッジ負け / 予算打ち切り）
+            self._call["closed"] = True
+            self._call["end"] = _r(time.time() - self._started)
+        close = getattr(self._stream, "close", None)
+        if close:
+            close()
+
+
+class _TracedClient:
+    """OpenAI クライアントの代理。chat.completions.create と audio.transcriptions.create だけ記録する"""
+
+    def __init__(self, client, tracer: "Tracer"):
+        self._client = client
+        self._tracer = tracer
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._transcribe))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _create(self, **kwargs):
+        turn = self._tracer.current
+        started = time.time()
+        call = {"model": kwargs.get("model"), "t": turn.rel(started) if turn else None,
+                "params": {k: kwargs[k] for k in PARAM_KEYS if k in kwargs}, "deltas": []}
+        if turn is not None:
+            with self._tracer.lock:
+                if turn.rec["prompt"] is None:
+                    turn.rec["prompt"] = kwargs.get("messages")
+                turn.rec["calls"].append(call)
+        try:
+            res = self._client.chat.completions.create(**kwargs)
+        except Exception as e:
+            call["end"] = _r(time.time() - started)
+            call["error"] = str(e)
+            raise
+        if kwargs.get("stream"):
+            return _TracedStream(res, call, started)
+        call["end"] = _r(time.time() - started)
+        content = res.choices[0].message.content if res.choices else ""
+        if content:
+            call["deltas"].append([call["end"], content])
+        return res
+
+    def _transcribe(self, **kwargs):
+        f = kwargs.get("file")
+        audio = _wav_info(getattr(f, "name", None))
+        started = time.time()
+        res = self._client.audio.transcriptions.create(**kwargs)
+        text = res if isinstance(res, str) else getattr(res, "text", "")
+        self._tracer.note_input(audio=audio, asr={"model": kwargs.get("model"), "text": text,
+                                                  "sec": _r(time.time() - started)})
+        return res
+
+
+def _wav_info(path: Optional[str]) -> Optional[Dict]:
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    info = {"sha1": hashlib.sha1(data).hexdigest(), "bytes": len(data)}
+    try:
+        with wave.open(path, "rb") as w:
+            info["sec"] = _r(w.getnframes() / float(w.getframerate()))
+            info["fs"] = w.getframerate()
+    except Exception:
+        pass
+    return info
+
+
+# ---------------- 記録 ----------------
+class Tracer:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.current: Optional[Turn] = None
+        self._seq = 0
+        self._pending: Dict = {}
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._f = open(path, "a", encoding="utf-8")
+        self._write({"type": "session", "v": TRACE_VERSION, "t": round(time.time(), 3),
+                     "argv": sys.argv, "env": {k: os.getenv(k) for k in ENV_KEYS if os.getenv(k)}})
+
+    # ---- 入力 ----
+    def note_audio(self, raw: bytes, fs: int, width: int = 2, channels: int = 1):
+        """次のターンの入力になる録音（本体は残さず、ハッシュと長さだけ）"""
+        self.note_input(audio={"sha1": hashlib.sha1(raw).hexdigest(), "bytes": len(raw), "fs": fs,
+                               "sec": _r(len(raw) / float(fs * width * channels))})
+
+    def note_input(self, **fields):
+        with self.lock:
+            self._pending.update({k: v for k, v in fields.items() if v is not None})
+
+    # ---- ターン ----
+    def begin(self, mode: str, text: str, **meta) -> Turn:
+        with self.lock:
+            self._seq += 1
+            turn = Turn(self._seq, mode, text, meta)
+            turn.rec["input"].update(self._pending)
+            self._pending = {}
+            self.current = turn
+        return turn
+
+    def end(self, turn: Turn, reply: Optional[str] = None, error: Optional[str] = None):
+        with self.lock:
+            if self.current is turn:
+                self.current = None
+            turn.rec["end"] = turn.rel()
+            turn.rec["reply"] = reply if reply is not None else turn.reply
+            if error:
+                turn.rec["error"] = error
+        self._write(turn.rec)
+
+    # ---- 再生 ----
+    def speech(self, text: str, started: float, finished: float,
+               queued: Optional[float] = None, rendered: Optional[float] = None, **fields):
+        """再生 1 回分（エンジンを使わない経路向け。時刻は wall clock）"""
+        turn = self.current
+        if turn is None:
+            return
+        rec = {"text": text, "s": turn.rel(started), "e": turn.rel(finished)}
+        if queued is not None:
+            rec["q"] = turn.rel(queued)
+            rec["r"] = turn.rel(rendered if rendered is not None else started)
+        rec.update(fields)
+        with self.lock:
+            turn.rec["speech"].append(rec)
+
+    def attach(self, engine):
+        """PlaybackEngine の再生終了ごとに、投入 / レンダリング完了 / 再生開始 / 終了の時刻を残す"""
+        def _on_finish(seg):
+            turn = self.current
+            if turn is None:
+                return
+            rel = lambda at: turn.rel(at) if at else None
+            rec = {"text": seg.text, "cid": seg.cid, "speed": seg.speed, "q": rel(seg.queued_at),
+                   "r": rel(getattr(seg, "rendered_at", None)), "s": rel(seg.started_at),
+                   "e": rel(seg.finished_at)}
+            # PCM が無い経路（winsound）は再生していた時間で代用
+            played = seg.finished_at - seg.started_at if seg.started_at and seg.finished_at else 0.0
+            rec["dur"] = _r(seg.duration or played)
+            if seg.error:
+                rec["err"] = seg.error
+            with self.lock:
+                turn.rec["speech"].append(rec)
+        engine.on_finish.append(_on_finish)
+
+    def wrap(self, client):
+        return _TracedClient(client, self)
+
+    # ---- 出力 ----
+    def _write(self, rec: Dict):
+        line = json.dumps(rec, ensure_ascii=False, default=str)
+        with self.lock:
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    def close(self):
+        with self.lock:
+            self._f.close()
+
+
+def open_trace() -> Optional[Tracer]:
+    """KIRITAN_TRACE が未設定 / 0 なら None"""
+    raw = (os.getenv("KIRITAN_TRACE") or "").strip()
+    if raw.lower() in ("", "0", "off", "false"):
+        return None
+    if raw.lower() in ("1", "on", "true"):
+        raw = os.path.join(TRACE_DIR, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.jsonl")
+    elif os.path.isdir(raw) or raw.endswith(("/", "\\")):
+        raw = os.path.join(raw, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.jsonl")
+    try:
+        tracer = Tracer(raw)
+    except OSError as e:
+        print(f"[trace] 記録先を開けません: {raw}: {e}", file=sys.stderr)
+        return None
+    print(f"[trace] 記録先: {raw}")
+    return tracer
+
+
+@contextmanager
+def trace_turn(tracer: Optional[Tracer], mode: str, text: str, **meta) -> Iterator[Optional[Turn]]:
+    """with trace_turn(TRACE, mode, user) as turn: …（tracer が None なら何もしない）"""
+    if tracer is None:
+        yield None
+        return
+    turn = tracer.begin(mode, text, **meta)
+    try:
+        yield turn
+    except BaseException as e:
+        tracer.end(turn, error=f"{type(e).__name__}: {e}")
+        raise
+    tracer.end(turn)
+
+
+# ---------------- 読み出し ----------------
+def load(path: str) -> List[Dict]:
+    """トレースファイルのターン行だけを順に返す（壊れた行は飛ばす）"""
+    turns = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get("type") == "turn":
+                turns.append(rec)
+    return turns
+
+
+def turn_metrics(rec: Dict) -> Dict[str, Optional[float]]:
+    """
+    ターン 1 行から遅延の指標を出す（秒、ターン開始基準）:
+      ttft  … 最初の delta
+      first … 最初の再生開始
+      total … ターン終了
+    """
+    ttft = None
+    for c in rec.get("calls") or []:
+        if c.get("t") is not None and c.get("deltas"):
+            at = c["t"] + c["deltas"][0][0]
+            ttft = at if ttft is None else min(ttft, at)
+    starts = [s["s"] for s in rec.get("speech") or [] if s.get("s") is not None]
+    return {"ttft": ttft, "first": min(starts) if starts else None, "total": rec.get("end")}
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+UI 操作（pywinauto / UIA）の別プロセス化（COM のハングで会話ループを止めない）
+- VOICEROID の操作（タブ復帰・テキスト投入・再生・音声保存）は子プロセスの STA スレッド 1 本だけで実行
+- 親とは標準入出力の JSON 行でやりとり（コマンドは 1 本ずつ順番に処理）
+- 操作ごとに期限を持ち、期限までに返事が無ければウォッチドッグが子を kill → 作り直し（VOICEROID へ再アタッチ）
+- 子の起動中 / 作り直し中の呼び出しも期限で打ち切るので、1 ターンの最悪遅延は期限の合計で決まる
+- 要求には今のターン ID（kiritan_timeline）を載せ、子での実行時刻を返してもらってタイムラインの子の行に置く
+
+設定（環境変数）:
+  KIRITAN_UIA_WORKER=0                          … 無効（従来どおり同じプロセスで操作）
+  KIRITAN_UIA_DEADLINE=3                        … 全操作の期限（秒）
+  KIRITAN_UIA_DEADLINE=tab=2,text=3,play=2,save=8 … 操作別
+
+単体確認:
+  python kiritan_uia_worker.py --ping [--say こんにちは]
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import subprocess
+from collections import deque
+from typing import Optional, Dict, Any
+
+# 既定は GUI 発展版と同じ（+/＋、末尾の * 等を許容）
+from kiritan_winreg import TITLE_RE
+from kiritan_timeline import current_turn, add_span
+
+DEFAULT_DEADLINES: Dict[str, float] = {
+    "ping": 1.0, "attach": 3.0, "tab": 3.0, "tab_selected": 1.0, "text": 3.0, "play": 2.0,
+    "say": 5.0, "save": 8.0,
+}
+SPAWN_TIMEOUT = 20.0          # 子の起動（pywinauto / comtypes の import 込み）がこれを超えたら作り直す
+KILL_WAIT = 1.0
+
+
+class UiaTimeout(Exception):
+    pass
+
+
+# ---------------- 統計 ----------------
+class UiaStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failed = 0           # 子の中で操作が失敗（False / 例外）
+        self.timeouts = 0         # 期限切れ（子を kill）
+        self.not_ready = 0        # 子の起動待ちで期限切れ
+        self.respawns = 0
+        self.ms: deque = deque(maxlen=500)
+
+    def summary(self) -> str:
+        with self.lock:
+            ms = sorted(self.ms)
+            p = lambda q: ms[min(len(ms) - 1, int(q * (len(ms) - 1)))] if ms else 0.0
+            return (f"calls={self.calls} 失敗={self.failed} 期限切れ={self.timeouts} 起動待ち={self.not_ready}"
+                    f" 作り直し={self.respawns} | p50 {p(0.5):.0f}ms p95 {p(0.95):.0f}ms max {ms[-1] if ms else 0:.0f}ms")
+
+
+def deadlines_from_env() -> Dict[str, float]:
+    raw = (os.getenv("KIRITAN_UIA_DEADLINE") or "").strip()
+    d = dict(DEFAULT_DEADLINES)
+    if not raw:
+        return d
+    try:
+        if "=" not in raw:
+            return {k: float(raw) for k in d}
+        for part in raw.split(","):
+            k, v = part.split("=", 1)
+            d[k.strip()] = float(v)
+    except ValueError:
+        print(f"[uia] KIRITAN_UIA_DEADLINE の値が不正です: {raw}（既定値を使用）", file=sys.stderr)
+        return dict(DEFAULT_DEADLINES)
+    return d
+
+
+# ---------------- 親側 ----------------
+class UiaWorker:
+    """子プロセスへの窓口。メソッドは期限内に終わらなければ False を返す（例外は投げない）"""
+
+    def __init__(self, title_re: str = TITLE_RE, deadlines: Optional[Dict[str, float]] = None):
+        self.title_re = title_re
+        self.deadlines = deadlines or deadlines_from_env()
+        self.stats = UiaStats()
+        self.hwnd: Optional[int] = None
+        self._lock = threading.Lock()          # コマンドは 1 本ずつ（= コマンドキュー）
+        self._proc: Optional[subprocess.Popen] = None
+        self._replies: "queue.Queue[Optional[Dict]]" = queue.Queue()
+        self._ready = False
+        self._spawned_at = 0.0
+        self._seq = 0
+
+    # ---- プロセス管理 ----
+    def _spawn(self):
+        cmd = [sys.executable, os.path.abspath(__file__), "--serve", "--title", self.title_re]
+        self._replies = queue.Queue()
+        self._ready = False
+        self._spawned_at = time.time()
+        # 子が GUI 版のモジュールを import しても、さらにワーカーを作らないように
+        env = dict(os.environ, KIRITAN_UIA_WORKER="0")
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+                                      creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+        threading.Thread(target=self._read_loop, args=(self._proc, self._replies), daemon=True).start()
+
+    @staticmethod
+    def _read_loop(proc: subprocess.Popen, replies: queue.Queue):
+        for line in proc.stdout:
+            try:
+                replies.put(json.loads(line.decode("utf-8")))
+            except ValueError:
+                continue
+        replies.put(None)     # EOF（子が落ちた）
+
+    def _kill(self):
+        proc, self._proc = self._proc, None
+        self._ready = False
+        if proc is None:
+            return
+        try:
+            proc.kill()
+            proc.wait(KILL_WAIT)
+        except Exception:
+            pass
+
+    def restart(self, reason: str = ""):
+        """ウォッチドッグ: 子を kill して作り直す（再アタッチは子の起動時に行われる）"""
+        if reason:
+            print(f"[uia] {reason} → ワーカーを作り直します", file=sys.stderr)
+        self._kill()
+        with self.stats.lock:
+            self.stats.respawns += 1
+        self._spawn()
+
+    def start(self):
+        """先に子を立ち上げておく（起動時に呼ぶと最初の操作を待たせない）"""
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._spawn()
+
+    def _next_reply(self, until: float) -> Optional[Dict]:
+        try:
+            return self._replies.get(timeout=max(0.0, until - time.time()))
+        except queue.Empty:
+            raise UiaTimeout()
+
+    def _wait_ready(self, until: float) -> bool:
+        while not self._ready:
+            try:
+                msg = self._next_reply(until)
+            except UiaTimeout:
+                # 起動が遅いだけなら待たずに諦める。長すぎる起動はハングとみなして作り直す
+                if time.time() - self._spawned_at > SPAWN_TIMEOUT:
+                    self.restart("起動がタイムアウト")
+                return False
+            if msg is None:
+                self.restart("起動に失敗")
+                return False
+            if msg.get("ready"):
+                self._ready = True
+                self.hwnd = msg.get("hwnd")
+        return True
+
+    # ---- 呼び出し ----
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def call(self, op: str, *args, hwnd: Optional[int] = None, deadline: Optional[float] = None,
+             wait: bool = True) -> Any:
+        """
+        子で op を実行して結果を返す。期限切れなら UiaTimeout（子は作り直し）。
+        wait=False なら、他の操作の実行中は待たずに None を返す（バックグラウンドの監視用）
+        """
+        limit = deadline if deadline is not None else self.deadlines.get(op, 3.0)
+        t0 = time.time()
+        until = t0 + limit
+        if not self._lock.acquire(blocking=wait):
+            return None
+        try:
+            if self._proc is None:
+                self._spawn()
+            elif self._proc.poll() is not None:
+                self.restart("ワーカーが終了していた")
+            with self.stats.lock:
+                self.stats.calls += 1
+            try:
+                if not self._wait_ready(until):
+                    with self.stats.lock:
+                        self.stats.not_ready += 1
+                    raise UiaTimeout(f"{op}: ワーカー起動待ち")
+                msg = self._request(op, list(args), hwnd, until, limit)
+            finally:
+                with self.stats.lock:
+                    self.stats.ms.append((time.time() - t0) * 1000)
+        finally:
+            self._lock.release()
+        if msg.get("hwnd"):
+            self.hwnd = msg["hwnd"]
+        if not msg.get("ok"):
+            with self.stats.lock:
+                self.stats.failed += 1
+            if msg.get("error"):
+                print(f"[uia] {op} 失敗: {msg['error']}", file=sys.stderr)
+        return msg.get("value")
+
+    def _request(self, op: str, args, hwnd: Optional[int], until: float, limit: float) -> Dict:
+        self._seq += 1
+        req = {"id": self._seq, "op": op, "args": args, "hwnd": hwnd, "turn": current_turn()}
+        try:
+            self._proc.stdin.write((json.dumps(req, ensure_ascii=False) + "\n").encode("utf-8"))
+            self._proc.stdin.flush()
+            while True:
+                msg = self._next_reply(until)
+                if msg is None:
+                    break
+                if msg.get("id") == self._seq:
+                    if msg.get("t"):
+                        add_span(f"uia.{op}", msg["t"][0], msg["t"][1], turn=msg.get("turn"),
+                                 track="uia-worker", pid=self._proc.pid, ok=msg.get("ok"))
+                    return msg
+        except UiaTimeout:
+            with self.stats.lock:
+                self.stats.timeouts += 1
+            self.restart(f"{op} が {limit:.1f}s で応答なし")
+            raise UiaTimeout(f"{op}: {limit:.1f}s 超過")
+        except OSError:
+            pass
+        self.restart(f"{op} 中にワーカーが終了")
+        raise UiaTimeout(f"{op}: ワーカー終了")
+
+    def _try(self, op: str, *args, **kw) -> bool:
+        try:
+            return bool(self.call(op, *args, **kw))
+        except UiaTimeout as e:
+            print(f"[uia] {e}", file=sys.stderr)
+            return False
+
+    # ---- 操作 ----
+    def attach(self, deadline: Optional[float] = None) -> Optional[int]:
+        """VOICEROID の HWND（見つからなければ None）。子の起動中なら起動完了まで待つ"""
+        if deadline is None and not self._ready:
+            deadline = SPAWN_TIMEOUT
+        try:
+            return self.call("attach", deadline=deadline) or None
+        except UiaTimeout as e:
+            print(f"[uia] {e}", file=sys.stderr)
+            return None
+
+    def phrase_tab(self, hwnd: Optional[int] = None) -> bool:
+        return self._try("tab", hwnd=hwnd)
+
+    def tab_selected(self, hwnd: Optional[int] = None, wait: bool = True) -> Optional[bool]:
+        """「フレーズ編集」タブが選択中か（キャッシュしたタブ要素の IsSelected を読むだけ）。不明なら None"""
+        try:
+            v = self.call("tab_selected", hwnd=hwnd, wait=wait)
+        except UiaTimeout:
+            return None
+        return None if v is None else bool(v)
+
+    def set_text(self, text: str, hwnd: Optional[int] = None) -> bool:
+        return self._try("text", text, hwnd=hwnd)
+
+    def play(self, hwnd: Optional[int] = None) -> bool:
+        return self._try("play", hwnd=hwnd)
+
+    def say(self, text: str, hwnd: Optional[int] = None) -> bool:
+        """テキスト投入 → 再生 を 1 往復で"""
+        return self._try("say", text, hwnd=hwnd)
+
+    def save(self, path: str, hwnd: Optional[int] = None) -> bool:
+        return self._try("save", path, hwnd=hwnd)
+
+    def close(self):
+        with self._lock:
+            self._kill()
+
+
+_worker: Optional[UiaWorker] = None
+
+
+def open_worker(title_re: str = TITLE_RE) -> Optional[UiaWorker]:
+    """KIRITAN_UIA_WORKER=0 なら None（呼び出し側は同じプロセスで操作する）"""
+    global _worker
+    if os.getenv("KIRITAN_UIA_WORKER", "1").strip().lower() in ("0", "off", "false"):
+        return None
+    if _worker is None or _worker.title_re != title_re:
+        _worker = UiaWorker(title_re)
+        _worker.start()
+    return _worker
+
+
+# ---------------- 子側 ----------------
+def serve(title_re: str):
+    """子プロセス本体。このスレッド（STA）だけで UIA を触る"""
+    out = sys.stdout.buffer
+    sys.stdout = sys.stderr        # 操作関数の print で通信路を汚さない
+    sys.coinit_flags = 2           # COINIT_APARTMENTTHREADED（pywinauto の import 前に）
+
+    from kiritan_winreg import WindowRegistry
+    from kiritan_voiceroid_ui import (ensure_phrase_tab, set_phrase_text, click_play,
+                                      click_save_and_type_path, PHRASE_TAB_LABEL, _rewrap)
+    registry = WindowRegistry(title_re)
+    tabs: Dict[int, Any] = {}      # HWND → 「フレーズ編集」の TabItem（選択状態の確認を 1 回の COM 呼び出しにする）
+
+    def phrase_tab(win, key: int):
+        t = tabs.get(key)
+        if t is None:
+            for item in win.descendants(control_type="TabItem"):
+                if PHRASE_TAB_LABEL in (item.window_text() or item.element_info.name or ""):
+                    t = tabs[key] = _rewrap(item)
+                    break
+        return t
+
+    def send(msg: Dict):
+        out.write((json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8"))
+        out.flush()
+
+    def run(op: str, args, hwnd: Optional[int]):
+        if op == "ping":
+            return True, None
+        win = registry.voiceroid_window(timeout=0.5, hwnd=hwnd)
+        if op == "attach":
+            return win is not None, registry.voiceroid_hwnd() if win is not None else None
+        if win is None:
+            return False, None
+        key = hwnd or registry.voiceroid_hwnd() or 0
+        if op == "tab_selected":
+            t = phrase_tab(win, key)
+            if t is None:
+                return False, None
+            try:
+                return True, bool(t.is_selected())
+            except Exception:
+                tabs.pop(key, None)
+                raise
+        if op == "tab":
+            t = tabs.get(key)
+            if t is not None:
+                try:
+                    t.select()
+                    return True, None
+                except Exception:
+                    tabs.pop(key, None)
+            return ensure_phrase_tab(win, timeout=2.0), None
+        if op == "text":
+            return set_phrase_text(win, args[0]), None
+        if op == "play":
+            return click_play(win), None
+        if op == "say":
+            return set_phrase_text(win, args[0]) and click_play(win), None
+        if op == "save":
+            return click_save_and_type_path(win, args[0]), None
+        raise ValueError(f"unknown op: {op}")
+
+    send({"ready": True, "pid": os.getpid(), "hwnd": registry.voiceroid_hwnd()})
+    for line in sys.stdin.buffer:
+        try:
+            req = json.loads(line.decode("utf-8"))
+        except ValueError:
+            continue
+        res = {"id": req.get("id"), "turn": req.get("turn")}
+        t0 = time.time()
+        try:
+            ok, value = run(req.get("op"), req.get("args") or [], req.get("hwnd"))
+            res.update(ok=bool(ok), value=value if value is not None else bool(ok))
+        except Exception as e:
+            # COM エラー等。ラッパを捨てて次の操作で取り直す
+            registry.invalidate(req.get("hwnd"))
+            tabs.clear()
+            res.update(ok=False, value=False, error=f"{type(e).__name__}: {e}")
+        res["t"] = [t0, time.time()]
+        res["hwnd"] = registry.voiceroid_hwnd()
+        send(res)
+
+
+def main():
+    p = argparse.ArgumentParser(prog="kiritan_uia_worker")
+    p.add_argument("--serve", action="store_true", help="（内部用）子プロセスとして動く")
+    p.add_argument("--title", default=TITLE_RE)
+    p.add_argument("--ping", action="store_true", help="子を起動して応答時間を測る")
+    p.add_argument("--say", help="テキストを入れて再生")
+    args = p.parse_args()
+    if args.serve:
+        serve(args.title)
+        return
+    w = UiaWorker(args.title)
+    w.start()
+    try:
+        t0 = time.time()
+        ok = w._try("ping", deadline=SPAWN_TIMEOUT)
+        print(f"[uia] ping {'OK' if ok else 'NG'}（{(time.time() - t0) * 1000:.0f}ms, hwnd={w.hwnd}）")
+        if args.say:
+            print(f"[uia] say {'OK' if w.say(args.say) else 'NG'}")
+        print(f"[uia] {w.stats.summary()}")
+    finally:
+        w.close()
+
+
+if __name__ == "__main__":
+    main()
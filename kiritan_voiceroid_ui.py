@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+VOICEROID＋ 東北きりたん EX の UI 操作（UIA）
+- 入力欄への流し込み・「再生」・「音声保存」・「フレーズ編集」タブへの復帰
+- import しても子プロセスやスレッドは起こさない（GUI Plus / UIA ワーカーの子 / voiceroid backend が共有する）
+"""
+
+import re
+import time
+from typing import Optional
+
+from pywinauto import Desktop, keyboard
+from pywinauto.base_wrapper import BaseWrapper
+
+from kiritan_winreg import WindowRegistry
+
+TITLE_RE = r"VOICEROID[＋+]\s*.*東北きりたん\s*EX(?:[^\S\r\n]*[\+\*/☆])?$"
+PLAY_LABEL_RE = r"再生"
+SAVE_LABEL_RE = r"音声保存"
+PHRASE_TAB_LABEL = "フレーズ編集"
+
+# VOICEROID のハンドルは 1 回だけ解決して使い回す
+WINDOWS = WindowRegistry(TITLE_RE)
+
+
+# ---- UTILS ----
+def _rewrap(ctrl) -> BaseWrapper:
+    """ElementInfo/Wrapper どちらでも Wrapper を返す"""
+    if isinstance(ctrl, BaseWrapper):
+        return ctrl
+    if hasattr(ctrl, "wrapper_object"):
+        return ctrl.wrapper_object()
+    return ctrl
+
+def find_voiceroid_window(timeout: float = 3.0) -> Optional[BaseWrapper]:
+    """VOICEROID トップレベルウィンドウを取る（見つからなければ None）。ハンドルはキャッシュして生存確認のみ"""
+    return WINDOWS.voiceroid_window(timeout)
+
+def ensure_phrase_tab(win: BaseWrapper, timeout: float = 3.0) -> bool:
+    """「フレーズ編集」タブへ復帰（select→invoke→click_input フォールバック）"""
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            tabs = win.descendants(control_type="TabItem")
+        except Exception:
+            tabs = []
+        for t in tabs:
+            name = (t.window_text() or t.element_info.name or "").strip()
+            if PHRASE_TAB_LABEL in name:
+                w = _rewrap(t)
+                try:
+                    w.select()
+                    return True
+                except Exception:
+                    pass
+                try:
+                    w.invoke()
+                    return True
+                except Exception:
+                    pass
+                try:
+                    w.click_input()
+                    return True
+                except Exception:
+                    pass
+        time.sleep(0.2)
+    return False
+
+def _find_text_area(win: BaseWrapper):
+    """入力欄（Document/Edit）候補を探す"""
+    nodes = []
+    try:
+        nodes = win.descendants(control_type="Document")
+    except Exception:
+        pass
+    if not nodes:
+        try:
+            nodes = win.descendants(control_type="Edit")
+        except Exception:
+            pass
+    return [_rewrap(x) for x in nodes]
+
+def set_phrase_text(win: BaseWrapper, text: str) -> bool:
+    """入力欄に text を流し込む"""
+    areas = _find_text_area(win)
+    for a in areas:
+        try:
+            # UIA の edit wrapper は set_edit_text を持っていることが多い
+            if hasattr(a, "set_edit_text"):
+                a.set_edit_text(text)
+            else:
+                a.set_focus()
+                keyboard.send_keys("^a{BACKSPACE}")
+                time.sleep(0.05)
+                keyboard.send_keys(text, with_spaces=True, pause=0.01)
+            return True
+        except Exception:
+            continue
+    return False
+
+def click_play(win: BaseWrapper) -> bool:
+    """「再生」ボタンを押す -> 失敗時 F5 → Space"""
+    try:
+        btns = win.descendants(control_type="Button")
+    except Exception:
+        btns = []
+    # 名前に「再生」が含まれるボタンを可視優先で
+    cand = []
+    for b in btns:
+        name = (b.window_text() or b.element_info.name or "").strip()
+        if re.search(PLAY_LABEL_RE, name):
+            cand.append(_rewrap(b))
+    # 可視優先
+    cand = sorted(cand, key=lambda w: 0 if w.is_visible() else 1)
+    for w in cand:
+        try:
+            w.click_input()
+            return True
+        except Exception:
+            continue
+    # フォールバック
+    try:
+        win.set_focus()
+    except Exception:
+        pass
+    try:
+        keyboard.send_keys("{F5}")
+        return True
+    except Exception:
+        pass
+    try:
+        keyboard.send_keys(" ")
+        return True
+    except Exception:
+        pass
+    return False
+
+def click_save_and_type_path(win: BaseWrapper, path: str, timeout: float = 4.0) -> bool:
+    """「音声保存」→ 保存ダイアログにパス入力 → Enter"""
+    try:
+        btns = win.descendants(control_type="Button")
+    except Exception:
+        btns = []
+    target = None
+    for b in btns:
+        name = (b.window_text() or b.element_info.name or "").strip()
+        if re.search(SAVE_LABEL_RE, name):
+            target = _rewrap(b)
+            break
+    if not target:
+        return False
+    try:
+        target.click_input()
+    except Exception:
+        return False
+
+    # 保存ダイアログ（日本語/英語）にざっくり対応
+    end = time.time() + timeout
+    dlg = None
+    title_re = r"(名前を付けて保存|保存|Save As)"
+    desktop = Desktop(backend="uia")
+    while time.time() < end:
+        ds = desktop.windows(title_re=title_re, control_type="Window")
+        if ds:
+            dlg = _rewrap(ds[0]); break
+        time.sleep(0.2)
+    if not dlg:
+        return False
+
+    try:
+        dlg.set_focus()
+        keyboard.send_keys("^l")           # パス入力ボックスへ（エクスプローラー準拠）
+        time.sleep(0.1)
+        keyboard.send_keys(path, with_spaces=True)
+        time.sleep(0.1)
+        keyboard.send_keys("{ENTER}")
+        return True
+    except Exception:
+        return False
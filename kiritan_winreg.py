@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+ウィンドウハンドルのレジストリ（毎ターンのデスクトップ全走査をやめる）
+- 自分のコンソール（PowerShell / Windows Terminal）は起動時に 1 回だけ解決
+  GetConsoleWindow → 見えないとき（Windows Terminal 等）は起動直後の前面ウィンドウ
+- VOICEROID のウィンドウも 1 回だけ列挙して HWND をキャッシュ
+- 以後は IsWindow + タイトル 1 回取得の軽い生存確認だけ。死んだ / タイトルが変わったときだけ再探索
+- UIA ラッパもハンドルごとにキャッシュ（Desktop(backend="uia") を毎回作らない）
+
+Windows 以外では何もしない（ハンドルは常に None）。
+"""
+
+import os
+import re
+import sys
+import time
+import ctypes
+import threading
+from typing import Optional, List, Dict, Tuple
+
+if os.name == "nt":
+    from ctypes import wintypes
+    _user32 = ctypes.windll.user32
+    _kernel32 = ctypes.windll.kernel32
+    _EnumWindowsProc = ctypes.WINFUNCTYPE(wintypes.BOOL, wintypes.HWND, wintypes.LPARAM)
+else:
+    _user32 = None
+    _kernel32 = None
+
+# 既定は GUI 発展版と同じ（+/＋、末尾の * 等を許容）
+TITLE_RE = r"VOICEROID[＋+]\s*.*東北きりたん\s*EX(?:[^\S\r\n]*[\+\*/☆])?$"
+
+
+# ---------------- Win32 小物 ----------------
+def window_text(hwnd: int) -> str:
+    if _user32 is None or not hwnd:
+        return ""
+    n = _user32.GetWindowTextLengthW(hwnd)
+    buf = ctypes.create_unicode_buffer(n + 1)
+    _user32.GetWindowTextW(hwnd, buf, n + 1)
+    return buf.value
+
+
+def is_alive(hwnd: Optional[int]) -> bool:
+    return bool(_user32 is not None and hwnd and _user32.IsWindow(hwnd))
+
+
+def window_pid(hwnd: int) -> Optional[int]:
+    if _user32 is None or not hwnd:
+        return None
+    pid = wintypes.DWORD()
+    _user32.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
+    return pid.value or None
+
+
+def enum_windows(title_re: str) -> List[int]:
+    """タイトルが title_re に一致する可視トップレベルウィンドウを列挙（再探索時だけ使う）"""
+    if _user32 is None:
+        return []
+    pat = re.compile(title_re)
+    found: List[int] = []
+
+    def _cb(hwnd, _):
+        if _user32.IsWindowVisible(hwnd) and pat.search(window_text(hwnd)):
+            found.append(hwnd)
+        return True
+
+    _user32.EnumWindows(_EnumWindowsProc(_cb), 0)
+    return found
+
+
+def resolve_console() -> Optional[int]:
+    """自分が動いているコンソールのウィンドウ"""
+    if _user32 is None:
+        return None
+    hwnd = _kernel32.GetConsoleWindow()
+    if hwnd and _user32.IsWindowVisible(hwnd):
+        return hwnd
+    # Windows Terminal 等は疑似コンソールなので、起動直後の前面ウィンドウを自分とみなす
+    return _user32.GetForegroundWindow() or None
+
+
+# ---------------- レジストリ ----------------
+class WindowRegistry:
+    def __init__(self, title_re: str = TITLE_RE):
+        self.title_re = title_re
+        self._pat = re.compile(title_re)
+        self._lock = threading.Lock()
+        self._console: Optional[int] = resolve_console()
+        self._voiceroid: List[int] = []
+        self._wrappers: Dict[int, object] = {}
+        self.rediscoveries = 0
+
+    # ---- コンソール ----
+    def console(self) -> Optional[int]:
+        if not is_alive(self._console):
+            self._console = resolve_console()
+        return self._console
+
+    def focus_console(self) -> bool:
+        """コンソールを前面へ（ウィンドウ走査はしない）"""
+        hwnd = self.console()
+        if not hwnd:
+            return False
+        try:
+            if _user32.GetForegroundWindow() == hwnd:
+                return True
+            return bool(_user32.SetForegroundWindow(hwnd))
+        except Exception:
+            return False
+
+    # ---- VOICEROID ----
+    def _valid(self, hwnd: int) -> bool:
+        return is_alive(hwnd) and bool(self._pat.search(window_text(hwnd)))
+
+    def voiceroid_hwnds(self) -> List[int]:
+        """生きている VOICEROID ウィンドウ（キャッシュが全滅したときだけ再列挙）"""
+        with self._lock:
+            alive = [h for h in self._voiceroid if self._valid(h)]
+            if not alive:
+                alive = enum_windows(self.title_re)
+                if alive:
+                    self.rediscoveries += 1
+            for h in list(self._wrappers):
+                if h not in alive:
+                    self._wrappers.pop(h, None)
+            self._voiceroid = alive
+            return list(alive)
+
+    def voiceroid_hwnd(self, timeout: float = 0.0) -> Optional[int]:
+        end = time.time() + timeout
+        while True:
+            hwnds = self.voiceroid_hwnds()
+            if hwnds:
+                return hwnds[0]
+            if time.time() >= end:
+                return None
+            time.sleep(0.2)
+
+    def voiceroid_handle(self) -> Tuple[Optional[int], Optional[int]]:
+        """(HWND, PID)。kiritan_chat_cli の find_voiceroid_handle 互換"""
+        hwnd = self.voiceroid_hwnd()
+        return (hwnd, window_pid(hwnd)) if hwnd else (None, None)
+
+    def voiceroid_window(self, timeout: float = 3.0, hwnd: Optional[int] = None):
+        """UIA ラッパ（ハンドルが生きている間は同じオブジェクトを返す）"""
+        hwnd = hwnd or self.voiceroid_hwnd(timeout)
+        if not hwnd:
+            return None
+        w = self._wrappers.get(hwnd)
+        if w is None:
+            from pywinauto import Desktop
+            try:
+                w = Desktop(backend="uia").window(handle=hwnd).wrapper_object()
+            except Exception as e:
+                print(f"[winreg] UIA ラッパ取得失敗: {e}", file=sys.stderr)
+                return None
+            self._wrappers[hwnd] = w
+        return w
+
+    def invalidate(self, hwnd: Optional[int] = None):
+        """操作が失敗したときなどに呼ぶ。次回アクセスで再検証/再探索される"""
+        with self._lock:
+            if hwnd is None:
+                self._voiceroid = []
+                self._wrappers.clear()
+            else:
+                self._wrappers.pop(hwnd, None)
+                self._voiceroid = [h for h in self._voiceroid if h != hwnd]